@@ -24,7 +24,10 @@ setup(name="sparkle",
                         'pydaqmx',
                         ],
       package_data={'':['*.conf', '*.jpg', '*.png', "*.ico"]},
-      entry_points={'console_scripts':['sparkle=sparkle.gui.run:main']},
+      entry_points={'console_scripts':['sparkle=sparkle.gui.run:main',
+                                          'sparkle-repack=sparkle.data.repack:main',
+                                          'sparkle-analyze=sparkle.data.analyze:main',
+                                          'sparkle-calibration-curve=sparkle.data.calibration_curve:main']},
       classifiers = [
         "Programming Language :: Python",
         "Programming Language :: Python :: 2",
@@ -7,6 +7,7 @@ import yaml
 
 from sparkle.acq.daq_tasks import AITask, AITaskFinite, AOTaskFinite, \
     DigitalOutTask
+from sparkle.tools.timing import monotonic
 
 if platform.system() == 'Windows':
     import win32com.client
@@ -44,6 +45,17 @@ class AbstractPlayerBase(object):
         self.trigger_src = None #"PCI-6259/port0/line1"  
         self.trigger_dest = None #"/PCI-6259/PFI0"
 
+        self.timing = None
+
+    def set_timing(self, recorder):
+        """Sets where to record how long arming ('daq_arm') and reading
+        ('read') take
+
+        :param recorder: the recorder to use, ``None`` to stop recording
+        :type recorder: :class:`TimingRecorder<sparkle.tools.timing.TimingRecorder>`
+        """
+        self.timing = recorder
+
     def start(self):
         """Abstract, must be implemented by subclass"""
         raise NotImplementedError
@@ -227,11 +239,14 @@ class FinitePlayer(AbstractPlayerBase):
             # acquire data and stop task, lock must have been release by
             # previous reset
             self.daq_lock.acquire()
+            start = monotonic()
             self.aotask.StartTask()
             self.aitask.StartTask()
 
             # blocking read
             data = self.aitask.read()
+            if self.timing is not None:
+                self.timing.record('read', monotonic() - start)
 
             # write task should always be shorter than read
             # self.aotask.WaitUntilTaskDone(10)
@@ -254,8 +269,11 @@ class FinitePlayer(AbstractPlayerBase):
 
         response_npts = int(self.aitime*self.aifs)
         try:
+            start = monotonic()
             self.aitask = AITaskFinite(self.aichan, self.aifs, response_npts, trigsrc=self.trigger_dest)
             new_gen = self.reset_generation(u"ai/StartTrigger")
+            if self.timing is not None:
+                self.timing.record('daq_arm', monotonic() - start)
         except:
             print u'ERROR! TERMINATE!'
             self.daq_lock.release()
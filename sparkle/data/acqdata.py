@@ -10,6 +10,30 @@ to provide actual access to datafiles. Implementation will depend on the interna
 of the data file.
 """
 
+def make_layout(chunked=False, chunks=None, compression=None, compression_opts=None,
+                shuffle=False, dtype='float32', full_scale=10.0):
+    """Checks, and puts together, the settings for how trace data is 
+    stored, see :meth:`AcquisitionData.set_layout`
+
+    :returns: dict -- the layout
+    """
+    if dtype not in ['float32', 'float64', 'int16']:
+        raise ValueError("Unsupported data type: {}".format(dtype))
+    if compression not in [None, 'gzip', 'lzf']:
+        raise ValueError("Unsupported compression: {}".format(compression))
+    if full_scale <= 0:
+        raise ValueError("Full scale must be positive")
+    if chunks is not None:
+        chunks = tuple(int(size) for size in chunks)
+        if len(chunks) == 0 or min(chunks) < 1:
+            raise ValueError("Chunk sizes must be positive: {}".format(chunks))
+    return {'chunked': chunked or chunks is not None or compression is not None or shuffle,
+            'chunks': chunks,
+            'compression': compression, 
+            'compression_opts': compression_opts,
+            'shuffle': shuffle, 'dtype': dtype,
+            'full_scale': full_scale}
+
 class AcquisitionData(object):
     """
     Provides convenient access to data file; 
@@ -49,10 +73,49 @@ class AcquisitionData(object):
         self.open_set_size = 32
         self.chunk_size = 2**24 # better to have a multiple of fs?
         self.needs_repack = False
+        # bytes of data deleted from the file, and how many it takes to be
+        # worth repacking the file on close
+        self.freed_space = 0
+        self.repack_threshold = 2**26
+        # how trace data is stored, see set_layout
+        self.layout = make_layout()
 
         self.datasets = {}
         self.meta = {}
+        self.timing = None
 
+    def set_timing(self, recorder):
+        """Sets where to record how long appending data takes ('save')
+
+        :param recorder: the recorder to use, ``None`` to stop recording
+        :type recorder: :class:`TimingRecorder<sparkle.tools.timing.TimingRecorder>`
+        """
+        self.timing = recorder
+
+
+    def set_layout(self, chunked=False, chunks=None, compression=None, compression_opts=None,
+                   shuffle=False, dtype='float32', full_scale=10.0):
+        """Sets how trace data is stored for datasets initialized after this
+        call. This applies to finite datasets, and the recorded signals of 
+        calibrations; other datasets keep the default layout.
+
+        :param chunked: Whether to store the data in chunks, by default of a single trace, rep and channel, so each recording may be written and read on its own. Implied by *chunks* and any of the filters.
+        :type chunked: bool
+        :param chunks: Shape of the chunks, for the last dimensions of the data e.g. (reps, channels, samples); earlier dimensions are chunked by 1, and sizes larger than a dataset are cut down to fit it. ``None`` for a chunk per recording.
+        :type chunks: tuple
+        :param compression: Compression filter to use: 'gzip', 'lzf' or ``None``
+        :type compression: str
+        :param compression_opts: Setting for the compression filter, e.g. gzip level 0-9
+        :type compression_opts: int
+        :param shuffle: Whether to use the byte shuffle filter, which usually improves compression
+        :type shuffle: bool
+        :param dtype: Type to store samples as: 'float32', 'float64', or 'int16'. int16 samples are scaled to *full_scale*, and converted back to volts when read.
+        :type dtype: str
+        :param full_scale: For int16 storage, the largest magnitude (V) that may be stored, larger values are clipped
+        :type full_scale: float
+        """
+        self.layout = make_layout(chunked, chunks, compression, compression_opts,
+                                  shuffle, dtype, full_scale)
 
     def close(self):
         """Closes the datafile, only one reference to a file may be 
@@ -128,6 +191,14 @@ class AcquisitionData(object):
         """
         raise NotImplementedError
 
+    def flush(self):
+        """Writes any data that has been appended, but is still held in
+        memory, to the file. Appended data is written a trace at a time, 
+        this should be called when an acquisition stops partway 
+        through a trace.
+        """
+        raise NotImplementedError
+
     def get_data(self, key, index=None):
         """
         Returns data for key at specified index
@@ -187,13 +258,15 @@ class AcquisitionData(object):
         """
         raise NotImplementedError
 
-    def append_trace_info(self, key, stim_data):
+    def append_trace_info(self, key, stim_data, nested_name=None):
         """Sets the stimulus documentation for the given dataset/groupname. If key is for a finite group, sets for current test
 
         :param key: Group or dataset name
         :type key: str
         :param stim_data: JSON formatted data to append to a list
         :type stim_data: str
+        :param nested_name: If mode is 'calibration', the dataset under group *key* the stimulus is for. Otherwise it is 'reference_tone' for a pure tone, and 'signal' for anything else. Ignored for other modes.
+        :type nested_name: str
         """
         raise NotImplementedError
 
@@ -216,14 +289,17 @@ class AcquisitionData(object):
         """
         raise NotImplementedError
 
-    def get_trace_stim(self, key):
+    def get_trace_stim(self, key, index=None):
         """Gets a list of the stimulus metadata for the given dataset *key*.
 
         :param key: The name of group or dataset to get stimulus info for
         :type key: str
+        :param index: The trace to get stimulus info for, ``None`` gets all traces
+        :type index: int
         :returns: list<dict> -- each dict in the list holds the stimulus info
          for each trace in the test. Therefore, the list should have a length equal 
-         to the number of traces in the given test.
+         to the number of traces in the given test. If *index* is given, only
+         the dict for that trace is returned.
         """
         raise NotImplementedError
 
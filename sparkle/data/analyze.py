@@ -0,0 +1,410 @@
+"""Batch spike analysis of sparkle data files, for when there are too many
+to go through in the GUI. Every test of every file is analysed, spread
+across processes, and the results for each trace and channel are saved
+to an HDF5 file, as a table with a data set for each column, e.g.::
+
+    $ python -m sparkle.data.analyze -t 0.2 -o results.hdf5 day1/*.hdf5
+
+Finished tests are listed in a manifest file beside the results
+(results.hdf5.manifest), so if the analysis is stopped, running the
+same command again carries on from where it left off.
+
+With ``--save-spikes``, the spikes found are also saved in the data files
+themselves, so the GUI can use them when reviewing the data instead of
+finding them again (with ``-o`` left out, this is all that is done)::
+
+    $ python -m sparkle.data.analyze -t 0.2 --save-spikes day1/*.hdf5
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import re
+import sys
+
+import h5py
+import numpy as np
+
+from sparkle.data.open import open_acqdata
+from sparkle.tools.spikestats import batch_spike_indices
+from sparkle.tools.util import convert2native
+
+STR_DTYPE = h5py.special_dtype(vlen=unicode)
+
+# name, dtype of each column of results
+COLUMNS = [('file', STR_DTYPE),
+           ('test', STR_DTYPE),
+           ('trace', np.int32),
+           ('channel', np.int32),
+           ('reps', np.int32),
+           ('spike_count', np.int32), # total of all reps
+           ('mean_count', np.float64), # spikes per rep
+           ('latency_mean', np.float64), # of the first spike in each rep (s)
+           ('latency_sd', np.float64),
+           ('rate', np.float64), # spikes per second
+           ('psth', h5py.special_dtype(vlen=np.int32)), # spike counts of all reps, in bins from the start of recording
+           ('stim', STR_DTYPE), # JSON stimulus info
+           ]
+
+def analyze(filenames, output, threshold, absval=True, polarity=1,
+            window=None, binsz=0.001, refract=0.002, nprocs=None, progress=None):
+    """Finds the spikes in every test of the data files, and saves summary
+    results of each trace and channel to *output*. Carries on from a previous
+    run with the same *output*, if there was one.
+
+    :param filenames: Data files to analyse
+    :type filenames: list<str>
+    :param output: Name of the HDF5 file to save results to
+    :type output: str
+    :param threshold: Threshold value to determine spikes, one value, or one for each channel
+    :type threshold: float or list
+    :param absval: Whether to apply absolute value to the signal before thresholding, one value, or one for each channel
+    :type absval: bool or list
+    :param polarity: Multiplies the signal (1 or -1) before thresholding, one value, or one for each channel
+    :type polarity: int or list
+    :param window: Start and stop time (seconds) of the part of the recordings to analyse, ``None`` for all of it
+    :type window: (float, float)
+    :param binsz: PSTH bin size (seconds)
+    :type binsz: float
+    :param refract: Refractory period in seconds
+    :type refract: float
+    :param nprocs: Number of processes to use, ``None`` for one per CPU; 1 does everything in this process
+    :type nprocs: int
+    :param progress: Function called with (number of tests done, total tests) as each test finishes
+    :type progress: callable
+    :returns: int -- number of tests analysed by this call
+    """
+    params = {'threshold': threshold, 'absval': absval, 'polarity': polarity,
+              'window': window, 'binsz': binsz, 'refract': refract}
+    manifest = Manifest(output + '.manifest')
+    results = ResultsTable(output, params)
+    try:
+        # rows of a test that did not make it into the manifest are redone
+        results.truncate(manifest.nrows)
+        units = [(os.path.abspath(filename), test, params) for filename in filenames
+                 for test in list_units(filename)]
+        todo = [unit for unit in units if (unit[0], unit[1]) not in manifest]
+        ndone = len(units) - len(todo)
+
+        if nprocs == 1:
+            pool = None
+            unit_results = itertools.imap(analyze_unit, todo)
+        else:
+            pool = multiprocessing.Pool(nprocs)
+            unit_results = pool.imap_unordered(analyze_unit, todo)
+        try:
+            for filename, test, rows in unit_results:
+                results.append(rows)
+                manifest.record(filename, test, len(rows['trace']))
+                ndone += 1
+                if progress is not None:
+                    progress(ndone, len(units))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+    finally:
+        results.close()
+        manifest.close()
+    return len(todo)
+
+def save_spikes(filenames, threshold, absval=True, polarity=1, refract=0.002,
+                nprocs=None, progress=None):
+    """Finds the spikes in every test of the data files, and saves them in
+    each file, see :meth:`build_spike_index<sparkle.data.hdf5data.HDF5Data.build_spike_index>`.
+    Each file is done in one process, as it is written to. Files which
+    spikes cannot be saved in, e.g. Batlab data, are skipped.
+
+    :param filenames: Data files to find spikes in
+    :type filenames: list<str>
+    :param nprocs: Number of processes to use, ``None`` for one per CPU; 1 does everything in this process
+    :type nprocs: int
+    :param progress: Function called with (number of files done, total files) as each file finishes
+    :type progress: callable
+    :returns: int -- number of tests indexed
+
+    The other parameters are as for :func:`analyze`
+    """
+    params = {'threshold': threshold, 'absval': absval, 'polarity': polarity,
+              'refract': refract}
+    todo = []
+    for filename in filenames:
+        if can_save_spikes(filename):
+            todo.append((os.path.abspath(filename), params))
+        else:
+            logger = logging.getLogger('main')
+            logger.warning('Spikes can only be saved in HDF5 data files, skipping %s' % filename)
+    if nprocs == 1:
+        pool = None
+        file_results = itertools.imap(index_file, todo)
+    else:
+        pool = multiprocessing.Pool(nprocs)
+        file_results = pool.imap_unordered(index_file, todo)
+    ntests = 0
+    try:
+        for ndone, tests in enumerate(file_results):
+            ntests += len(tests)
+            if progress is not None:
+                progress(ndone + 1, len(todo))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return ntests
+
+def can_save_spikes(filename):
+    """Whether spikes can be saved in a data file, see :func:`save_spikes`.
+    Only sparkle's own HDF5 files can hold them.
+
+    :returns: bool
+    """
+    return filename.lower().endswith(('.hdf5', '.h5'))
+
+def index_file(unit):
+    """Saves the spikes of every test in a data file. The unit of work
+    given to each process by :func:`save_spikes`.
+
+    :param unit: data file name, and detection parameters (keyword arguments of :func:`save_spikes`)
+    :type unit: (str, dict)
+    :returns: list<str> -- names of the tests indexed
+    """
+    filename, params = unit
+    datafile = open_acqdata(filename, filemode='a')
+    try:
+        return datafile.build_spike_index('', **params)
+    finally:
+        datafile.close()
+
+def list_units(filename):
+    """Names of the finite tests in a data file
+
+    :returns: list<str> -- keys of the test data sets
+    """
+    datafile = open_acqdata(filename, filemode='r')
+    try:
+        return [name for name in datafile.dataset_names()
+                if re.match(r'test_\d+$', name.rpartition('/')[-1])]
+    finally:
+        datafile.close()
+
+def analyze_unit(unit):
+    """Analyses each trace of a test, in the same way as spike statistics
+    are worked out in the GUI. The unit of work given to each process.
+
+    :param unit: data file name, test name, and analysis parameters (keyword arguments of :func:`analyze`)
+    :type unit: (str, str, dict)
+    :returns: (str, str, dict) -- data file name, test name, and a list of values for each column of results
+    """
+    filename, test, params = unit
+    rows = dict((name, []) for name, dtype in COLUMNS)
+    datafile = open_acqdata(filename, filemode='r')
+    try:
+        fs = datafile.get_info(test, inherited=True)['samplerate_ad']
+        stims = datafile.get_trace_stim(test)
+        if stims is None:
+            ntraces = datafile.get_data(test).shape[0]
+        else:
+            ntraces = len(stims)
+        for itrace in range(ntraces):
+            tracedata = datafile.get_data(test, (itrace,))
+            if len(tracedata.shape) == 2:
+                # backwards compatibility: old data has no channel dimension
+                tracedata = tracedata.reshape((tracedata.shape[0], 1, tracedata.shape[1]))
+            stim = None if stims is None else json.dumps(convert2native(stims[itrace]))
+            trace_rows = analyze_trace(tracedata, fs, params)
+            for ichan, row in enumerate(trace_rows):
+                row.update({'file': filename, 'test': test, 'trace': itrace,
+                            'channel': ichan, 'stim': stim or u''})
+                for name, value in row.items():
+                    rows[name].append(value)
+    finally:
+        datafile.close()
+    return filename, test, rows
+
+def analyze_trace(tracedata, fs, params):
+    """Spike statistics of each channel of a trace
+
+    :param tracedata: recordings of dimensions (rep, channel, samples)
+    :type tracedata: numpy.ndarray
+    :param fs: samplerate of the recordings
+    :type fs: int
+    :param params: analysis parameters (keyword arguments of :func:`analyze`)
+    :type params: dict
+    :returns: list<dict> -- result columns, for each channel
+    """
+    nreps, nchans, npoints = tracedata.shape
+    polarity = np.empty((nchans,))
+    polarity[:] = params['polarity']
+    if params['window'] is None:
+        start_time, stop_time = 0, float(npoints)/fs
+    else:
+        start_time, stop_time = params['window']
+    start_index = int(fs*start_time)
+    stop_index = int(fs*stop_time)
+    binsz = params['binsz']
+    nbins = int(np.ceil(float(npoints)/fs/binsz))
+
+    # reps by channels
+    recordings = tracedata[:,:,start_index:stop_index]*polarity[:,np.newaxis]
+    offsets, indices = batch_spike_indices(recordings, params['threshold'], fs,
+                                           params['absval'], params['refract'])
+    counts = np.diff(offsets).reshape((nreps, nchans))
+    times = (indices + start_index).astype(float)/fs
+
+    rows = []
+    for ichan in range(nchans):
+        # first spike of each rep with any spikes
+        latencies = [times[offsets[irep*nchans + ichan]] for irep in range(nreps)
+                     if counts[irep, ichan] > 0]
+        chan_times = np.concatenate([times[offsets[irep*nchans + ichan]:offsets[irep*nchans + ichan + 1]]
+                                     for irep in range(nreps)] + [np.zeros(0)])
+        psth = np.bincount(np.floor(np.around(chan_times/binsz, 5)).astype(int),
+                           minlength=nbins)
+        rows.append({'reps': nreps,
+                     'spike_count': counts[:,ichan].sum(),
+                     'mean_count': counts[:,ichan].mean(),
+                     'latency_mean': np.mean(latencies) if latencies else np.nan,
+                     'latency_sd': np.std(latencies) if latencies else np.nan,
+                     'rate': counts[:,ichan].mean()/(stop_time - start_time),
+                     'psth': psth.astype(np.int32)})
+    return rows
+
+class ResultsTable(object):
+    """Results saved in an HDF5 file, as a data set for each column that
+    grows as rows are appended. An existing file is added to, if it was
+    made with the same analysis parameters.
+
+    :param filename: Name of the results file
+    :type filename: str
+    :param params: the analysis parameters
+    :type params: dict
+    """
+    def __init__(self, filename, params):
+        self.hdf5 = h5py.File(filename, 'a')
+        params = json.dumps(convert2native(dict(params)), sort_keys=True)
+        if 'params' in self.hdf5.attrs and self.hdf5.attrs['params'] != params:
+            self.hdf5.close()
+            raise ValueError("Results in {} are from different parameters: {}".format(filename, self.hdf5.attrs['params']))
+        self.hdf5.attrs['params'] = params
+        for name, dtype in COLUMNS:
+            if name not in self.hdf5:
+                self.hdf5.create_dataset(name, (0,), maxshape=(None,),
+                                         chunks=(1024,), dtype=dtype)
+
+    def __len__(self):
+        return self.hdf5[COLUMNS[0][0]].shape[0]
+
+    def append(self, rows):
+        """Adds rows to the end of the table, and writes them to disk
+
+        :param rows: a list of values for each column
+        :type rows: dict
+        """
+        nrows = len(self)
+        nnew = len(rows[COLUMNS[0][0]])
+        for name, dtype in COLUMNS:
+            column = self.hdf5[name]
+            column.resize((nrows + nnew,))
+            if name == 'psth':
+                # row by row, so that equal length PSTHs are not taken
+                # as a 2-D array
+                for irow, value in enumerate(rows[name]):
+                    column[nrows + irow] = value
+            elif nnew > 0:
+                column[nrows:] = rows[name]
+        self.hdf5.flush()
+
+    def truncate(self, nrows):
+        """Removes rows past the first *nrows*"""
+        if nrows < len(self):
+            for name, dtype in COLUMNS:
+                self.hdf5[name].resize((nrows,))
+            self.hdf5.flush()
+
+    def close(self):
+        self.hdf5.close()
+
+class Manifest(object):
+    """Record of the tests that have been analysed, and how many rows of
+    results each added, kept in a text file with a JSON line per test.
+
+    :param filename: Name of the manifest file, which is added to if it exists
+    :type filename: str
+    """
+    def __init__(self, filename):
+        self.done = set()
+        self.nrows = 0
+        if os.path.isfile(filename):
+            with open(filename) as manifest:
+                for line in manifest:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # partly written when stopped
+                        continue
+                    self.done.add((entry['file'], entry['test']))
+                    self.nrows += entry['rows']
+        self._file = open(filename, 'a')
+
+    def __contains__(self, unit):
+        return unit in self.done
+
+    def record(self, filename, test, nrows):
+        """Notes that a test is done, once its results are saved"""
+        self._file.write(json.dumps({'file': filename, 'test': test, 'rows': nrows}) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.done.add((filename, test))
+        self.nrows += nrows
+
+    def close(self):
+        self._file.close()
+
+def print_progress(done, total, units='tests'):
+    sys.stdout.write('\r{}/{} {}'.format(done, total, units))
+    sys.stdout.flush()
+
+def print_file_progress(done, total):
+    print_progress(done, total, 'files')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch spike analysis of sparkle data files")
+    parser.add_argument('files', nargs='+', help="data files to analyse")
+    parser.add_argument('-o', '--output', help="HDF5 file to save results to")
+    parser.add_argument('-t', '--threshold', type=float, nargs='+', required=True,
+                        help="spike threshold, or one for each channel")
+    parser.add_argument('--no-abs', action='store_true', help="do not use the absolute value of the signal")
+    parser.add_argument('--invert', action='store_true', help="invert the polarity of the signal")
+    parser.add_argument('--window', type=float, nargs=2, metavar=('START', 'STOP'),
+                        help="part of each recording to analyse (seconds)")
+    parser.add_argument('--binsz', type=float, default=0.001, help="PSTH bin size (seconds)")
+    parser.add_argument('--refract', type=float, default=0.002, help="refractory period (seconds)")
+    parser.add_argument('-j', '--processes', type=int, help="number of processes, default one per CPU")
+    parser.add_argument('--save-spikes', action='store_true',
+                        help="save the spikes found in the data files, for the GUI to use")
+    args = parser.parse_args(argv)
+    if args.output is None and not args.save_spikes:
+        parser.error("one of -o/--output or --save-spikes is required")
+
+    threshold = args.threshold[0] if len(args.threshold) == 1 else args.threshold
+    polarity = -1 if args.invert else 1
+    if args.save_spikes:
+        for filename in args.files:
+            if not can_save_spikes(filename):
+                print 'not an HDF5 data file, spikes not saved:', filename
+        ntests = save_spikes(args.files, threshold, not args.no_abs, polarity,
+                             args.refract, args.processes, print_file_progress)
+        print '\nsaved spikes of {} tests'.format(ntests)
+    if args.output is None:
+        return
+    window = tuple(args.window) if args.window is not None else None
+    ntests = analyze(args.files, args.output, threshold, not args.no_abs,
+                     polarity, window, args.binsz, args.refract,
+                     args.processes, print_progress)
+    print '\nanalysed {} tests, results in {}'.format(ntests, args.output)
+
+if __name__ == '__main__':
+    main()
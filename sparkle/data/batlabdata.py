@@ -79,8 +79,13 @@ class BatlabData(AcquisitionData):
             return self._info[key]
 
     @doc_inherit
-    def get_trace_stim(self, key):
-        return self._info[key]['stim']
+    def get_trace_stim(self, key, index=None):
+        if 'stim' not in self._info.get(key, {}):
+            return None
+        if index is None:
+            return self._info[key]['stim']
+        else:
+            return self._info[key]['stim'][index]
 
 
     def calibration_list(self):
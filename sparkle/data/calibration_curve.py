@@ -0,0 +1,105 @@
+"""Processing for tone calibration curves: the levels of every recording
+of a block of tones are worked out together, as arrays. Used as the tones
+are recorded, and to work out the results of a curve saved in a data file
+(a calibration_test_N group) again, from its recordings, e.g.::
+
+    $ python -m sparkle.data.calibration_curve mydata.hdf5 calibration_test_1
+"""
+
+import argparse
+
+import numpy as np
+
+from sparkle.data.open import open_acqdata
+from sparkle.tools.audiotools import calc_db, calc_spectrum, \
+    signal_amplitude, spectrum_peaks
+
+
+def process_tones(responses, fs, frequencies):
+    """Levels of tones in their recordings, for a block of recordings at once
+
+    :param responses: recordings, along the last dimension e.g. (traces, reps, samples)
+    :type responses: numpy.ndarray
+    :param fs: samplerate of the recordings (Hz)
+    :type fs: int
+    :param frequencies: frequency of the tone in each recording; must broadcast against the recordings e.g. (traces, 1)
+    :type frequencies: float or numpy.ndarray
+    :returns: numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray -- frequencies of the spectra, spectrum of each recording, FFT peak at the tone frequency of each recording, signal amplitude of each recording
+    """
+    freq, spectra = calc_spectrum(responses, fs)
+    peaks = spectrum_peaks(spectra, freq, frequencies)
+    amps = signal_amplitude(responses, fs)
+    return freq, spectra, peaks, amps
+
+def reprocess(datafile, key, mphonesens=None, mphonedb=None, use_fft=False, block_size=2**25):
+    """Works out the results of a saved tone calibration curve again, from
+    its recordings. The recordings are read, and processed, a block of
+    traces at a time.
+
+    :param datafile: Data file the calibration curve is saved in
+    :type datafile: :class:`AcquisitionData<sparkle.data.acqdata.AcquisitionData>`
+    :param key: Name of the calibration curve group e.g. 'calibration_test_1'
+    :type key: str
+    :param mphonesens: Microphone sensitivity (V), default is the one used in the calibration
+    :type mphonesens: float
+    :param mphonedb: Intensity the microphone sensitivity was measured at (dB SPL), default is the one used in the calibration
+    :type mphonedb: float
+    :param use_fft: Whether to use the FFT peak at the tone frequency as the level of a tone, rather than the signal amplitude
+    :type use_fft: bool
+    :param block_size: The most bytes of recordings to process at once
+    :type block_size: int
+    :returns: numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray -- for each tone: frequency, intensity, intensity measured with the microphone (dB SPL), attenuation relative to the control tone (dB)
+    """
+    info = datafile.get_info(key)
+    fs = info['samplerate_ad']
+    if mphonesens is None:
+        mphonesens = info['microphone_sensitivity']
+    if mphonedb is None:
+        mphonedb = info['microphone_dB']
+
+    # traces that were finished have their stimulus saved
+    stims = datafile.get_trace_stim(key + '/signal')
+    frequencies = np.array([stim['components'][0]['frequency'] for stim in stims], dtype=float)
+    intensities = np.array([stim['components'][0]['intensity'] for stim in stims], dtype=float)
+    ntraces = len(stims)
+
+    levels = np.empty((ntraces,))
+    if ntraces > 0:
+        trace_size = datafile.get_data(key + '/signal', (0,)).nbytes
+        block_traces = max(1, block_size // trace_size)
+        for start in range(0, ntraces, block_traces):
+            stop = min(start + block_traces, ntraces)
+            responses = datafile.get_data(key + '/signal', (slice(start, stop),))
+            _, _, peaks, amps = process_tones(responses, fs, frequencies[start:stop, np.newaxis])
+            levels[start:stop] = np.mean(peaks if use_fft else amps, axis=1)
+
+    # control tone, at the calibration frequency and intensity
+    control_freq = datafile.get_trace_stim(key + '/reference_tone', 0)['components'][0]['frequency']
+    _, _, peaks, amps = process_tones(datafile.get_data(key + '/reference_tone'), fs, control_freq)
+    calpeak = np.mean(peaks if use_fft else amps)
+
+    resultdb = calc_db(levels, mphonesens, mphonedb)
+    attenuations = calc_db(levels, calpeak) * -1
+    return frequencies, intensities, resultdb, attenuations
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Work out the results of a tone calibration curve saved in a sparkle data file")
+    parser.add_argument('file', help="data file")
+    parser.add_argument('group', help="calibration curve group e.g. calibration_test_1")
+    parser.add_argument('--mphone-sens', type=float, help="microphone sensitivity (V), default is the one used in the calibration")
+    parser.add_argument('--mphone-db', type=float, help="intensity of microphone sensitivity (dB SPL), default is the one used in the calibration")
+    parser.add_argument('--fft', action='store_true',
+                        help="use the FFT peak at the tone frequency, rather than the signal amplitude")
+    args = parser.parse_args(argv)
+
+    datafile = open_acqdata(args.file, filemode='r')
+    try:
+        results = reprocess(datafile, args.group, args.mphone_sens, args.mphone_db, args.fft)
+    finally:
+        datafile.close()
+    print '{:>12}{:>8}{:>10}{:>14}'.format('frequency', 'dB', 'dB SPL', 'attenuation')
+    for frequency, intensity, resultdb, attenuation in zip(*results):
+        print '{:>12.0f}{:>8.1f}{:>10.2f}{:>14.2f}'.format(frequency, intensity, resultdb, attenuation)
+
+if __name__ == '__main__':
+    main()
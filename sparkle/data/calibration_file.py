@@ -0,0 +1,122 @@
+"""A calibration saved to a small file of its own, apart from the data
+file it was recorded in: the frequency response of the speaker, and the
+calibration filter kernels worked out from it for common samplerates.
+
+Arrays are stored uncompressed and contiguous, and are memory-mapped when
+the file is opened, rather than read in, so opening one takes about the
+same time no matter how big it is. That makes switching between the
+calibrations of many speakers on one rig close to instant, and nothing
+has to be worked out again when the calibration is applied to stimuli.
+"""
+
+import json
+import os
+import sys
+import tempfile
+
+import h5py
+import numpy as np
+
+from sparkle.tools.audiotools import impulse_response
+
+# samplerates kernels are worked out for, when saving
+SAMPLERATES = [100000, 200000, 250000, 400000, 500000]
+
+def save_calibration(filename, fresponse, frequencies, frange=None, calf=None,
+                     samplerates=SAMPLERATES, filter_len=2**14, source=None):
+    """Saves a calibration to *filename*, along with its filter kernels
+
+    :param filename: Name of the file to save to, replaced if it exists. A :class:`CalibrationFile` already opened from it keeps the old calibration
+    :type filename: str
+    :param fresponse: frequency response of the system (in dB)
+    :type fresponse: numpy.ndarray
+    :param frequencies: corresponding frequencies for the fresponse
+    :type frequencies: numpy.ndarray
+    :param frange: Frequency range to apply the calibration to, default is all of the frequencies
+    :type frange: (int, int)
+    :param calf: Frequency the frequency response is relative to
+    :type calf: int
+    :param samplerates: Samplerates to work out filter kernels for
+    :type samplerates: list<int>
+    :param filter_len: length of the filter kernels
+    :type filter_len: int
+    :param source: Where the calibration came from e.g. data file and group name
+    :type source: str
+    """
+    if frange is None:
+        # maximum possible range, as stimuli use
+        frange = (frequencies[0], frequencies[-1])
+    # written to a new file, which is then moved into place, rather than
+    # overwriting the file in place, where arrays memory-mapped from it
+    # would change under whoever is using them
+    fd, tmpname = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(filename)))
+    os.close(fd)
+    try:
+        with h5py.File(tmpname, 'w') as calfile:
+            # no chunking or compression, so the arrays can be memory-mapped
+            calfile.create_dataset('frequency_response', data=np.asarray(fresponse, dtype=float))
+            calfile.create_dataset('frequencies', data=np.asarray(frequencies, dtype=float))
+            kernels = calfile.create_group('kernels')
+            for fs in samplerates:
+                kernels.create_dataset(str(int(fs)), data=impulse_response(fs, fresponse, frequencies, frange, filter_len))
+            calfile.attrs['frange'] = [float(f) for f in frange]
+            calfile.attrs['calibration_frequency'] = json.dumps(calf)
+            calfile.attrs['filter_len'] = filter_len
+            calfile.attrs['source'] = json.dumps(source)
+        if sys.platform.startswith('win') and os.path.exists(filename):
+            # can't rename over a file on windows; this fails, leaving it
+            # as it is, if it is memory-mapped
+            os.remove(filename)
+        os.rename(tmpname, filename)
+    except:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+class CalibrationFile(object):
+    """A calibration saved with :func:`save_calibration`, with its arrays
+    memory-mapped, read only, from the file
+
+    :param filename: Name of the file to open
+    :type filename: str
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with h5py.File(filename, 'r') as calfile:
+            #: frequency response of the system (in dB)
+            self.fresponse = _memmap(filename, calfile['frequency_response'])
+            #: corresponding frequencies for the frequency response
+            self.frequencies = _memmap(filename, calfile['frequencies'])
+            #: filter kernels, by samplerate
+            self.kernels = dict((int(fs), _memmap(filename, kernel))
+                                for fs, kernel in calfile['kernels'].items())
+            self.frange = tuple(calfile.attrs['frange'])
+            self.calf = json.loads(calfile.attrs['calibration_frequency'])
+            self.filter_len = int(calfile.attrs['filter_len'])
+            self.source = json.loads(calfile.attrs['source'])
+
+    def add_kernels(self, kernel_cache, frange=None):
+        """Puts the filter kernels in *kernel_cache*, so they are used
+        instead of being worked out again. Kernels are only for the saved
+        frequency range, so nothing is added for a different *frange*
+
+        :param kernel_cache: The cache to add to e.g. the one of :class:`StimulusModel<sparkle.stim.stimulus_model.StimulusModel>`
+        :type kernel_cache: :class:`KernelCache<sparkle.stim.kernel_cache.KernelCache>`
+        :param frange: Frequency range the calibration is to be applied to, default is the saved one
+        :type frange: (int, int)
+        """
+        if frange is not None and tuple(float(f) for f in frange) != self.frange:
+            return
+        for fs, kernel in self.kernels.items():
+            kernel_cache.add(fs, self.fresponse, self.frequencies, self.frange,
+                             kernel, self.filter_len)
+
+def _memmap(filename, dataset):
+    """Maps the contents of an h5py *dataset*, of file *filename*, into
+    memory, or reads it in, if it is not stored in one contiguous block"""
+    offset = dataset.id.get_offset()
+    if offset is None or dataset.chunks is not None or dataset.compression is not None:
+        return dataset[...]
+    # a plain array, so copies of it are plain arrays too
+    return np.memmap(filename, dtype=dataset.dtype, mode='r', offset=offset,
+                     shape=dataset.shape).view(np.ndarray)
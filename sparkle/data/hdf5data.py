@@ -3,23 +3,38 @@ import glob
 import json
 import logging
 import os
+import re
 import socket
+import threading
 import time
 
 import h5py
 import numpy as np
 
 from sparkle.data.acqdata import AcquisitionData, increment
+from sparkle.tools.cache import content_key
 from sparkle.tools.exceptions import DataIndexError, DisallowedFilemodeError, \
     OverwriteFileError, ReadOnlyError
+from sparkle.tools.spikestats import batch_spike_indices
+from sparkle.tools.systools import get_free_mb
+from sparkle.tools.timing import monotonic
 from sparkle.tools.util import convert2native, max_str_num, create_unique_path
 from sparkle.tools.doc_inherit import doc_inherit
 
+INT16_MAX = np.iinfo(np.int16).max
+# group that saved spike indices are kept under, see HDF5Data.build_spike_index
+SPIKES_GROUP = '.spikes'
+
 class HDF5Data(AcquisitionData):
     def __init__(self, filename, user='unknown', filemode='w-'):
         super(HDF5Data, self).__init__(filename, user, filemode)
 
         logger = logging.getLogger('main')
+        # changes made since the last backup, see :meth:`backup`
+        self.changes = ChangeLog()
+        # finite data not yet written to file, see :meth:`flush`
+        self._trace_buffer = None
+        self._buffer_lock = threading.RLock()
         try:
             # reload backup files, if present -- it means the program crashed
             # If the data file is corrupted it may still load, but the previously
@@ -29,6 +44,10 @@ class HDF5Data(AcquisitionData):
                 # reassemble data from pieces
                 self.hdf5 = recover_data_from_backup(filename, prev_backups)
                 logger.info('Recovered data file %s' % filename)
+                if filemode != 'r':
+                    # the recovered file now holds everything in the backups
+                    for prevf in prev_backups:
+                        os.remove(prevf)
             else:
                 self.hdf5 = h5py.File(filename, filemode)
         except:
@@ -56,8 +75,11 @@ class HDF5Data(AcquisitionData):
             logger.info('Opened data file %s' % filename)
 
         if filemode != 'r':
-            # immediately make a backup, even if no data data (save attributes)
-            copy_backup(self.hdf5)
+            # immediately make a backup, even if no data data (save attributes).
+            # This first one is a full copy of the file, so data from earlier
+            # sessions can be recovered too; after it, only changes are saved
+            self.changes.touch_all(self.hdf5)
+            self.backup()
 
     @doc_inherit
     def close(self):
@@ -66,6 +88,7 @@ class HDF5Data(AcquisitionData):
             return
 
         fname = self.hdf5.filename
+        self.flush()
 
         # if there was no data saved, just remove the file
         if len(self.hdf5.keys()) == 0:
@@ -81,8 +104,14 @@ class HDF5Data(AcquisitionData):
         if remove:
             os.remove(fname)
         else:
-            if self.needs_repack:
-                _repack(fname)
+            if self.needs_repack and self.freed_space >= self.repack_threshold:
+                try:
+                    repack(fname, _log_repack_progress)
+                except (IOError, OSError):
+                    # the original file is left as it was
+                    logger.exception('Unable to repack data file %s' % fname)
+            elif self.needs_repack:
+                logger.debug('Skipped repack of %s, %d bytes freed' % (fname, self.freed_space))
 
         # now that data is closed and safe, clean up backupfile
         remove_backup(fname)
@@ -94,6 +123,7 @@ class HDF5Data(AcquisitionData):
             raise ReadOnlyError(self.filename)
         # self.groups[key] = self.hdf5.create_group(key)
         self.hdf5.create_group(key)
+        self.changes.touch(key)
         self.meta[key] = {'mode': mode}
         if mode == 'calibration':
             self.set_metadata(key, {'start': time.strftime('%H:%M:%S'), 
@@ -106,25 +136,33 @@ class HDF5Data(AcquisitionData):
     def init_data(self, key, dims=None, mode='finite', nested_name=None):
         if self.hdf5.mode == 'r':
             raise ReadOnlyError(self.filename)
+        self.flush()
         if mode == 'calibration':
             if nested_name is None:
                 nested_name = 'signal'
             setname = nested_name
             setpath ='/'.join([key, setname])
-            self.hdf5[key].create_dataset(setname, dims)
+            if nested_name in ['signal', 'reference_tone']:
+                self.datasets[setpath] = self._create_trace_set(self.hdf5[key], setname, dims)
+            else:
+                self.datasets[setpath] = self.hdf5[key].create_dataset(setname, dims)
+            self.changes.touch(setpath)
             self.meta[nested_name] = {'cursor':[0]*len(dims)}
-            if nested_name == 'signal' or 'reference_tone':
-                self.set_metadata(setpath, {'stim': '[]'})
+            if nested_name in ['signal', 'reference_tone']:
+                _init_trace_info(self.hdf5, setpath)
+                self.changes.touch(_trace_info_key(setpath))
         elif mode == 'finite':
             self.test_count +=1
             setname = 'test_'+str(self.test_count)
             setpath ='/'.join([key, setname])
             if not key in self.hdf5:
                 self.init_group(key)
-            self.hdf5[key].create_dataset(setname, dims)
+            self.datasets[setpath] = self._create_trace_set(self.hdf5[key], setname, dims)
             self.meta[setname] = {'cursor':[0]*len(dims)}
             self.set_metadata(setpath, {'start': time.strftime('%H:%M:%S'), 
-                              'mode':mode, 'stim': '[]'})
+                              'mode':mode})
+            _init_trace_info(self.hdf5, setpath)
+            self.changes.touch(_trace_info_key(setpath))
         elif mode == 'open':
             if len(dims) > 1:
                 print "open acquisition only for single dimension data"
@@ -134,25 +172,48 @@ class HDF5Data(AcquisitionData):
             self.meta[key] = {'mode':mode, 'cursor':0}
             setpath = key
             self.set_metadata(setpath, {'start': time.strftime('%H:%M:%S'), 
-                              'mode':mode, 'stim': '[]'})
+                              'mode':mode})
+            _init_trace_info(self.hdf5, setpath)
+            self.changes.touch(_trace_info_key(setpath))
         elif mode == 'continuous':
             self.datasets[key+'_set1'] = self.hdf5.create_dataset(key+'_set1', (self.chunk_size,))
-            self.datasets[key+'_set1'].attrs['stim'] = ''
+            _init_trace_info(self.hdf5, key+'_set1')
+            self.changes.touch(key+'_set1')
+            self.changes.touch(_trace_info_key(key+'_set1'))
             self.meta[key] = {'mode':mode, 'set_counter':1, 'cursor':0, 'start': time.strftime('%H:%M:%S')}
             # create a dataset for the key itself, so to allow setting attributes, 
             # that will get copied after consolidation
             setname = key
             self.hdf5.create_dataset(key, (1,))
+            self.changes.touch(key)
         else:
             raise Exception("Unknown acquisition mode")
         
         logger = logging.getLogger('main')
         logger.info('Created data set %s' % setname)
 
+    def _create_trace_set(self, group, setname, dims):
+        layout = {'dtype': self.layout['dtype']}
+        if self.layout['chunked']:
+            # by default, a chunk for each trace, rep and channel recording
+            chunks = self.layout['chunks'] or (dims[-1],)
+            chunks = ((1,)*len(dims) + chunks)[-len(dims):]
+            layout['chunks'] = tuple(max(1, min(int(size), int(dim))) for size, dim in zip(chunks, dims))
+            layout['shuffle'] = self.layout['shuffle']
+            if self.layout['compression'] is not None:
+                layout['compression'] = self.layout['compression']
+                if self.layout['compression_opts'] is not None:
+                    layout['compression_opts'] = self.layout['compression_opts']
+        dataset = group.create_dataset(setname, dims, **layout)
+        if self.layout['dtype'] == 'int16':
+            dataset.attrs['sample_scale'] = float(self.layout['full_scale'])/INT16_MAX
+        return dataset
+
     @doc_inherit
     def append(self, key, data, nested_name=None):
         if self.hdf5.mode == 'r':
             raise ReadOnlyError(self.filename)
+        start = monotonic()
         # make sure data is numpy array
         data = np.array(data)
         mode = self.meta[key]['mode']
@@ -163,20 +224,33 @@ class HDF5Data(AcquisitionData):
                 setname = nested_name
             else:
                 setname = 'signal'
+            setpath = key + '/' + setname
+            dataset = self.datasets.get(setpath)
+            if dataset is None:
+                dataset = self.datasets[setpath] = self.hdf5[setpath]
             current_location = self.meta[setname]['cursor']
             if data.shape == (1,):
                 index = current_location
             else:
                 index = current_location[:-len(data.shape)]
-            # if data does crosses dimensions of datastructure, raise error
-            # turn the index into a tuple so not to trigger advanced indexing
-            self.hdf5[key][setname][tuple(index)] = data[:]
-            dims = self.hdf5[key][setname].shape
-            increment(current_location, dims, data.shape)
+            if len(index) > 0 and data.shape == dataset.shape[len(index):]:
+                # gather up a whole trace before writing
+                self._buffered_write(dataset, index, data)
+            else:
+                self.flush()
+                # if data does crosses dimensions of datastructure, raise error
+                # turn the index into a tuple so not to trigger advanced indexing
+                dataset[tuple(index)] = encode_samples(dataset, data)
+            if len(index) > 0:
+                self.changes.touch(key + '/' + setname, index[0], index[0]+1)
+            else:
+                self.changes.touch(key + '/' + setname, 0, data.shape[0])
+            increment(current_location, dataset.shape, data.shape)
 
         elif mode =='open':
             current_index = self.meta[key]['cursor']
             self.hdf5[key][current_index] = data
+            self.changes.touch(key, current_index, current_index+1)
             current_index += 1
             if current_index == self.hdf5[key].shape[0]:
                 self.hdf5[key].resize(current_index+self.open_set_size, axis=0)
@@ -188,11 +262,13 @@ class HDF5Data(AcquisitionData):
             end_index = current_index + data.size
             if end_index < self.chunk_size:
                 self.datasets[key+'_set'+str(setnum)][current_index:end_index] = data
+                self.changes.touch(key+'_set'+str(setnum), current_index, end_index)
             else:
                 nleft = self.chunk_size - current_index
                 if nleft > 0:
                 # fill the rest of this data set
                     self.datasets[key+'_set'+str(setnum)][current_index:] = data[:nleft]
+                    self.changes.touch(key+'_set'+str(setnum), current_index, self.chunk_size)
 
                 print 'starting new set'
                 setnum +=1
@@ -200,11 +276,16 @@ class HDF5Data(AcquisitionData):
                 end_index = data[nleft:].size
                 self.datasets[key+'_set'+str(setnum)] = self.hdf5.create_dataset(key+'_set'+str(setnum), (self.chunk_size,))
                 self.datasets[key+'_set'+str(setnum)][current_index:end_index] = data[nleft:]
-                self.datasets[key+'_set'+str(setnum)].attrs['stim'] = ''
+                _init_trace_info(self.hdf5, key+'_set'+str(setnum))
+                self.changes.touch(key+'_set'+str(setnum), current_index, end_index)
+                self.changes.touch(_trace_info_key(key+'_set'+str(setnum)))
 
             self.meta[key]['set_counter'] = setnum
             self.meta[key]['cursor'] = end_index
 
+        if self.timing is not None:
+            self.timing.record('save', monotonic() - start)
+
     @doc_inherit
     def insert(self, key, index, data):
         if self.hdf5.mode == 'r':
@@ -212,24 +293,56 @@ class HDF5Data(AcquisitionData):
         mode = self.meta[key]['mode']
         if mode == 'finite':
             setname = 'test_'+str(self.test_count)
+            self.flush()
             # turn the index into a tuple so not to trigger advanced indexing
             index = tuple(index)
-            self.hdf5[key][setname][index] = data[:]
+            dataset = self.hdf5[key][setname]
+            dataset[index] = encode_samples(dataset, data)
+            self.changes.touch(key + '/' + setname, index[0], index[0]+1)
         else:
             print "insert not supported for mode: ", mode
 
-    def backup(self, key):
-        backup(self.hdf5, key)
+    def backup(self, key=None):
+        """Saves everything written to the file since the last backup,
+        so that it may be recovered if the program crashes before the file 
+        is closed. Each backup is a new file in the *.backup* folder, 
+        holding only the changed rows and attributes, apart from the first,
+        made when the file is opened, which holds all of it.
+
+        :param key: Not used, all changes are saved regardless of group
+        :type key: str
+        """
+        self.flush()
+        self.changes.save(self.hdf5)
+
+    @doc_inherit
+    def flush(self):
+        with self._buffer_lock:
+            if self._trace_buffer is not None:
+                self._trace_buffer.flush()
+
+    def _buffered_write(self, dataset, index, data):
+        with self._buffer_lock:
+            if index[0] >= dataset.shape[0]:
+                raise ValueError("Index ({}) out of range (0-{})".format(index[0], dataset.shape[0]-1))
+            if self._trace_buffer is None or self._trace_buffer.dataset != dataset:
+                self.flush()
+                self._trace_buffer = TraceBuffer(dataset)
+            self._trace_buffer.add(index, encode_samples(dataset, data))
 
     @doc_inherit
     def get_data(self, key, index=None):
-        if not hasattr(self.hdf5[key], 'shape'):
+        self.flush()
+        dataset = self.hdf5[key]
+        if not hasattr(dataset, 'shape'):
             return None
         elif index is not None:
             index = tuple(index)
-            data = self.hdf5[key][index]
+            data = dataset[index]
         else:
-            data = self.hdf5[key][:]
+            data = dataset[:]
+        if 'sample_scale' in dataset.attrs:
+            data = data*dataset.attrs['sample_scale']
         return data
 
     @doc_inherit
@@ -245,17 +358,17 @@ class HDF5Data(AcquisitionData):
                 return attrs
 
     @doc_inherit
-    def get_trace_stim(self, key):
-        if key in self.hdf5 and 'stim' in self.hdf5[key].attrs:
-            return json.loads(self.hdf5[key].attrs['stim'])
+    def get_trace_stim(self, key, index=None):
+        if key in self.hdf5 and hasattr(self.hdf5[key], 'shape'):
+            return read_trace_stim(self.hdf5[key], index)
         else:
             return None
 
     @doc_inherit
     def get_calibration(self, key, reffreq):
         cal_vector = self.hdf5[key]['calibration_intensities'].value
-        stim_info = json.loads(self.hdf5[key+'/signal'].attrs['stim'])
-        fs = stim_info[0]['samplerate_da']
+        stim_info = self.get_trace_stim(key+'/signal', 0)
+        fs = stim_info['samplerate_da']
         npts = len(cal_vector)
         frequencies = np.arange(npts)/(float((npts-1)*2)/fs)
         if reffreq in frequencies:
@@ -275,6 +388,116 @@ class HDF5Data(AcquisitionData):
                 cal_names.append(grpky)
         return cal_names
 
+    def build_spike_index(self, key, threshold, absval=True, polarity=1, refract=0.002):
+        """Detects the spikes in recorded tests, and saves their sample 
+        indices in the file, tagged with the detection parameters, so that
+        they can be looked up with :meth:`get_spikes` and :meth:`get_spike_counts`,
+        instead of being detected again. Spikes are kept in a hidden 
+        ``.spikes`` group, under the same path as the test data.
+
+        :param key: Test data set to find spikes in, or a group to find spikes for all of its tests. '' for every test in the file.
+        :type key: str
+        :param threshold: Threshold value to determine spikes, one value, or one for each channel
+        :type threshold: float or list
+        :param absval: Whether to apply absolute value to the signal before thresholding, one value, or one for each channel
+        :type absval: bool or list
+        :param polarity: Multiplies the signal (1 or -1) before thresholding, one value, or one for each channel
+        :type polarity: int or list
+        :param refract: Refractory period in seconds
+        :type refract: float
+        :returns: list<str> -- names of the tests indexed
+        """
+        if self.hdf5.mode == 'r':
+            raise ReadOnlyError(self.filename)
+        self.flush()
+        if key in self.hdf5 and hasattr(self.hdf5[key], 'shape'):
+            setnames = [key.strip('/')]
+        else:
+            prefix = key.strip('/') + '/' if key.strip('/') else ''
+            setnames = [name for name in self.dataset_names() if name.startswith(prefix)
+                        and re.match(r'test_\d+$', name.rpartition('/')[-1])]
+
+        for setname in setnames:
+            dataset = self.hdf5[setname]
+            params = _spike_params(dataset, threshold, absval, polarity, refract)
+            fs = self.get_info(setname, inherited=True)['samplerate_ad']
+            offsets = [np.zeros(1, dtype=int)]
+            indices = [np.zeros(0, dtype=int)]
+            nspikes = 0
+            # a trace at a time, so that a whole test is not read at once
+            for itrace in range(dataset.shape[0]):
+                tracedata = self.get_data(setname, (itrace,))
+                if np.any(params['polarity'] != 1):
+                    tracedata = tracedata*params['polarity'][:,np.newaxis]
+                trace_offsets, trace_indices = batch_spike_indices(tracedata, 
+                    params['threshold'], fs, params['absval'], refract)
+                offsets.append(trace_offsets[1:] + nspikes)
+                indices.append(trace_indices)
+                nspikes += len(trace_indices)
+
+            index_key = _spike_index_key(setname, params)
+            if index_key in self.hdf5:
+                del self.hdf5[index_key]
+            group = self.hdf5.create_group(index_key)
+            group.create_dataset('offsets', data=np.concatenate(offsets))
+            group.create_dataset('indices', data=np.concatenate(indices).astype(np.int32))
+            for name, value in params.items():
+                group.attrs[name] = value
+            group.attrs['samplerate_ad'] = fs
+            group.attrs['shape'] = dataset.shape[:-1]
+
+        logger = logging.getLogger('main')
+        logger.info('Saved spikes for %d tests in %s' % (len(setnames), self.filename))
+        return setnames
+
+    def get_spikes(self, key, threshold, absval=True, polarity=1, refract=0.002, index=None):
+        """Gets the spikes saved by :meth:`build_spike_index` for a test. 
+        Takes the same detection parameters, which must match those the 
+        spikes were saved with.
+
+        :param key: Test data set to get the spikes of
+        :type key: str
+        :param index: The trace, or (trace, rep), or (trace, rep, channel) to get the spikes of. ``None`` gets all.
+        :type index: int or tuple
+        :returns: (numpy.ndarray, numpy.ndarray) -- offsets and spike sample indices, as from :func:`batch_spike_indices<sparkle.tools.spikestats.batch_spike_indices>`, for the recordings in *index*. None if spikes have not been saved for these parameters
+        """
+        group = self._spike_index(key, threshold, absval, polarity, refract)
+        if group is None:
+            return None
+        if index is None:
+            return group['offsets'][:], group['indices'][:]
+        if not isinstance(index, tuple):
+            index = (index,)
+        shape = tuple(group.attrs['shape'])
+        first = np.ravel_multi_index(index + (0,)*(len(shape) - len(index)), shape)
+        nrecordings = int(np.prod(shape[len(index):]))
+        offsets = group['offsets'][first:first+nrecordings+1]
+        indices = group['indices'][offsets[0]:offsets[-1]]
+        return offsets - offsets[0], indices
+
+    def get_spike_counts(self, key, threshold, absval=True, polarity=1, refract=0.002):
+        """Gets the number of spikes in each recording of a test, from the 
+        spikes saved by :meth:`build_spike_index`, without reading them.
+        Takes the same detection parameters, which must match those the 
+        spikes were saved with.
+
+        :param key: Test data set to get the spike counts of
+        :type key: str
+        :returns: numpy.ndarray -- spike counts of dimensions (trace, rep, channel), or None if spikes have not been saved for these parameters
+        """
+        group = self._spike_index(key, threshold, absval, polarity, refract)
+        if group is None:
+            return None
+        return np.diff(group['offsets'][:]).reshape(tuple(group.attrs['shape']))
+
+    def _spike_index(self, key, threshold, absval, polarity, refract):
+        self.flush()
+        params = _spike_params(self.hdf5[key], threshold, absval, polarity, refract)
+        index_key = _spike_index_key(key, params)
+        if index_key in self.hdf5:
+            return self.hdf5[index_key]
+        return None
+
     def trim(self, key):
         """
         Removes empty rows from dataset... I am still wanting to use this???
@@ -284,6 +507,7 @@ class HDF5Data(AcquisitionData):
         """
         current_index = self.meta[key]['cursor']
         self.hdf5[key].resize(current_index, axis=0)
+        self.changes.touch(key)
 
     def consolidate(self, key):
         """
@@ -300,49 +524,67 @@ class HDF5Data(AcquisitionData):
 
         # get a copy of the attributes saved, then delete placeholder
         attr_tmp = self.hdf5[key].attrs.items()
+        self.freed_space += storage_size(self.hdf5[key])
         del self.hdf5[key]
+        self.changes.delete(key)
 
         setnum = self.meta[key]['set_counter']
         setnum -= 1 # convert from 1-indexed to 0-indexed
         current_index = self.meta[key]['cursor']
         total_samples = (self.chunk_size * setnum) + current_index
         self.datasets[key] = self.hdf5.create_dataset(key, (total_samples,))
-        self.datasets[key].attrs['stim'] = '[ ' # space in case empty, closing replaces the space and not the [
         self.datasets[key].attrs['start'] = self.meta[key]['start']
         self.datasets[key].attrs['mode'] = 'continuous'
 
         for iset in range(0, setnum):
             self.datasets[key][iset*self.chunk_size:(iset+1)*self.chunk_size] = self.datasets[key+'_set'+str(iset+1)][:]
-            self.datasets[key].attrs['stim'] = self.datasets[key].attrs['stim'] + self.datasets[key+'_set'+str(iset+1)].attrs['stim']
         
         # last set may not be complete
         if current_index != 0:
             self.datasets[key][setnum*self.chunk_size:(setnum*self.chunk_size)+current_index] = self.datasets[key+'_set'+str(setnum+1)][:current_index]
-            self.datasets[key].attrs['stim'] = self.datasets[key].attrs['stim'] + self.datasets[key+'_set'+str(setnum+1)].attrs['stim']
 
-        # make sure we have a closing bracket
-        if self.datasets[key].attrs['stim'][-1] != ']':
-            self.datasets[key].attrs['stim'] = self.datasets[key].attrs['stim'] + ']'
+        # join the trace info of every set into a single journal
+        stims = []
+        for iset in range(setnum+1):
+            stims.extend(self.hdf5[_trace_info_key(key+'_set'+str(iset+1))][:])
+        _init_trace_info(self.hdf5, key)
+        _extend_trace_info(self.hdf5, key, stims)
         
         # copy back attributes from placeholder
         for k, v in attr_tmp:
             self.datasets[key].attrs[k] = v
+        self.changes.touch(key, 0, total_samples)
+        self.changes.touch(_trace_info_key(key), 0, len(stims))
 
         # now go ahead and delete fractional sets.
         for iset in range(setnum+1):
             del self.datasets[key+'_set'+str(iset+1)]
+            self.freed_space += storage_size(self.hdf5[key+'_set'+str(iset+1)])
             del self.hdf5[key+'_set'+str(iset+1)]
+            del self.hdf5[_trace_info_key(key+'_set'+str(iset+1))]
+            self.changes.delete(key+'_set'+str(iset+1))
+            self.changes.delete(_trace_info_key(key+'_set'+str(iset+1)))
 
         print 'consolidated', self.hdf5.keys()
-        print 'stim attr', self.datasets[key].attrs['stim']
-        print
         self.needs_repack = True
 
     @doc_inherit
     def delete_group(self, key):
         if self.hdf5.mode == 'r':
             raise ReadOnlyError(self.filename)
+        self.flush()
+        self._trace_buffer = None
+        for setpath in self.datasets.keys():
+            if setpath == key or setpath.startswith(key + '/'):
+                del self.datasets[setpath]
+        self.freed_space += storage_size(self.hdf5[key])
         del self.hdf5[key]
+        self.changes.delete(key)
+        # saved spikes of the deleted data
+        spikes_key = SPIKES_GROUP + '/' + key.strip('/')
+        if spikes_key in self.hdf5:
+            self.freed_space += storage_size(self.hdf5[spikes_key])
+            del self.hdf5[spikes_key]
         self.needs_repack = True
 
         logger = logging.getLogger('main')
@@ -357,6 +599,7 @@ class HDF5Data(AcquisitionData):
         if key == '':
              for attr, val in attrdict.iteritems():
                 self.hdf5.attrs[attr] = val
+             self.changes.touch('/')
         else:
             for attr, val in attrdict.iteritems():
                 if val is None:
@@ -368,11 +611,13 @@ class HDF5Data(AcquisitionData):
                     elif mode == 'calibration':
                         setname = key + '/signal'
                     self.hdf5[setname].attrs[attr] = val
+                    self.changes.touch(setname)
                 else:
                     self.hdf5[key].attrs[attr] = val
+                    self.changes.touch(key)
 
     @doc_inherit
-    def append_trace_info(self, key, stim_data):
+    def append_trace_info(self, key, stim_data, nested_name=None):
         if self.hdf5.mode == 'r':
             raise ReadOnlyError(self.filename)
         # append data to json list?
@@ -380,27 +625,28 @@ class HDF5Data(AcquisitionData):
             stim_data = json.dumps(convert2native(stim_data))
         mode = self.meta[key]['mode']
         if mode == 'open':
-            _append_stim(self.hdf5, key, stim_data)
-        if mode == 'finite':
+            setname = key
+        elif mode == 'finite':
             setname = key + '/' + 'test_'+str(self.test_count)
-            _append_stim(self.hdf5, setname, stim_data)
         elif mode =='continuous':
             setnum = self.meta[key]['set_counter']
             setname = key+'_set'+str(setnum)
-            _append_stim(self.hdf5, setname, stim_data)
         elif mode == 'calibration':
-            if 'Pure Tone' in stim_data:
+            if nested_name is not None:
+                setname = key + '/' + nested_name
+            elif 'Pure Tone' in stim_data:
                 setname =  key + '/' + 'reference_tone'
             else:
                 setname = key + '/' + 'signal'
-            _append_stim(self.hdf5, setname, stim_data)
+        start, stop = _extend_trace_info(self.hdf5, setname, [stim_data])
+        self.changes.touch(_trace_info_key(setname), start, stop)
 
     @doc_inherit
     def keys(self, key=None):
         if key is None or key == self.filename or key == '':
-            return self.hdf5.keys()
+            return [k for k in self.hdf5.keys() if not _is_hidden(k)]
         elif key in self.hdf5 and hasattr(self.hdf5[key], 'keys'):
-            return self.hdf5[key].keys()
+            return [k for k in self.hdf5[key].keys() if not _is_hidden(k)]
         else:
             return None
 
@@ -421,11 +667,11 @@ class HDF5Data(AcquisitionData):
         return self._dset_names
 
     def _gather_datasets(self, name, item):
-        if hasattr(item, 'shape'):
+        if hasattr(item, 'shape') and not _is_hidden(name):
             self._dsets.append(item)
 
     def _gather_names(self, name, item):
-        if hasattr(item, 'shape'):
+        if hasattr(item, 'shape') and not _is_hidden(name):
             self._dset_names.append(name)
 
     def _repr_html_(self):
@@ -436,6 +682,8 @@ class HDF5Data(AcquisitionData):
         return self._printstr
 
     def _report_item(self, name, item):
+        if _is_hidden(name):
+            return
         self._printstr += name
         if hasattr(item, 'shape'):
             self._printstr += ' ' + str(item.shape)
@@ -447,30 +695,6 @@ def hasparent(key):
         path.remove('')
     return len(path) > 1
 
-def copy_backup(h5file):
-    # assemble backup file filename
-    backup_dir, backup_filename, prev_backups = autosave_filenames(h5file.filename)
-    logger = logging.getLogger('main')
-    logger.debug('Backing up data: %s' % backup_filename)
-    
-    # open a new hdf5 file for backup
-    backup_file = h5py.File(backup_filename, 'w')
-
-    # copy the contents of main data file to the backup
-    for group in h5file.keys():
-        h5file.copy(group, backup_file)
-    # copy the file attributes
-    for attr in h5file.attrs:
-        backup_file.attrs[attr] = h5file.attrs[attr]
-
-    # importantly, close the file, so it is safe from corruption
-    backup_file.close()
-    
-    logger.debug('Backup safe %s' % backup_filename)        
-    #  whole file is backed up, so delete any previous backups to free up space
-    for prevf in prev_backups:
-        os.remove(prevf)
-
 def autosave_filenames(data_file_name):
     parent_dir, filename = os.path.split(data_file_name)
     backup_dir = os.path.join(parent_dir, '.backup')
@@ -480,7 +704,12 @@ def autosave_filenames(data_file_name):
     backup_filename = create_unique_path(os.path.join(backup_dir, basefname + '_autosave'), ext)
     
     if not os.path.exists(backup_dir):
-        os.mkdir(backup_dir)
+        try:
+            os.mkdir(backup_dir)
+        except OSError:
+            # another process opening a file in the same folder got there first
+            if not os.path.isdir(backup_dir):
+                raise
         if os.name == 'nt':
             # mark as hidden in windows
             FILE_ATTRIBUTE_HIDDEN = 0x02
@@ -489,23 +718,6 @@ def autosave_filenames(data_file_name):
 
     return backup_dir, backup_filename, prev_backup_files  
 
-def backup(from_h5file, dataset_key):
-    backup_dir, backup_filename, prevs = autosave_filenames(from_h5file.filename)
-    logger = logging.getLogger('main')
-    logger.debug('Backing up data: %s, data set: %s' % (backup_filename, dataset_key))
-    backup_file = h5py.File(backup_filename, 'w')
-    from_h5file.copy(dataset_key, backup_file, dataset_key)
-    
-    # copy over any group attrs
-    dataset_path = dataset_key.split('/')
-    current_path = ''
-    for parent in dataset_path[:-1]:
-        current_path += '/' + parent
-        for attr in from_h5file[current_path].attrs:
-            backup_file[current_path].attrs[attr] = from_h5file[current_path].attrs[attr]
-    
-    backup_file.close()
-
 def remove_backup(filename):
     backup_dir, xx, backup_files = autosave_filenames(filename)
 
@@ -516,114 +728,481 @@ def remove_backup(filename):
     logger.debug('Removed backup data files: %d' % len(backup_files))
 
     if os.path.exists(backup_dir) and not os.listdir(backup_dir):
-        os.rmdir(backup_dir)
+        try:
+            os.rmdir(backup_dir)
+        except OSError:
+            # in use by another process, or already removed by one
+            pass
 
 def recover_data_from_backup(filename, backup_files):
+    """Rebuilds a data file that was not closed properly. Whatever can 
+    still be read from the data file is kept, then the changes saved in 
+    *backup_files* are replayed on top of it, in the order they were saved.
+    The original file is renamed with a *_compromised* suffix.
+
+    :param filename: path of the data file to recover
+    :type filename: str
+    :param backup_files: paths of the backup files, see :func:`autosave_filenames`
+    :type backup_files: list<str>
+    :returns: h5py.File -- the recovered file, opened for appending
+    """
+    logger = logging.getLogger('main')
     new_data = h5py.File(filename+'tmp', 'w-')
-    for backup_fname in backup_files:
+    if os.path.isfile(filename):
+        try:
+            old_data = h5py.File(filename, 'r')
+        except IOError:
+            logger.warning('Could not open %s, recovering from backups only' % filename)
+        else:
+            for key in old_data.keys():
+                try:
+                    old_data.copy(key, new_data)
+                except Exception:
+                    logger.warning('Could not read %s from %s' % (key, filename))
+            for attr in old_data.attrs:
+                new_data.attrs[attr] = old_data.attrs[attr]
+            old_data.close()
+
+    for backup_fname in sorted(backup_files, key=_autosave_number):
         backup = h5py.File(backup_fname, 'r')
-        for key in backup.keys():
-            # copy with overwrite or ignore existing doesn't exist,
-            # in h5py, so create our own
-            copy_group(backup, new_data, key)            
-
-        # copy file attributes too
-        for attr in backup.attrs:
-            new_data.attrs[attr] = backup.attrs[attr]
+        ChangeLog.replay(backup, new_data)
         backup.close()
 
     # close this file, so we can change the name
     new_data.close()
     # do some filename shuffling
     basefname, ext = os.path.splitext(filename)
-    compromised_fname = create_unique_path(basefname + '_compromised')
-    os.rename(filename, compromised_fname)
+    if os.path.isfile(filename):
+        compromised_fname = create_unique_path(basefname + '_compromised')
+        os.rename(filename, compromised_fname)
     os.rename(filename+'tmp', filename)
 
     new_data = h5py.File(filename, 'a')
     return new_data
 
-def copy_group(from_file, to_file, key):
-    """Recursively copy all groups/datasets/attributes from from_file[key] to
-    to_file. Datasets are not overwritten, attributes are.
+def _autosave_number(backup_filename):
+    basefname = os.path.splitext(backup_filename)[0]
+    return int(re.search('(\d+)$', basefname).group(1))
+
+class ChangeLog(object):
+    """Keeps track of what has been written to a data file, so that only
+    those changes need to be saved to back up the file. Datasets are tracked
+    by the range of rows (along the first dimension) written to; groups by
+    their attributes only.
     """
-    if not key in to_file:
-        from_file.copy(key, to_file, key)
-    else:
-        # also make sure any additional attributes are copied
-        for attr in from_file[key].attrs:
-            to_file.attrs[attr] = from_file[key].attrs[attr]
-            
-        if hasattr(from_file[key], 'keys'):
-            for subkey in from_file[key].keys():
-                copy_group(from_file, to_file, '/'.join([key,subkey]))
-
-def _append_stim(container, key, stim_data):
-    if container[key].attrs['stim'] == '[]':
-         # first addition
-        existing_stim = '['
-    elif container[key].attrs['stim'] == '':
-        existing_stim = ''
-    else:
-        # removing closing bracket and add comma
-        existing_stim = container[key].attrs['stim'][:-1] + ','
-    container[key].attrs['stim'] = existing_stim + stim_data + ']'
+    #: most bytes of a data set read at a time when saving
+    block_size = 2**26
 
+    def __init__(self):
+        # path : [start row, stop row], or None if no data rows have changed
+        self.rows = {}
+        self.deleted = []
 
-def _repack(h5file):
+    def touch(self, key, start=None, stop=None):
+        """Marks the item at *key* as changed
+
+        :param key: path of the group or dataset that has changed
+        :type key: str
+        :param start: first row of dataset data that has changed, if any
+        :type start: int
+        :param stop: row after the last that has changed
+        :type stop: int
+        """
+        key = '/' + key.strip('/')
+        current = self.rows.get(key)
+        if start is None:
+            self.rows[key] = current
+        elif current is None:
+            self.rows[key] = [start, stop]
+        else:
+            self.rows[key] = [min(current[0], start), max(current[1], stop)]
+
+    def touch_all(self, h5file):
+        """Marks everything in *h5file* as changed, so that the next save
+        is a full copy of it
+
+        :param h5file: the file to track changes to
+        :type h5file: h5py.File
+        """
+        self.touch('/')
+        def touch_item(name, item):
+            if SPIKES_GROUP in name.split('/'):
+                # saved spikes are not backed up, they can be found again
+                return
+            elif hasattr(item, 'shape') and item.shape != ():
+                self.touch(name, 0, item.shape[0])
+            else:
+                self.touch(name)
+        h5file.visititems(touch_item)
+
+    def delete(self, key):
+        """Marks the item at *key* as removed"""
+        self.deleted.append('/' + key.strip('/'))
+
+    def save(self, h5file):
+        """Saves the changes since the last save to a new backup file, 
+        next to *h5file*, then starts over tracking changes
+
+        :param h5file: the file the tracked changes were made to
+        :type h5file: h5py.File
+        """
+        backup_dir, backup_filename, prevs = autosave_filenames(h5file.filename)
+        logger = logging.getLogger('main')
+        logger.debug('Backing up data: %s' % backup_filename)
+
+        backup_file = h5py.File(backup_filename, 'w')
+        nrecords = 0
+        for key in self.deleted:
+            record = backup_file.create_group(str(nrecords))
+            record.attrs['path'] = key
+            record.attrs['kind'] = 'deleted'
+            nrecords += 1
+        # sorted, so that parent groups are created before their children
+        for key in sorted(self.rows.keys()):
+            if key not in h5file:
+                # removed since it was changed
+                continue
+            item = h5file[key]
+            record = backup_file.create_group(str(nrecords))
+            record.attrs['path'] = key
+            if hasattr(item, 'shape'):
+                record.attrs['kind'] = 'dataset'
+                record.attrs['shape'] = item.shape
+                record.attrs['maxshape'] = [-1 if dim is None else dim for dim in item.maxshape]
+                if item.chunks is not None:
+                    record.attrs['chunks'] = item.chunks
+                if item.compression is not None:
+                    record.attrs['compression'] = item.compression
+                    if item.compression_opts is not None:
+                        record.attrs['compression_opts'] = item.compression_opts
+                record.attrs['shuffle'] = item.shuffle
+                if item.shape == ():
+                    # scalar, saved whole
+                    record.attrs['start'] = 0
+                    record.create_dataset('rows', data=item[()], dtype=item.dtype)
+                else:
+                    # clip to the current size, in case the data was trimmed
+                    start, stop = self.rows[key] or (0, 0)
+                    stop = min(stop, item.shape[0])
+                    start = min(start, stop)
+                    record.attrs['start'] = start
+                    rows = record.create_dataset('rows', (stop - start,) + item.shape[1:],
+                                                 dtype=item.dtype)
+                    # in blocks, so a full copy of a large data set fits in memory
+                    row_nbytes = max(1, int(np.prod(item.shape[1:]))*item.dtype.itemsize)
+                    block_rows = max(1, self.block_size / row_nbytes)
+                    for block_start in range(start, stop, block_rows):
+                        block_stop = min(block_start + block_rows, stop)
+                        rows[block_start-start:block_stop-start] = item[block_start:block_stop]
+            else:
+                record.attrs['kind'] = 'group'
+            attrs = record.create_group('attrs')
+            for attr, val in item.attrs.items():
+                attrs.attrs[attr] = val
+            nrecords += 1
+        # importantly, close the file, so it is safe from corruption
+        backup_file.close()
+        logger.debug('Backup safe %s' % backup_filename)
+
+        self.rows = {}
+        self.deleted = []
+
+    @staticmethod
+    def replay(backup_file, h5file):
+        """Applies the changes saved in *backup_file* to *h5file*
+
+        :param backup_file: a file saved by :meth:`save`
+        :type backup_file: h5py.File
+        :param h5file: file to apply changes to
+        :type h5file: h5py.File
+        """
+        for irecord in sorted(backup_file.keys(), key=int):
+            record = backup_file[irecord]
+            key = record.attrs['path']
+            kind = record.attrs['kind']
+            if kind == 'deleted':
+                if key in h5file:
+                    del h5file[key]
+                continue
+            elif kind == 'group':
+                item = h5file.require_group(key)
+            else:
+                rows = record['rows']
+                shape = tuple(record.attrs['shape'])
+                if key in h5file and h5file[key].shape != shape:
+                    try:
+                        h5file[key].resize(shape)
+                    except TypeError:
+                        # not resizable, the backup version wins
+                        del h5file[key]
+                if key not in h5file:
+                    maxshape = tuple(None if dim < 0 else dim for dim in record.attrs['maxshape'])
+                    layout = {}
+                    for prop in ['chunks', 'compression', 'compression_opts']:
+                        if prop in record.attrs:
+                            layout[prop] = record.attrs[prop]
+                    if 'chunks' in layout:
+                        layout['chunks'] = tuple(layout['chunks'])
+                        layout['shuffle'] = bool(record.attrs['shuffle'])
+                    parent = key.rpartition('/')[0]
+                    if parent != '':
+                        h5file.require_group(parent)
+                    h5file.create_dataset(key, shape, dtype=rows.dtype,
+                                          maxshape=maxshape, **layout)
+                item = h5file[key]
+                if rows.shape == ():
+                    item[()] = rows[()]
+                elif rows.shape[0] > 0:
+                    start = record.attrs['start']
+                    item[start:start+rows.shape[0]] = rows[:]
+            for attr, val in record['attrs'].attrs.items():
+                item.attrs[attr] = val
+
+class TraceBuffer(object):
+    """Gathers up data appended to a trace (row along the first dimension)
+    of a dataset, to be written to file in one go, once the trace is filled,
+    or :meth:`flush` is called.
+
+    :param dataset: The data set to buffer writes to
+    :type dataset: h5py.Dataset
     """
-    Repack archive to remove freespace.
-               
-    Returns
-    -------
-    file : h5py File or None
-        If the input is a h5py.File then a h5py File instance of the
-        repacked archive is returned. The input File instance will no longer
-        be useable. 
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.shape = dataset.shape[1:]
+        self.data = np.empty((int(np.prod(self.shape)),), dtype=dataset.dtype)
+        self.row = None
+        # range of self.data that has been filled
+        self.start = 0
+        self.stop = 0
+
+    def add(self, index, data):
+        """Puts *data* at *index* of the dataset, writing it to file if this
+        completes the trace
+
+        :param index: location of data in the dataset, the first value is the trace
+        :type index: list
+        :param data: data, already converted to dataset storage
+        :type data: numpy.ndarray
+        """
+        offset = 0
+        if len(index) > 1:
+            # position in the flattened trace
+            offset = np.ravel_multi_index(tuple(index[1:]) + (0,)*(len(self.shape) - len(index) + 1), self.shape)
+        if index[0] != self.row or offset != self.stop:
+            self.flush()
+            self.row = index[0]
+            self.start = offset
+            self.stop = offset
+        self.data[self.stop:self.stop+data.size] = data.ravel()
+        self.stop += data.size
+        if self.start == 0 and self.stop == self.data.size:
+            self.flush()
+
+    def flush(self):
+        """Writes buffered data to the file"""
+        if self.stop == self.start:
+            return
+        if self.start == 0 and self.stop == self.data.size:
+            self.dataset[self.row] = self.data.reshape(self.shape)
+        else:
+            # only part of the trace, keep the rest as it is in the file
+            trace = self.dataset[self.row].ravel()
+            trace[self.start:self.stop] = self.data[self.start:self.stop]
+            self.dataset[self.row] = trace.reshape(self.shape)
+        self.start = self.stop = 0
+        self.row = None
+
+def encode_samples(dataset, data):
+    """Converts *data* to the way it is stored in *dataset*, i.e. for
+    scaled integer storage, to counts of the dataset's *sample_scale*
+    attribute. Out of range values are clipped.
+
+    :param dataset: The data set to be written to
+    :type dataset: h5py.Dataset
+    :param data: samples, in volts
+    :type data: numpy.ndarray
+    :returns: numpy.ndarray -- data ready to write
     """
-    f1, opened = _openfile(h5file) 
-    filename1 = f1.filename
-    filename2 = filename1 + '_repack_tmp'
-    f2 = h5py.File(filename2, 'w')
-    for key in f1.keys():
-        # print 'copying', key
-        f1.copy(key, f2)
-    f1.close()
-    f2.close()
-    filename_tmp = filename1 + '_repack_rename_tmp'
-    os.rename(filename1, filename_tmp)
-    os.rename(filename2, filename1) 
-    if opened:
-        f = None  
+    if 'sample_scale' in dataset.attrs:
+        counts = np.round(np.asarray(data)/dataset.attrs['sample_scale'])
+        return np.clip(counts, -INT16_MAX, INT16_MAX).astype(dataset.dtype)
     else:
-        f = h5py.File(filename1)
-    os.remove(filename_tmp)
-    return f   
+        return data[:]
+
+def read_trace_stim(dataset, index=None):
+    """Gets the stimulus info saved for the traces of an h5py *dataset*
 
-def _openfile(h5file):
+    :param dataset: The data set to get stimulus info for
+    :type dataset: h5py.Dataset
+    :param index: Trace number to get the info of, ``None`` gets all traces
+    :type index: int
+    :returns: list<dict> for all traces, or dict for a single trace, None if there is no info
     """
-    Open an archive if input is a path.
-    
-    Parameters
-    ----------
-    h5file : str or h5py.File
-        Filename or h5py.File instance of the archive.
-        
-    Returns
-    ------- 
-    f : h5py.File
-        Returns a h5py.File instance.
-    opened : bool
-        True is `h5file` is a path; False if `h5file` is a h5py.File object.   
-    
+    trace_info_key = _trace_info_key(dataset.name)
+    if trace_info_key in dataset.file:
+        journal = dataset.file[trace_info_key]
+        if index is None:
+            return [json.loads(stim) for stim in journal[:]]
+        else:
+            return json.loads(journal[index])
+    elif 'stim' in dataset.attrs:
+        # older files keep the whole list as a JSON string attribute
+        stims = json.loads(dataset.attrs['stim'])
+        if index is None:
+            return stims
+        else:
+            return stims[index]
+    else:
+        return None
+
+def _trace_info_key(key):
+    """Name of the trace info journal that sits beside dataset *key*"""
+    parent, sep, name = key.rpartition('/')
+    return parent + sep + '.' + name + '_stim'
+
+def _is_hidden(key):
+    """Whether *key* is bookkeeping, rather than recorded data"""
+    return any(name.startswith('.') for name in key.split('/'))
+
+def _spike_params(dataset, threshold, absval, polarity, refract):
+    """Spike detection parameters, with a value for each channel of *dataset*"""
+    nchans = dataset.shape[2] if len(dataset.shape) == 4 else 1
+    params = {'refract': float(refract)}
+    for name, value, dtype in [('threshold', threshold, float), 
+                               ('absval', absval, bool),
+                               ('polarity', polarity, float)]:
+        params[name] = np.empty((nchans,), dtype=dtype)
+        params[name][:] = value
+    return params
+
+def _spike_index_key(key, params):
+    """Name of the group holding the spikes of data set *key*, found with *params*"""
+    return SPIKES_GROUP + '/' + key.strip('/') + '/' + content_key(dict(params))
+
+def _init_trace_info(container, key):
+    # one JSON document per trace, appended to as traces are recorded
+    container.create_dataset(_trace_info_key(key), (0,), maxshape=(None,),
+                             chunks=(64,), dtype=h5py.special_dtype(vlen=unicode))
+
+def _extend_trace_info(container, key, stims):
+    journal = container[_trace_info_key(key)]
+    ntraces = journal.shape[0]
+    journal.resize((ntraces + len(stims),))
+    journal[ntraces:] = np.array(stims, dtype=object)
+    return ntraces, ntraces + len(stims)
+
+def storage_size(item):
+    """Bytes of file space taken up by the data of *item*, including 
+    everything under it, if it is a group
+
+    :param item: Group or dataset of an open file
+    :type item: h5py.Group or h5py.Dataset
+    :returns: int -- number of bytes
+    """
+    if hasattr(item, 'shape'):
+        return item.id.get_storage_size()
+    sizes = []
+    def gather_size(name, obj):
+        if hasattr(obj, 'shape'):
+            sizes.append(obj.id.get_storage_size())
+    item.visititems(gather_size)
+    return sum(sizes)
+
+def repack(filename, progress=None, buffer_size=2**26):
+    """
+    Rewrites the data file to remove the free space left behind by deleted
+    data. Datasets are copied a block of rows at a time, through a buffer of
+    about *buffer_size* bytes, so memory use does not depend on the size of 
+    the data. Requires free disk space for a copy of the file.
+
+    :param filename: path of the (closed) file to repack
+    :type filename: str
+    :param progress: Function to report progress to, called with bytes copied so far and total bytes, after each block
+    :type progress: function
+    :param buffer_size: maximum number of bytes to read at a time
+    :type buffer_size: int
     """
-    if isinstance(h5file, h5py.File):
-        f = h5file
-        opened = False
-    elif isinstance(h5file, basestring):
-        f = h5py.File(h5file)
-        opened = True
+    free_bytes = get_free_mb(os.path.dirname(os.path.abspath(filename)))*1024*1024
+    if free_bytes < os.path.getsize(filename):
+        raise IOError("Not enough free disk space to repack {}".format(filename))
+
+    tmp_filename = filename + '_repack_tmp'
+    from_file = h5py.File(filename, 'r')
+    to_file = h5py.File(tmp_filename, 'w')
+    try:
+        total = [0]
+        def gather_nbytes(name, obj):
+            if hasattr(obj, 'shape'):
+                total[0] += obj.size*obj.dtype.itemsize
+        from_file.visititems(gather_nbytes)
+
+        copied = [0]
+        def report(nbytes):
+            copied[0] += nbytes
+            if progress is not None:
+                progress(copied[0], total[0])
+
+        _copy_items(from_file, to_file, buffer_size, report)
+    except:
+        from_file.close()
+        to_file.close()
+        os.remove(tmp_filename)
+        raise
+    from_file.close()
+    to_file.close()
+
+    filename_tmp = filename + '_repack_rename_tmp'
+    os.rename(filename, filename_tmp)
+    os.rename(tmp_filename, filename)
+    os.remove(filename_tmp)
+
+def _copy_items(from_group, to_group, buffer_size, report):
+    for attr, val in from_group.attrs.items():
+        to_group.attrs[attr] = val
+    for name, item in from_group.items():
+        if hasattr(item, 'shape'):
+            _copy_dataset(item, to_group, name, buffer_size, report)
+        else:
+            _copy_items(item, to_group.create_group(name), buffer_size, report)
+
+def _copy_dataset(dataset, to_group, name, buffer_size, report):
+    layout = {'maxshape': dataset.maxshape, 'chunks': dataset.chunks,
+              'shuffle': dataset.shuffle, 'fletcher32': dataset.fletcher32}
+    if dataset.compression is not None:
+        layout['compression'] = dataset.compression
+        layout['compression_opts'] = dataset.compression_opts
+    copy = to_group.create_dataset(name, dataset.shape, dtype=dataset.dtype, **layout)
+    for attr, val in dataset.attrs.items():
+        copy.attrs[attr] = val
+
+    if dataset.size == 0:
+        return
+    if len(dataset.shape) == 0:
+        copy[()] = dataset[()]
+        report(dataset.dtype.itemsize)
+        return
+
+    row_nbytes = (dataset.size / dataset.shape[0])*dataset.dtype.itemsize
+    block_rows = max(1, buffer_size / row_nbytes)
+    if dataset.chunks is not None:
+        # read whole chunks at a time
+        block_rows = max(dataset.chunks[0], block_rows - (block_rows % dataset.chunks[0]))
+    block_rows = min(block_rows, dataset.shape[0])
+
+    if h5py.check_dtype(vlen=dataset.dtype) is not None:
+        # variable length data can't be read into a buffer
+        for start in range(0, dataset.shape[0], block_rows):
+            stop = min(start + block_rows, dataset.shape[0])
+            copy[start:stop] = dataset[start:stop]
+            report((stop - start)*row_nbytes)
     else:
-        msg = "h5file must be a h5py.File object or a string (path)."
-        raise TypeError, msg    
-    return f, opened                 
+        buf = np.empty((block_rows,) + dataset.shape[1:], dtype=dataset.dtype)
+        for start in range(0, dataset.shape[0], block_rows):
+            stop = min(start + block_rows, dataset.shape[0])
+            dataset.read_direct(buf, np.s_[start:stop], np.s_[0:stop-start])
+            copy.write_direct(buf, np.s_[0:stop-start], np.s_[start:stop])
+            report((stop - start)*row_nbytes)
+
+def _log_repack_progress(copied, total):
+    logger = logging.getLogger('main')
+    logger.debug('Repacking data: {:.0%}'.format(float(copied)/total))
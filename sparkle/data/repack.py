@@ -0,0 +1,26 @@
+"""Removes the unused space left in sparkle HDF5 data files after data has 
+been deleted from them. Sparkle skips this when closing a file, if only a
+little data was deleted, so that it can be run later instead, e.g.::
+
+    $ python -m sparkle.data.repack mydata.hdf5 moredata.hdf5
+"""
+
+import os
+import sys
+
+from sparkle.data.hdf5data import repack
+
+
+def print_progress(copied, total):
+    sys.stdout.write('\r{:.0%}'.format(float(copied)/total))
+    sys.stdout.flush()
+
+def main():
+    for filename in sys.argv[1:]:
+        size_before = os.path.getsize(filename)
+        print 'repacking', filename
+        repack(filename, print_progress)
+        print '\r{} MB -> {} MB'.format(size_before/2**20, os.path.getsize(filename)/2**20)
+
+if __name__ == '__main__':
+    main()
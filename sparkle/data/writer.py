@@ -0,0 +1,185 @@
+import logging
+import Queue
+import sys
+import threading
+
+import numpy as np
+
+from sparkle.tools.timing import monotonic
+
+
+class DataWriter(object):
+    """Takes over writing to a data file, so that acquisition does not
+    have to wait on the disk. Writes are put in a queue, and carried out,
+    in order, by a dedicated writer thread, which owns the data file.
+
+    Otherwise used the same as the :class:`AcquisitionData<sparkle.data.acqdata.AcquisitionData>`
+    it wraps: Any other method is also carried out by the writer thread,
+    after the writes queued before it, and waits for its result, so it
+    will always see everything written before it, and never runs at the
+    same time as a write. Plain attributes, e.g. *filename*, are read
+    straight away.
+
+    If the queue fills up, the writer is not keeping up, and writes will
+    block until there is room; this is logged, counted in *stalls* and
+    *stall_time*, and reported to *on_backpressure*.
+
+    An error from a queued write is raised on the next call to the writer.
+
+    With :meth:`set_timing`, how long each write waits in the queue is
+    recorded ('queue'), along with how long appends take ('save').
+
+    :param datafile: The opened data file to write to
+    :type datafile: :class:`AcquisitionData<sparkle.data.acqdata.AcquisitionData>`
+    :param maxsize: The most writes that can be waiting in the queue
+    :type maxsize: int
+    :param on_backpressure: Function called, with *maxsize*, whenever a write has to wait for room in the queue
+    :type on_backpressure: callable
+    """
+    # methods of the data file that are carried out by the writer thread
+    queued = ['init_group', 'init_data', 'append', 'insert', 'set_metadata',
+              'append_trace_info', 'backup', 'trim', 'consolidate',
+              'delete_group']
+
+    def __init__(self, datafile, maxsize=256, on_backpressure=None):
+        self.datafile = datafile
+        self.on_backpressure = on_backpressure
+        # number of times, and total seconds, writes had to wait for the queue
+        self.stalls = 0
+        self.stall_time = 0.
+        self.timing = None
+
+        self._queue = Queue.Queue(maxsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in self.queued:
+            def queued_call(*args, **kwargs):
+                self._put((name, args, kwargs))
+            return queued_call
+        attr = getattr(self.datafile, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            return self._call(name, args, kwargs)
+        return call
+
+    def _call(self, name, args, kwargs):
+        # carries out a method on the writer thread, and waits for it
+        result = _Result()
+        self._put((name, args, kwargs), result)
+        result.done.wait()
+        self._raise_error()
+        return result.get()
+
+    def _put(self, item, result=None):
+        self._raise_error()
+        if not self._thread.is_alive():
+            raise IOError("Data writer for {} is closed".format(self.datafile.filename))
+        name, args, kwargs = item
+        if result is None:
+            # the caller is free to reuse its arrays once this returns
+            args = tuple(np.array(arg) if isinstance(arg, np.ndarray) else arg for arg in args)
+        item = (name, args, kwargs, monotonic(), result)
+        try:
+            self._queue.put_nowait(item)
+        except Queue.Full:
+            self.stalls += 1
+            logger = logging.getLogger('main')
+            logger.warning('Data writer queue full, waiting to save data')
+            if self.on_backpressure is not None:
+                self.on_backpressure(self._queue.maxsize)
+            start = monotonic()
+            self._queue.put(item)
+            self.stall_time += monotonic() - start
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            result = None
+            try:
+                if item is None:
+                    return
+                name, args, kwargs, queued, result = item
+                timing = self.timing
+                if timing is not None and result is None:
+                    timing.record('queue', monotonic() - queued)
+                # after an error, later calls are skipped
+                if self._error is None:
+                    value = getattr(self.datafile, name)(*args, **kwargs)
+                    if result is not None:
+                        result.value = value
+            except:
+                if result is not None:
+                    # raised to the caller
+                    result.error = sys.exc_info()
+                else:
+                    logger = logging.getLogger('main')
+                    logger.exception('Error writing to data file')
+                    # keep the first error, it is raised on the next call
+                    self._error = sys.exc_info()
+            finally:
+                if result is not None:
+                    result.done.set()
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error[0], error[1], error[2]
+
+    def set_timing(self, recorder):
+        """Sets where to record how long writes wait in the queue, and
+        appends take, see :meth:`AcquisitionData.set_timing<sparkle.data.acqdata.AcquisitionData.set_timing>`
+
+        :param recorder: the recorder to use, ``None`` to stop recording
+        :type recorder: :class:`TimingRecorder<sparkle.tools.timing.TimingRecorder>`
+        """
+        self._call('set_timing', (recorder,), {})
+        self.timing = recorder
+
+    def pending(self):
+        """Number of writes waiting in the queue
+
+        :returns: int -- the queue size
+        """
+        return self._queue.qsize()
+
+    def join(self):
+        """Waits until all queued writes are done"""
+        self._queue.join()
+        self._raise_error()
+
+    def flush(self):
+        """Waits until all queued writes are done, and written to file
+        (see :meth:`AcquisitionData.flush<sparkle.data.acqdata.AcquisitionData.flush>`)
+        """
+        self._call('flush', (), {})
+
+    def close(self):
+        """Finishes all queued writes, stops the writer thread, and closes
+        the data file"""
+        if self._thread.is_alive():
+            self._queue.join()
+            self._queue.put(None)
+            self._thread.join()
+        self.datafile.close()
+        self._raise_error()
+
+class _Result(object):
+    """The outcome of a call carried out by the writer thread"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def get(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
@@ -162,32 +162,34 @@ class QDataReviewer(QtGui.QWidget):
         for attr in info:
             if attr != 'stim':
                 self.attrtxt.appendPlainText(attr + ' : ' + str(info[attr]))
-            else:
-                # use the datafile object to do json converstion of stim data
-                stimuli = self.datafile.get_trace_stim(path)
-
-                self.tracetable.setRowCount(len(stimuli))
-                for row, stim in enumerate(stimuli):
-                    # print stim
-                    comp_names = [comp['stim_type'] for comp in stim['components'] if comp['stim_type'].lower() != 'silence']
-                    unique = set(comp_names)
-                    if len(unique) == 0:
-                        comp_type = 'None'
-                    elif len(unique) == 1:
-                        comp_type = list(unique)[0]
-                    else:
-                        comp_type = 'Multi'
-                    item =  QtGui.QTableWidgetItem(str(len(comp_names)))
-                    item.setFlags(QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable)
-                    self.tracetable.setItem(row, 0, item)
-                    item =  QtGui.QTableWidgetItem(comp_type)
-                    item.setFlags(QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable)
-                    self.tracetable.setItem(row, 1, item)
-                    item =  QtGui.QTableWidgetItem(str(stim['samplerate_da']))
-                    item.setFlags(QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable)
-                    self.tracetable.setItem(row, 2, item)
-                self.current_test = stimuli
-                self.current_path = path
+
+        # use the datafile object to do json converstion of stim data
+        stimuli = None
+        if path != '':
+            stimuli = self.datafile.get_trace_stim(path)
+        if stimuli is not None:
+            self.tracetable.setRowCount(len(stimuli))
+            for row, stim in enumerate(stimuli):
+                # print stim
+                comp_names = [comp['stim_type'] for comp in stim['components'] if comp['stim_type'].lower() != 'silence']
+                unique = set(comp_names)
+                if len(unique) == 0:
+                    comp_type = 'None'
+                elif len(unique) == 1:
+                    comp_type = list(unique)[0]
+                else:
+                    comp_type = 'Multi'
+                item =  QtGui.QTableWidgetItem(str(len(comp_names)))
+                item.setFlags(QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable)
+                self.tracetable.setItem(row, 0, item)
+                item =  QtGui.QTableWidgetItem(comp_type)
+                item.setFlags(QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable)
+                self.tracetable.setItem(row, 1, item)
+                item =  QtGui.QTableWidgetItem(str(stim['samplerate_da']))
+                item.setFlags(QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable)
+                self.tracetable.setItem(row, 2, item)
+            self.current_test = stimuli
+            self.current_path = path
 
         if path == '':
             return
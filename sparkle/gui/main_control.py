@@ -26,6 +26,7 @@ from sparkle.stim.types.stimuli_classes import Vocalization
 from sparkle.tools import spikestats
 from sparkle.tools.audiotools import audioread, calc_db, calc_spectrum, \
     calc_summed_db, rms, signal_amplitude, sum_db
+from sparkle.tools.cache import LRUCache
 from sparkle.tools.qsignals import ProtocolSignals
 from sparkle.tools.systools import get_src_directory
 from sparkle.tools.uihandler import assign_uihandler_slot
@@ -88,6 +89,10 @@ class MainWindow(ControlWindow):
         else:
             fname = None
 
+        # spike statistics of each rep of reviewed traces, so that browsing
+        # through reps does not analyse the same data over again
+        self.reviewStats = LRUCache(2**24)
+
         super(MainWindow, self).__init__(inputsFilename)
 
         if datafile is not None:
@@ -408,6 +413,7 @@ class MainWindow(ControlWindow):
 
         # add group to review data tree
         self.ui.reviewer.update()
+        self.reviewStats.clear()
 
     def runChart(self):
         winsz, acq_rate = self.onUpdate()
@@ -657,8 +663,13 @@ class MainWindow(ControlWindow):
                 elif 'all traces' in extra_info:
                     self.displayTuningCurve(trace_num, 'all traces', avg_count)
             
-    def do_spike_stats(self, response, fs):
-        winsz = float(response.shape[-1])/fs
+    def psthWindow(self, npoints, fs):
+        """The part of a recording to work out spike statistics for, and
+        the PSTH bins, from the current settings
+
+        :returns: int, int, float, float, int -- start and stop sample of the window, its duration, bin size, and the number of bins before the window
+        """
+        winsz = float(npoints)/fs
 
         # use time subwindow of trace, specified by user
         start_time = self.ui.psthStartField.value()
@@ -673,6 +684,10 @@ class MainWindow(ControlWindow):
         binsz = float(self.ui.binszSpnbx.value())
         # number of bins to shift spike counts by since we are cropping first part of data
         binshift = int(np.ceil(start_time/binsz))
+        return start_index, stop_index, subwinsz, binsz, binshift
+
+    def do_spike_stats(self, response, fs):
+        start_index, stop_index, subwinsz, binsz, binshift = self.psthWindow(response.shape[-1], fs)
 
         count, latency, rate, response_bins = [],[],[],[]
         for chan, name in enumerate(self._aichans):
@@ -691,6 +706,53 @@ class MainWindow(ControlWindow):
 
         return count, latency, rate, response_bins
 
+    def saved_spike_stats(self, offsets, indices, npoints, fs):
+        """Same as :meth:`do_spike_stats`, for a rep, from the spikes saved
+        in the data file for each of its channels, rather than its recording.
+        The latency is that of the first spike in the window. As the saved
+        spikes were found in the whole recording, a spike cut by the edge
+        of the window may count here when it would not from the recording.
+
+        :param offsets: offsets into *indices* of the spikes of each channel, see :meth:`get_spikes<sparkle.data.hdf5data.HDF5Data.get_spikes>`
+        :type offsets: numpy.ndarray
+        :param indices: spike sample indices
+        :type indices: numpy.ndarray
+        :param npoints: number of samples in the recording
+        :type npoints: int
+        """
+        start_index, stop_index, subwinsz, binsz, binshift = self.psthWindow(npoints, fs)
+
+        count, latency, rate, response_bins = [],[],[],[]
+        for chan, name in enumerate(self._aichans):
+            chan_indices = indices[offsets[chan]:offsets[chan+1]]
+            in_window = chan_indices[(chan_indices >= start_index) & (chan_indices < stop_index)]
+            spike_times = (in_window - start_index).astype(float)/fs
+
+            count.append(len(spike_times))
+            latency.append(spike_times[0] if len(spike_times) > 0 else np.nan)
+            rate.append(spikestats.firing_rate(spike_times, subwinsz))
+
+            response_bins.append(spikestats.bin_spikes(spike_times, binsz) + binshift)
+
+        return count, latency, rate, response_bins
+
+    def savedSpikes(self, path, index):
+        """Spikes saved in the data file for the current thresholds, abs
+        settings and polarities, see :meth:`get_spikes<sparkle.data.hdf5data.HDF5Data.get_spikes>`
+
+        :returns: (numpy.ndarray, numpy.ndarray) -- offsets and spike indices, or None if there are none saved
+        """
+        if not hasattr(self.acqmodel.datafile, 'get_spikes'):
+            return None
+        thresholds = [self._aichan_details[chan]['threshold'] for chan in self._aichans]
+        useabs = [self._aichan_details[chan]['abs'] for chan in self._aichans]
+        polarities = [self._aichan_details[chan]['polarity'] for chan in self._aichans]
+        try:
+            return self.acqmodel.datafile.get_spikes(path, thresholds, useabs, polarities, index=index)
+        except ValueError:
+            # different number of channels
+            return None
+
     def spawnTuningCurve(self, frequencies, intensities, plotType):
         self.livecurve = ProgressWidget(intensities, (frequencies[0], frequencies[-1]))
         self.livecurve.setLabels(plotType)
@@ -819,9 +881,7 @@ class MainWindow(ControlWindow):
                 else:
                     self.display.updateSpiketrace(times, response[chan,:], name)
 
-            stimuli = self.acqmodel.datafile.get_trace_stim(path)
-
-            stimulus = stimuli[tracenum]
+            stimulus = self.acqmodel.datafile.get_trace_stim(path, tracenum)
 
             # show the stimulus details
             self.reportProgress(-1, tracenum, stimulus)
@@ -845,16 +905,36 @@ class MainWindow(ControlWindow):
             self.ui.psth.clearData()
             self.display.clearRaster()
 
-            # recreate PSTH for current threshold and current rep
-            tracedata = self.acqmodel.datafile.get_data(path, (tracenum,))
-            if len(tracedata.shape) == 2:
-                # backwards compatibility: reshape old data to have channel dimension
-                tracedata = tracedata.reshape((tracedata.shape[0], 1, tracedata.shape[1]))
-
-            self.display.setNreps(tracedata.shape[0])
+            # recreate PSTH for current threshold and current rep, only
+            # analysing reps that have not been already
+            key = self.reviewStatsKey(path, tracenum, aifs)
+            review = self.reviewStats.get(key)
+            if review is None or len(review['stats']) <= repnum:
+                # from the spikes saved in the file, if there are any for
+                # the current settings, otherwise from the recordings
+                spikes = self.savedSpikes(path, tracenum)
+                if spikes is not None:
+                    offsets, indices = spikes
+                    nreps = (len(offsets) - 1)/nchans
+                    review = {'nreps': nreps, 'npoints': npoints,
+                              'stats': [self.saved_spike_stats(offsets[irep*nchans:(irep+1)*nchans+1], 
+                                                               indices, npoints, aifs)
+                                        for irep in range(nreps)]}
+                else:
+                    tracedata = self.acqmodel.datafile.get_data(path, (tracenum,))
+                    if len(tracedata.shape) == 2:
+                        # backwards compatibility: reshape old data to have channel dimension
+                        tracedata = tracedata.reshape((tracedata.shape[0], 1, tracedata.shape[1]))
+                    if review is None:
+                        review = {'nreps': tracedata.shape[0], 'npoints': tracedata.shape[-1], 'stats': []}
+                    for irep in range(len(review['stats']), repnum+1):
+                        review['stats'].append(self.do_spike_stats(tracedata[irep], aifs))
+                self.reviewStats.put(key, review)
+
+            self.display.setNreps(review['nreps'])
 
             binsz = float(self.ui.binszSpnbx.value())
-            winsz = float(tracedata.shape[-1])/aifs
+            winsz = float(review['npoints'])/aifs
             # set the max of the PSTH subwindow to the size of this data
             self.ui.psthStopField.setMaximum(winsz)
             self.ui.psthStartField.setMaximum(winsz)
@@ -868,7 +948,7 @@ class MainWindow(ControlWindow):
             spike_latencies = []
             spike_rates = []
             for irep in range(repnum+1):
-                count, latency, rate, response_bins = self.do_spike_stats(tracedata[irep], aifs)
+                count, latency, rate, response_bins = review['stats'][irep]
                 spike_counts.extend(count)
                 spike_latencies.extend(latency)
                 spike_rates.extend(rate)
@@ -890,6 +970,22 @@ class MainWindow(ControlWindow):
             # update UI
             self.traceDone(total_spikes, avg_count, avg_latency, avg_rate, sd_latency, nan)
 
+    def reviewStatsKey(self, path, tracenum, fs):
+        """Identifies the spike statistics of a trace of saved data, for the
+        current analysis settings
+
+        :returns: tuple -- key for the trace's stats in reviewStats
+        """
+        if self.ui.psthMaxBox.isChecked():
+            stop_time = None
+        else:
+            stop_time = self.ui.psthStopField.value()
+        channels = tuple((name, self._aichan_details[name]['threshold'], 
+                          self._aichan_details[name]['polarity'], 
+                          self._aichan_details[name]['abs']) for name in self._aichans)
+        return (path, tracenum, fs, channels, self.ui.psthStartField.value(),
+                stop_time, float(self.ui.binszSpnbx.value()))
+
     def displayOldProgressPlot(self, path):
         if self.activeOperation is None:
             path = str(path)
@@ -897,7 +993,6 @@ class MainWindow(ControlWindow):
                 group_path = os.path.dirname(path)
             else:
                 group_path = path
-            testdata = self.acqmodel.datafile.get_data(path)
             test_info = dict(self.acqmodel.datafile.get_info(path))
             comp_info = self.acqmodel.datafile.get_trace_stim(path)
             group_info = dict(self.acqmodel.datafile.get_info(group_path))
@@ -918,23 +1013,45 @@ class MainWindow(ControlWindow):
                 groups = intensities
                 plottype = 'tuning'
             else:
-                xlabels = range(testdata.shape[0])
+                xlabels = None
                 groups = ['all traces']
                 plottype = 'other'
 
-            if len(testdata.shape) == 3:
-                # backwards compatibility: reshape old data to have channel dimension
-                testdata = testdata.reshape((testdata.shape[0], testdata.shape[1], 1, testdata.shape[-1]))
-            nchans = testdata.shape[-2]
-
-            if len(self._aichans) != nchans:
-                cnames = get_ai_chans(self.advanced_options['device_name'])
-                self.setNewChannels(cnames[:nchans])
-
+            # use spikes saved in the data file for the current settings, if there are any
             thresholds = [self._aichan_details[chan]['threshold'] for chan in self._aichans]
             useabs = [self._aichan_details[chan]['abs'] for chan in self._aichans]
-            # a not-so-live curve
-            self.comatosecurve = ProgressWidget.loadCurve(testdata, groups, thresholds, useabs, aifs, xlabels)
+            polarities = [self._aichan_details[chan]['polarity'] for chan in self._aichans]
+            counts = None
+            if hasattr(self.acqmodel.datafile, 'get_spike_counts'):
+                try:
+                    counts = self.acqmodel.datafile.get_spike_counts(path, thresholds, useabs, polarities)
+                except ValueError:
+                    # different number of channels
+                    counts = None
+
+            if counts is not None:
+                if xlabels is None:
+                    xlabels = range(counts.shape[0])
+                # mean spikes per rep
+                spike_counts = counts.reshape((counts.shape[0], -1)).mean(axis=1)
+                self.comatosecurve = ProgressWidget.loadCounts(spike_counts, groups, xlabels)
+            else:
+                testdata = self.acqmodel.datafile.get_data(path)
+                if xlabels is None:
+                    xlabels = range(testdata.shape[0])
+                if len(testdata.shape) == 3:
+                    # backwards compatibility: reshape old data to have channel dimension
+                    testdata = testdata.reshape((testdata.shape[0], testdata.shape[1], 1, testdata.shape[-1]))
+                nchans = testdata.shape[-2]
+
+                if len(self._aichans) != nchans:
+                    cnames = get_ai_chans(self.advanced_options['device_name'])
+                    self.setNewChannels(cnames[:nchans])
+
+                thresholds = [self._aichan_details[chan]['threshold'] for chan in self._aichans]
+                useabs = [self._aichan_details[chan]['abs'] for chan in self._aichans]
+                # a not-so-live curve
+                self.comatosecurve = ProgressWidget.loadCurve(testdata, groups, thresholds, useabs, aifs, xlabels)
             self.comatosecurve.setLabels(plottype)
             self.ui.progressDock.setWidget(self.comatosecurve)
 
@@ -972,6 +1089,7 @@ class MainWindow(ControlWindow):
         fname = os.path.basename(str(fname))
         self.ui.dataFileLbl.setText(fname)
         self.ui.reviewer.setDataObject(self.acqmodel.datafile)
+        self.reviewStats.clear()
         self.ui.cellIDLbl.setText(str(self.acqmodel.current_cellid))
         self.lf.close()
         self.lf.deleteLater()
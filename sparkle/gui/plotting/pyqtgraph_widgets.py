@@ -674,8 +674,6 @@ class ProgressWidget(BasePlot):
         """Accepts a data set from a whole test, averages reps and re-creates the 
         progress plot as the same as it was during live plotting. Number of thresholds
         must match the size of the channel dimension"""
-        xlims = (xlabels[0], xlabels[-1])
-        pw = ProgressWidget(groups, xlims)
         spike_counts = []
         # skip control
         for itrace in range(data.shape[0]):
@@ -683,8 +681,16 @@ class ProgressWidget(BasePlot):
             for ichan in range(data.shape[2]):
                 flat_reps = data[itrace,:,ichan,:].flatten()
                 count += len(spikestats.spike_times(flat_reps, thresholds[ichan], fs, absvals[ichan]))
-            spike_counts.append(count/(data.shape[1]*data.shape[2])) #mean spikes per rep
+            spike_counts.append(float(count)/(data.shape[1]*data.shape[2])) #mean spikes per rep
+
+        return ProgressWidget.loadCounts(spike_counts, groups, xlabels)
 
+    @staticmethod
+    def loadCounts(spike_counts, groups, xlabels):
+        """Re-creates the progress plot from the mean spike count per rep
+        of each trace of a test, e.g. from spikes saved in the data file"""
+        xlims = (xlabels[0], xlabels[-1])
+        pw = ProgressWidget(groups, xlims)
         i = 0
         for g in groups:
             for x in xlabels:
@@ -1,8 +1,11 @@
+import logging
 import threading
-import time
 
 import numpy as np
 
+from sparkle.run.scheduler import Scheduler, raise_thread_priority
+from sparkle.tools.timing import TimingRecorder
+
 
 class AbstractAcquisitionRunner(object):
     """Holds state information for an experimental session"""
@@ -14,6 +17,7 @@ class AbstractAcquisitionRunner(object):
         self.average = False
         self.reject = False
         self.rejectrate = 0
+        self.rejectmode = 'sample'
 
         self.datafile = None
 
@@ -21,6 +25,11 @@ class AbstractAcquisitionRunner(object):
         self.calv = 0.1
         self.calf = 20000
         self.reprate = 2
+        self.high_priority = False
+        self.scheduler = None
+        #: how long the stages of each rep take
+        self.timing = TimingRecorder()
+        self.save_timing = False
 
         self.binsz = 0.005
 
@@ -90,6 +99,12 @@ class AbstractAcquisitionRunner(object):
         :type reject: bool
         :param rejectrate: the value to base artifact rejection on
         :type rejectrate: float
+        :param rejectmode: what to leave out of the average when a value is rejected: 'sample' for just that sample, 'rep' for the whole repetition (all channels)
+        :type rejectmode: str
+        :param high_priority: whether to raise the priority of the acquisition thread, for steadier timing of reps
+        :type high_priority: bool
+        :param save_timing: whether to save a summary of how long the stages of each rep took as an attribute of the data set (see :attr:`timing`)
+        :type save_timing: bool
         """
         self.player_lock.acquire()
         if 'acqtime' in kwargs:
@@ -133,6 +148,12 @@ class AbstractAcquisitionRunner(object):
             self.reject = kwargs['reject']
         if 'rejectrate' in kwargs:
             self.rejectrate = kwargs['rejectrate']
+        if 'rejectmode' in kwargs:
+            self.rejectmode = kwargs['rejectmode']
+        if 'high_priority' in kwargs:
+            self.high_priority = kwargs['high_priority']
+        if 'save_timing' in kwargs:
+            self.save_timing = kwargs['save_timing']
 
     def run(self, interval, **kwargs):
         """Runs the acquisiton
@@ -147,23 +168,44 @@ class AbstractAcquisitionRunner(object):
         """Stop the current on-going generation/acquisition"""
         self._halt = True
 
+    def start_schedule(self, nreps=None):
+        """Starts timing reps to this acquisition object's interval
+        setting, with the first rep due now. Called from the acquisition
+        thread, whose priority is raised, if set to.
+
+        :param nreps: number of reps expected, if known
+        :type nreps: int
+        """
+        self._restore_priority = None
+        if self.high_priority:
+            self._restore_priority = raise_thread_priority()
+        self.scheduler = Scheduler(self.interval)
+        self.scheduler.start(nreps)
+
+    def stop_schedule(self):
+        """Finishes timing reps, and logs how the timing went"""
+        if self._restore_priority is not None:
+            self._restore_priority()
+            self._restore_priority = None
+        logger = logging.getLogger('main')
+        logger.info('Reps late {late}/{reps}, mean lateness {mean_lateness:.4f} s, max {max_lateness:.4f} s'.format(**self.scheduler.stats()))
+
     def interval_wait(self):
-        """Pauses the correct amount of time according to this 
-        acquisition object's interval setting, and the last time this 
-        function was called"""
-        # calculate time since last interation and wait to acheive desired interval
-        now = time.time()
-        elapsed = (now - self.last_tick)*1000
-        # print("interval %d, time from start %d \n" % (elapsed, (now - self.start_time)*1000))
-        if elapsed < self.interval:
-            # print('sleep ', (self.interval-elapsed))
-            # self.signals.warning.emit('') # clear previous warning
-            time.sleep((self.interval-elapsed)/1000)
-            now = time.time()
-        elif elapsed > self.interval:
-            pass
-            # self.signals.warning.emit("WARNING: PROVIDED INTERVAL EXCEEDED, ELAPSED TIME %d" % (elapsed))
-        self.last_tick = now
+        """Pauses until the next rep is due, according to this acquisition
+        object's interval setting, and the schedule started with the run
+
+        :returns: float -- seconds the rep is late
+        """
+        return self.scheduler.wait()
+
+    def timing_stats(self):
+        """Timing statistics of the reps of the current, or last, run
+
+        :returns: dict -- see :meth:`Scheduler.stats<sparkle.run.scheduler.Scheduler.stats>`, empty if nothing has been run
+        """
+        if self.scheduler is None:
+            return {}
+        return self.scheduler.stats()
 
     def putnotify(self, name, *args):
         """Puts data into queue and alerts listeners"""
@@ -1,8 +1,14 @@
 import logging
+import os
 import Queue
 import threading
 
+import yaml
+
+from sparkle.data.acqdata import make_layout
+from sparkle.data.calibration_file import CalibrationFile, save_calibration
 from sparkle.data.open import open_acqdata
+from sparkle.data.writer import DataWriter
 from sparkle.run.calibration_runner import CalibrationCurveRunner, \
     CalibrationRunner
 from sparkle.run.chart_runner import ChartRunner
@@ -10,7 +16,12 @@ from sparkle.run.microphone_calibration_runner import MphoneCalibrationRunner
 from sparkle.run.protocol_runner import ProtocolRunner
 from sparkle.run.search_runner import SearchRunner
 from sparkle.stim.stimulus_model import StimulusModel
+from sparkle.tools.systools import get_src_directory
 
+with open(os.path.join(get_src_directory(), 'settings.conf'), 'r') as yf:
+    config = yaml.load(yf)
+# how recordings are stored in new data files, see AcquisitionData.set_layout
+DATA_LAYOUT = config.get('data_layout') or {}
 
 class AcquisitionManager():
     """Handles all of the marshalling of different acquisition operations to the correct runner class.
@@ -22,6 +33,7 @@ class AcquisitionManager():
         self.datafile = None
         self.savefolder = None
         self.savename = None
+        self.data_layout = dict(DATA_LAYOUT)
 
         queue_names = ['curve_finished',
                 'ncollected',
@@ -63,6 +75,8 @@ class AcquisitionManager():
 
         self.selected_calibration_index = 0
         self.current_cellid = 0
+        # calibration files that have been opened, by file name
+        self.calibration_files = {}
 
     def _qlisten(self):
         # create listener threads for all acquisition hooks
@@ -146,20 +160,58 @@ class AcquisitionManager():
                 print "Error: unable to load calibration data from: ", datakey
                 raise
             calibration_vector, calibration_freqs = cal
-        # clear one cache -- affects all StimulusModels
-        StimulusModel.clearCache()
+        self._set_calibration(calibration_vector, calibration_freqs, frange, datakey)
+
+    def save_calibration_file(self, filename, datakey, calf, frange=None):
+        """Saves a calibration from the current data file to a file of its
+        own, with its filters worked out ahead of time, see :func:`save_calibration<sparkle.data.calibration_file.save_calibration>`
+
+        :param filename: Name of the file to save the calibration to
+        :type filename: str
+        :param datakey: name of the calibration in the current data file
+        :type datakey: str
+        :param calf: Calibration frequency for the attenuation vector to be in relation to
+        :type calf: int
+        :param frange: Frequency range, low and high, for which to restrict the calibration to
+        :type frange: (int, int)
+        """
+        calibration_vector, calibration_freqs = self.datafile.get_calibration(datakey, calf)
+        save_calibration(filename, calibration_vector, calibration_freqs, frange, calf,
+                         source='{}:{}'.format(self.datafile.filename, datakey))
+        self.calibration_files.pop(filename, None)
+
+    def load_calibration_file(self, filename, frange=None):
+        """Sets a calibration, saved with :meth:`save_calibration_file`,
+        for all of the acquisition operations. Its saved filters are used,
+        rather than worked out again.
+
+        :param filename: Name of the calibration file
+        :type filename: str
+        :param frange: Frequency range, low and high, for which to restrict the calibration to, default is the saved range
+        :type frange: (int, int)
+        """
+        if filename not in self.calibration_files:
+            self.calibration_files[filename] = CalibrationFile(filename)
+        calibration = self.calibration_files[filename]
+        calibration.add_kernels(StimulusModel.kernelCache, frange)
+        if frange is None:
+            frange = calibration.frange
+        self._set_calibration(calibration.fresponse, calibration.frequencies, frange, filename)
+
+    def _set_calibration(self, calibration_vector, calibration_freqs, frange, calname):
+        # calibration filters are cached by calibration, so switching back
+        # to a calibration used before reuses its filters
         logger = logging.getLogger('main')
-        logger.debug('clearing cache')
         logger.debug('setting explore calibration')
-        self.explorer.set_calibration(calibration_vector, calibration_freqs, frange, datakey)
+        self.explorer.set_calibration(calibration_vector, calibration_freqs, frange, calname)
         logger.debug('setting protocol calibration')
-        self.protocoler.set_calibration(calibration_vector, calibration_freqs, frange, datakey)
+        self.protocoler.set_calibration(calibration_vector, calibration_freqs, frange, calname)
         logger.debug('setting chart calibration')
-        self.charter.set_calibration(calibration_vector, calibration_freqs, frange, datakey)
+        self.charter.set_calibration(calibration_vector, calibration_freqs, frange, calname)
         logger.debug('setting calibrator calibration')
-        self.bs_calibrator.stash_calibration(calibration_vector, calibration_freqs, frange, datakey)
+        self.bs_calibrator.stash_calibration(calibration_vector, calibration_freqs, frange, calname)
         logger.debug('setting tone calibrator calibration')
-        self.tone_calibrator.stash_calibration(calibration_vector, calibration_freqs, frange, datakey)
+        self.tone_calibrator.stash_calibration(calibration_vector, calibration_freqs, frange, calname)
 
     def current_calibration(self):
         """The currently employed calibration
@@ -194,6 +246,10 @@ class AcquisitionManager():
         """
         self.close_data()
         self.datafile = open_acqdata(fname, filemode=filemode)
+        if filemode != 'r':
+            self.datafile.set_layout(**self.data_layout)
+            # saving data happens in the background
+            self.datafile = DataWriter(self.datafile, on_backpressure=self._warn_backpressure)
 
         self.explorer.set(datafile=self.datafile)
         self.protocoler.set(datafile=self.datafile)
@@ -204,6 +260,24 @@ class AcquisitionManager():
 
         self.current_cellid = dict(self.datafile.get_info('')).get('total cells', 0)
 
+    def set_data_layout(self, **layout):
+        """Sets how recordings are stored in data sets created from now on,
+        in the current data file, and those opened later. The default is 
+        *data_layout* in `settings.conf`.
+
+        See :meth:`AcquisitionData.set_layout<sparkle.data.acqdata.AcquisitionData.set_layout>` for the options
+        """
+        # check before anything is changed
+        make_layout(**layout)
+        self.data_layout = layout
+        if self.datafile is not None and self.datafile.filemode != 'r':
+            self.datafile.set_layout(**layout)
+
+    def _warn_backpressure(self, maxsize):
+        q, waker = self.signals['warning']
+        q.put(("WARNING: saving data is falling behind acquisition",))
+        waker.set()
+
     def current_data_file(self):
         """Name of the currently employed data file
 
@@ -5,12 +5,13 @@ import numpy as np
 import yaml
 
 from sparkle.acq.players import FinitePlayer
+from sparkle.data.calibration_curve import process_tones
 from sparkle.gui.stim.factory import CCFactory
 from sparkle.run.list_runner import ListAcquisitionRunner
 from sparkle.stim.stimulus_model import StimulusModel
 from sparkle.stim.types.stimuli_classes import FMSweep, PureTone, WhiteNoise
-from sparkle.tools.audiotools import attenuation_curve, calc_db, \
-    calc_spectrum, signal_amplitude
+from sparkle.tools.audiotools import RunningStats, attenuation_curve, \
+    calc_db, signal_amplitude
 from sparkle.tools.systools import get_src_directory
 from sparkle.tools.util import next_str_num
 
@@ -81,6 +82,9 @@ class CalibrationRunner(AbstractCalibrationRunner):
         self.calibration_vector = None
         self.calibration_freqs = None
         self.calibration_frange = None
+        # running mean and variance of the recordings of each stimulus,
+        # 'signal' and 'reference_tone', so they are not read back to average
+        self.calibration_stats = {}
 
     def get_stims(self):
         """Gets the stimuli available for setting as the current calibration stimulus
@@ -110,6 +114,7 @@ class CalibrationRunner(AbstractCalibrationRunner):
 
     def _initialize_run(self):
        
+        self.calibration_stats = {}
         self.player.set_aochan(self.aochan)
         self.player.set_aichan(self.aichan)
 
@@ -153,11 +158,29 @@ class CalibrationRunner(AbstractCalibrationRunner):
         if self.save_data:
             if trace_info['components'][0]['stim_type'] == 'Pure Tone':
                 self.datafile.append(self.current_dataset_name, response, nested_name='reference_tone')
+                self._update_stats('reference_tone', response)
             elif trace_info['components'][0]['stim_type'] == 'FM Sweep' or trace_info['components'][0]['stim_type'] == 'White Noise':
                 self.datafile.append(self.current_dataset_name, response)
+                self._update_stats('signal', response)
             else:
                 raise Exception("Improper calibration stimulus : {}".format(trace_info['components'][0]['stim_type']))
 
+    def _update_stats(self, name, response):
+        response = np.squeeze(response)
+        if name not in self.calibration_stats:
+            self.calibration_stats[name] = RunningStats(response.shape)
+        self.calibration_stats[name].add(response)
+
+    def calibration_variance(self):
+        """Variance between the reps of the last calibration, sample by
+        sample, of the recordings of the calibration stimulus ('signal'),
+        and of the reference tone ('reference_tone'). The lower it is,
+        the more consistent the recordings were.
+
+        :returns: dict -- numpy.ndarray of the variance, for each of 'signal' and 'reference_tone' recorded
+        """
+        return dict((name, stats.variance()) for name, stats in self.calibration_stats.items())
+
     def process_calibration(self, save=True):
         """processes calibration control signal. Determines transfer function
         of speaker to get frequency vs. attenuation curve.
@@ -168,8 +191,11 @@ class CalibrationRunner(AbstractCalibrationRunner):
         """
         if not self.save_data:
             raise Exception("Cannot process an unsaved calibration")
-            
-        avg_signal = np.mean(self.datafile.get_data(self.current_dataset_name + '/signal'), axis=0)
+        if 'signal' not in self.calibration_stats or 'reference_tone' not in self.calibration_stats:
+            raise Exception("Cannot process a calibration with nothing recorded")
+
+        # averaged as the reps were recorded
+        avg_signal = self.calibration_stats['signal'].mean()
 
         diffdB = attenuation_curve(self.stimulus.signal()[0], avg_signal,
                                         self.stimulus.samplerate(), self.calf)
@@ -183,13 +209,20 @@ class CalibrationRunner(AbstractCalibrationRunner):
         self.datafile.append(self.current_dataset_name, diffdB,
                              nested_name='calibration_intensities')
 
+        # how consistent the recordings were: mean variance between reps
+        variance = dict((name, float(np.mean(var))) for name, var in self.calibration_variance().items())
+        logger.debug('Calibration signal variance {signal}, reference tone variance {reference_tone}'.format(**variance))
+
         relevant_info = {'frequencies': 'all', 'calibration_dB':self.caldb,
                          'calibration_voltage': self.calv, 'calibration_frequency': self.calf,
+                         'signal_variance': variance['signal'],
+                         'reference_tone_variance': variance['reference_tone'],
+                         'reps': self.calibration_stats['signal'].count,
                          }
         self.datafile.set_metadata('/'.join([self.current_dataset_name, 'calibration_intensities']),
                                    relevant_info)
 
-        mean_reftone = np.mean(self.datafile.get_data(self.current_dataset_name + '/reference_tone'), axis=0)
+        mean_reftone = self.calibration_stats['reference_tone'].mean()
         tone_amp = signal_amplitude(mean_reftone, self.player.get_aifs())
         db = calc_db(tone_amp, self.mphonesens, self.mphonedb)
         # remove the reference tone from protocol
@@ -230,10 +263,10 @@ class CalibrationCurveRunner(AbstractCalibrationRunner):
         self.protocol_model.insert(self.stimulus, 0)
 
         # add in a tone at the calibration frequency and intensity
-        control_stim = StimulusModel()
+        self.control_stim = StimulusModel()
         self.control_tone = PureTone()
-        control_stim.insertComponent(self.control_tone)
-        self.protocol_model.insert(control_stim, 0)
+        self.control_stim.insertComponent(self.control_tone)
+        self.protocol_model.insert(self.control_stim, 0)
 
         self.save_data = False
 
@@ -272,8 +305,13 @@ class CalibrationCurveRunner(AbstractCalibrationRunner):
             self.datafile.init_data(self.current_dataset_name, mode='calibration',
                                     dims=(self.stimulus.traceCount(), self.stimulus.repCount()),
                                     nested_name='vamp')
+            # recordings of the control tone, so the curve can be processed again
+            self.datafile.init_data(self.current_dataset_name, mode='calibration',
+                                    dims=(self.control_stim.repCount(), self.aitimes.shape[0]),
+                                    nested_name='reference_tone')
 
-            info = {'samplerate_ad': self.player.aifs}
+            info = {'samplerate_ad': self.player.aifs, 'microphone_sensitivity': self.mphonesens,
+                    'microphone_dB': self.mphonedb}
             self.datafile.set_metadata(self.current_dataset_name, info)
 
         self.player.set_aochan(self.aochan)
@@ -288,6 +326,7 @@ class CalibrationCurveRunner(AbstractCalibrationRunner):
         self.control_tone.setIntensity(self.caldb)
         self.calpeak = None
         self.trace_counter = -1 # initialize to -1 instead of 0
+        self.trace_responses = None
 
         if self.apply_cal:
             self.protocol_model.setCalibration(self.calibration_vector, self.calibration_freqs, self.calibration_frange)
@@ -295,59 +334,65 @@ class CalibrationCurveRunner(AbstractCalibrationRunner):
             self.protocol_model.setCalibration(None, None, None)
 
     def _initialize_test(self, test):
-        self.peak_avg = []
+        pass
 
     def _process_response(self, response, trace_info, irep):
-        f = trace_info['components'][0]['frequency'] #only the one component (PureTone)
-        db = trace_info['components'][0]['intensity']
-        # print 'f', f, 'db', db
-        
         response = np.squeeze(response)
         assert len(response.shape) == 1, 'calibration only supported for single output channel'
-        # target frequency amplitude
-        freq, spectrum = calc_spectrum(response, self.player.get_aifs())
-        peak_fft = spectrum[(np.abs(freq-f)).argmin()]
+        # the reps of a trace are gathered up, and processed, and saved, together
+        if irep == 0:
+            if self.trace_responses is None or self.trace_responses.shape != (self.nreps, response.shape[0]):
+                self.trace_responses = np.empty((self.nreps, response.shape[0]))
+        self.trace_responses[irep] = response
+        if irep < self.nreps-1:
+            return
 
-        # signal amplitude
-        vamp = signal_amplitude(response, self.player.get_aifs())
+        f = trace_info['components'][0]['frequency'] #only the one component (PureTone)
+        db = trace_info['components'][0]['intensity']
+        # print 'f', f, 'db', db
 
-        if self.trace_counter >= 0:
-            if irep == 0:
-                if db == self.caldb:
-                    self.calibration_frequencies.append(f)
-                    self.calibration_indexes.append(self.trace_counter)
-                self.trace_counter +=1
-                self.peak_avg = []
+        # target frequency amplitude, and signal amplitude, of each rep
+        freq, spectra, peaks_fft, vamps = process_tones(self.trace_responses, self.player.get_aifs(), f)
+        if USE_FFT:
+            mean_peak = np.mean(peaks_fft)
+        else:
+            mean_peak = np.mean(vamps)
 
+        if self.trace_counter == -1:
+            # this always is the first trace
+            self.calpeak = mean_peak
+            self.trace_counter +=1
+            self.trace_set = 'reference_tone'
             if self.save_data:
-
-                self.datafile.append(self.current_dataset_name, response)
-                self.datafile.append(self.current_dataset_name, peak_fft, 
+                self.datafile.append(self.current_dataset_name, self.trace_responses,
+                                     nested_name='reference_tone')
+        else:
+            if db == self.caldb:
+                self.calibration_frequencies.append(f)
+                self.calibration_indexes.append(self.trace_counter)
+            self.trace_counter +=1
+            self.trace_set = 'signal'
+            if self.save_data:
+                self.datafile.append(self.current_dataset_name, self.trace_responses)
+                self.datafile.append(self.current_dataset_name, peaks_fft,
                                      nested_name='fft_peaks')
-                self.datafile.append(self.current_dataset_name, np.array([vamp]), 
+                self.datafile.append(self.current_dataset_name, vamps,
                                      nested_name='vamp')
-                self.datafile.append_trace_info(self.current_dataset_name, trace_info)
 
-            self.putnotify('calibration_response_collected', (spectrum, freq, vamp))
+            for spectrum, vamp in zip(spectra, vamps):
+                self.putnotify('calibration_response_collected', (spectrum, freq, vamp))
 
-        # calculate resultant dB and emit
-        if USE_FFT:
-            self.peak_avg.append(peak_fft)
-        else:
-            self.peak_avg.append(vamp)
-        if irep == self.nreps-1:
-            mean_peak = np.mean(self.peak_avg)
-            # print 'peak fft', mean_peak
-            if self.trace_counter == -1:
-                # this always is the first trace
-                self.calpeak = mean_peak
-                self.trace_counter +=1
-            else:
-                # use relative dB
-                # resultdb = calc_db(mean_peak, self.calpeak) + self.caldb
-                # dB according to microphone sensitivity
-                resultdb = calc_db(mean_peak, self.mphonesens, self.mphonedb)
-                self.putnotify('average_response', (f, db, resultdb))
+            # calculate resultant dB and emit
+            # use relative dB
+            # resultdb = calc_db(mean_peak, self.calpeak) + self.caldb
+            # dB according to microphone sensitivity
+            resultdb = calc_db(mean_peak, self.mphonesens, self.mphonedb)
+            self.putnotify('average_response', (f, db, resultdb))
+
+    def _save_trace_info(self, trace_doc):
+        # saved with the recordings, as the control and curve tones are both pure tones
+        self.datafile.append_trace_info(self.current_dataset_name, trace_doc,
+                                        nested_name=self.trace_set)
 
     def process_calibration(self, save=False):
         """processes the data gathered in a calibration run (does not work if multiple
@@ -356,8 +401,6 @@ class CalibrationCurveRunner(AbstractCalibrationRunner):
         if not self.save_data:
             raise Exception("Runner must be set to save when run, to be able to process")
 
-        vfunc = np.vectorize(calc_db, self.mphonesens, self.mphonedb)
-
         if USE_FFT:
             peaks = np.mean(abs(self.datafile.get_data(self.current_dataset_name + '/fft_peaks')), axis=1)
         else:
@@ -368,9 +411,7 @@ class CalibrationCurveRunner(AbstractCalibrationRunner):
         # cal_peak = peaks[cal_index]
         # cal_vmax = vmaxes[cal_index]
 
-        # print 'vfunc inputs', vmaxes, self.caldb, cal_vmax
-
-        resultant_dB = vfunc(peaks, self.calpeak) * -1 #db attenuation
+        resultant_dB = calc_db(peaks, self.calpeak) * -1 #db attenuation
 
         print 'calibration frequences', self.calibration_frequencies, 'indexes', self.calibration_indexes
         print 'attenuations', resultant_dB
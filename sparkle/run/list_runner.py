@@ -1,3 +1,4 @@
+import json
 import logging
 import threading
 import time
@@ -6,6 +7,7 @@ import numpy as np
 
 from sparkle.run.abstract_acquisition import AbstractAcquisitionRunner
 from sparkle.run.protocol_model import ProtocolTabelModel
+from sparkle.tools.timing import monotonic
 
 
 class Broken(Exception): pass
@@ -66,11 +68,6 @@ class ListAcquisitionRunner(AbstractAcquisitionRunner):
             info = {'calibration_used': self.calname, 'calibration_range': self.cal_frange}
             self.datafile.set_metadata(self.current_dataset_name, info)
 
-        # save the start time and set last tick to expired, so first
-        # acquisition loop iteration executes immediately
-        self.start_time = time.time()
-        self.last_tick = self.start_time - (self.interval/1000)
-
         self.acq_thread.start()
         return self.acq_thread
  
@@ -81,15 +78,19 @@ class ListAcquisitionRunner(AbstractAcquisitionRunner):
         raise NotImplementedError
 
     def _worker(self, stimuli):
-        t0 = time.time()
-        starttime = t0
-        timecollection = []
+        self.timing.reset()
+        self.player.set_timing(self.timing)
+        if self.save_data:
+            self.datafile.set_timing(self.timing)
+        # the first rep is due straight away
+        self.start_schedule(self.count())
         try:
             logger = logging.getLogger('main')
             # incase of early abortion...
             itest = 0
             itrace = -1
             irep = 0
+            expanded = None
             try:
                 for itest, test in enumerate(stimuli):
                     # pull out signal from stim model
@@ -98,7 +99,8 @@ class ListAcquisitionRunner(AbstractAcquisitionRunner):
                     self._initialize_test(test)
                     if self.save_data:
                         self.datafile.set_metadata(self.current_dataset_name, test.testDoc(), signal=True)
-                    traces, docs, overs = test.expandedStim()
+                    # stimuli are generated in the background, as they are needed
+                    expanded = test.expandedStimStream()
                     nreps = test.repCount()
                     self.nreps = test.repCount() # not sure I like this -- subclasses use this variable
                     fs = test.samplerate()
@@ -114,13 +116,15 @@ class ListAcquisitionRunner(AbstractAcquisitionRunner):
                         self.putnotify('over_voltage', (0,))
 
                         stamps = []
+                        lateness = []
                         self.player.start()
                         for irep in range(nreps):
-                            self.interval_wait()  
+                            lateness.append(self.interval_wait())
                             if self._halt:
                                 raise Broken
                             response = self.player.run()
                             stamps.append(time.time())
+                            start = monotonic()
                             self._process_response(response, trace_doc, irep)
                             if test.stimType() == 'Tuning Curve':
                                 extra_info = {'f': -1, 'db': 80}
@@ -129,40 +133,34 @@ class ListAcquisitionRunner(AbstractAcquisitionRunner):
                             self.putnotify('response_collected', (self.aitimes, response, itest, -1, irep, extra_info))
 
                             self.putnotify('current_rep', (irep,))
+                            self.timing.record('processing', monotonic() - start)
                             self.player.reset()
 
                         trace_doc['time_stamps'] = stamps
+                        trace_doc['lateness'] = lateness
                         if self.save_data:
-                            self.datafile.append_trace_info(self.current_dataset_name, trace_doc)
+                            self._save_trace_info(trace_doc)
                         self.player.stop()
 
-                    # now present the "real" stimuli
-                    for itrace, (trace, trace_doc, over) in enumerate(zip(traces, docs, overs)):
+                    # now present the "real" stimuli, timing how long
+                    # each takes to come out of the stream and be loaded
+                    start = monotonic()
+                    for itrace, (trace, trace_doc, over) in enumerate(expanded):
                         
                         signal, atten = trace
-                        # t1 = time.time()
                         self.player.set_stim(signal, fs, atten)
-                        # print 'player start time {:.3f}'.format(time.time()-t1)
+                        self.timing.record('stim_generation', monotonic() - start)
 
                         stamps = []
+                        lateness = []
                         self.player.start()
                         for irep in range(nreps):
-                            self.interval_wait()
+                            lateness.append(self.interval_wait())
                             if self._halt:
                                 raise Broken
-                            elapsed = time.time()-t0
-                            # print 'down time {:.3f}'.format(elapsed),
-                            # timecollection.append(elapsed)
                             response = self.player.run()
-                            s = time.time()
-                            oldt = t0
-                            t0=time.time()
-                            looplen = t0 - oldt
+                            stamps.append(time.time())
                             self.player.reset()
-                            # print 'reset time {:.3f}'.format(time.time()-s)
-                            # print 'loop duration {:.3f}'.format(looplen)
-                            timecollection.append(looplen)
-                            stamps.append(s)
 
                             if test.stimType() == 'Tuning Curve':
                                 f = trace_doc['components'][0]['frequency']
@@ -171,6 +169,7 @@ class ListAcquisitionRunner(AbstractAcquisitionRunner):
                             else:
                                 extra_info = {'all traces': True}
                             
+                            start = monotonic()
                             self.putnotify('response_collected', (self.aitimes, response, itest, itrace, irep, extra_info))
                             self._process_response(response, trace_doc, irep)
 
@@ -179,31 +178,48 @@ class ListAcquisitionRunner(AbstractAcquisitionRunner):
                                 self.putnotify('current_trace', (itest,itrace,trace_doc))
                                 self.putnotify('over_voltage', (over,))
                             self.putnotify('current_rep', (irep,))
+                            self.timing.record('processing', monotonic() - start)
                             
-                        # not getting saved:
                         trace_doc['time_stamps'] = stamps
+                        trace_doc['lateness'] = lateness
                         if self.save_data:
-                            self.datafile.append_trace_info(self.current_dataset_name, trace_doc)
+                            self._save_trace_info(trace_doc)
                         self.player.stop()
+                        start = monotonic()
+                    expanded.close()
 
                     # log as well, test type and user tag will be the same across traces
                     # logger.info("Finished test type: {}, tag: {}".format(trace_doc['testtype'], trace_doc['user_tag']))
             except Broken:
                 # save some abortion message
                 if self.save_data:
+                    # write the reps gathered for the unfinished trace
+                    self.datafile.flush()
                     self.datafile.set_metadata(self.current_dataset_name, {'aborted': 'test {}, trace {}, rep {}'.format(itest+1, itrace+1, irep+1)})
                 self.player.stop()
+            finally:
+                if expanded is not None:
+                    expanded.close()
+                self.stop_schedule()
+                self.player.set_timing(None)
+                if self.save_data:
+                    # waits for the queued saves, so they are all timed
+                    self.datafile.set_timing(None)
 
             if self.save_data:
+                timing = self.timing_stats()
+                metadata = {'reps_late': timing['late'],
+                            'max_lateness': timing['max_lateness']}
+                if self.save_timing:
+                    metadata['timing'] = json.dumps(self.timing.summary())
+                self.datafile.set_metadata(self.current_dataset_name, metadata)
                 self.datafile.backup(self.current_dataset_name)
+                # make sure everything is saved before announcing the end
+                self.datafile.flush()
             self.putnotify('group_finished', (self._halt,))
         except:
             logger.exception("Uncaught Exception from Acq Thread: ")
 
-        # print 'all elapsed', timecollection
-        tc = np.array(timecollection[1:])
-        print 'deadlines missed {}/{}'.format(len(tc[tc > (1./self.reprate)+0.01]), len(tc))
-
     def clear_child_process(self):
         del self.acq_thread
         
@@ -212,3 +228,7 @@ class ListAcquisitionRunner(AbstractAcquisitionRunner):
 
     def _process_response(self, test):
         raise NotImplementedError
+
+    def _save_trace_info(self, trace_doc):
+        """Saves the stimulus info of a finished trace to the current data set"""
+        self.datafile.append_trace_info(self.current_dataset_name, trace_doc)
@@ -39,10 +39,7 @@ class MphoneCalibrationRunner(ListAcquisitionRunner):
         self.response_buffer[irep,:] = response
 
     def process_calibration(self):
-        amps = []
-        for itest in range(self.response_buffer.shape[0]):
-            amps.append(signal_amplitude(self.response_buffer[itest,:], self.player.aifs))
-        amp = np.mean(amps)
+        amp = np.mean(signal_amplitude(self.response_buffer, self.player.aifs))
         return amp
 
     def reps(self):
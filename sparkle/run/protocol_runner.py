@@ -1,6 +1,6 @@
-import numpy as np
+import logging
 
-from itertools import islice, count
+import numpy as np
 
 from sparkle.acq.players import FinitePlayer
 from sparkle.run.list_runner import ListAcquisitionRunner
@@ -26,7 +26,8 @@ class ProtocolRunner(ListAcquisitionRunner):
             self.datafile.init_group(self.current_dataset_name)
 
             info = {'samplerate_ad': self.player.aifs, 'averaged': self.average,
-                    'artifact_reject': self.reject, 'reject_rate': self.rejectrate}
+                    'artifact_reject': self.reject, 'reject_rate': self.rejectrate,
+                    'reject_mode': self.rejectmode}
             self.datafile.set_metadata(self.current_dataset_name, info)
 
         self.player.set_aochan(self.aochan)
@@ -65,12 +66,10 @@ class ProtocolRunner(ListAcquisitionRunner):
                     # Checks if any values are higher than the Artifact Rejection
                     # value for each sample and if so converts to nan
                     if self.reject:
-                        # print 'rejectrate:', self.rejectrate
-                        for i in islice(count(), self.avg_buffer.shape[0]):
-                            for j in islice(count(), self.avg_buffer.shape[2]):
-                                if self.avg_buffer[i][0][j] >= self.rejectrate:
-                                    self.avg_buffer[i][0][j] = np.nan
-                            # print '[', i, ']: ', self.avg_buffer[i][0]
+                        nrejected = reject_artifacts(self.avg_buffer, self.rejectrate, self.rejectmode)
+                        if nrejected > 0:
+                            logger = logging.getLogger('main')
+                            logger.debug('Artifacts found in {} of {} reps'.format(nrejected, self.nreps))
 
                     avg_response = np.nanmean(self.avg_buffer, axis=0)
                     # print '\navg_response: ', avg_response
@@ -93,3 +92,25 @@ class ProtocolRunner(ListAcquisitionRunner):
     def clear(self):
         """Clears all tests from protocol list"""
         self.protocol_model.clear()
+
+def reject_artifacts(responses, threshold, mode='sample'):
+    """Marks artifacts in the repetitions of a trace as NaN, so that 
+    they may be left out of the average
+
+    :param responses: recordings for each rep, dimensions (reps, channels, samples). Modified in place.
+    :type responses: numpy.ndarray
+    :param threshold: samples at or above this value are artifacts
+    :type threshold: float
+    :param mode: 'sample' to mark only the artifact samples, or 'rep' to mark every sample of a rep, across all channels, that contains an artifact
+    :type mode: str
+    :returns: int -- the number of reps that contained an artifact
+    """
+    artifacts = responses >= threshold
+    bad_reps = artifacts.reshape(artifacts.shape[0], -1).any(axis=1)
+    if mode == 'rep':
+        responses[bad_reps] = np.nan
+    elif mode == 'sample':
+        responses[artifacts] = np.nan
+    else:
+        raise ValueError("Unknown artifact rejection mode: {}".format(mode))
+    return int(np.count_nonzero(bad_reps))
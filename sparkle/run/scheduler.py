@@ -0,0 +1,137 @@
+"""Timing of the reps of an acquisition: each rep is due a fixed interval
+after the one before, on a schedule worked out from the start of the run,
+so that small delays do not add up over a protocol.
+
+Waiting for a rep sleeps until shortly before it is due, and spins for
+the rest of the time, since a sleep on its own can overshoot by a few
+milliseconds, or more on Windows. Times come from a monotonic clock, so
+they are not thrown off by changes to the system time.
+"""
+
+import ctypes
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+from sparkle.tools.timing import monotonic
+
+# seconds before a rep is due that waiting stops sleeping, and spins
+SPIN = 0.002
+# seconds a rep can be late, before it is counted as late
+TOLERANCE = 0.001
+# niceness taken off the acquisition thread, to raise its priority, on posix
+NICE = 10
+
+
+def raise_thread_priority():
+    """Raises the scheduling priority of the calling thread, if it can. On
+    posix this needs the privilege to lower niceness; on OS X, this affects
+    the whole process.
+
+    :returns: callable -- function which puts the priority back, or None if it could not be raised
+    """
+    logger = logging.getLogger('main')
+    if sys.platform.startswith('win'):
+        kernel32 = ctypes.windll.kernel32
+        thread = kernel32.GetCurrentThread()
+        old_priority = kernel32.GetThreadPriority(thread)
+        # THREAD_PRIORITY_HIGHEST
+        if not kernel32.SetThreadPriority(thread, 2):
+            logger.warning('Could not raise acquisition thread priority')
+            return None
+        return lambda: kernel32.SetThreadPriority(kernel32.GetCurrentThread(), old_priority)
+    try:
+        os.nice(-NICE)
+    except OSError:
+        logger.warning('Could not raise acquisition thread priority, not permitted')
+        return None
+    return lambda: os.nice(NICE)
+
+class Scheduler(object):
+    """Paces the reps of an acquisition to an interval
+
+    If a rep is late, the rest of the schedule is put back by as much, so
+    the reps after it are still at least the interval apart, rather than
+    closer together to catch up.
+
+    :param interval: time between the start of each rep (ms)
+    :type interval: float
+    :param spin: seconds before a rep is due to stop sleeping, and spin
+    :type spin: float
+    :param tolerance: seconds a rep can be late, before it is counted as late
+    :type tolerance: float
+    :param clock: function giving the current time, in seconds
+    :type clock: callable
+    :param sleep: function which sleeps for a number of seconds, on *clock*
+    :type sleep: callable
+    """
+    def __init__(self, interval, spin=SPIN, tolerance=TOLERANCE, clock=monotonic,
+                 sleep=time.sleep):
+        self.interval = interval / 1000.
+        self.spin = spin
+        self.tolerance = tolerance
+        self.clock = clock
+        self.sleep = sleep
+        self.start()
+
+    def start(self, nreps=None):
+        """Starts the schedule, with the first rep due now
+
+        :param nreps: number of reps expected, their deadlines are worked out up front; reps after these are due at the same interval
+        :type nreps: int
+        """
+        self.start_time = self.clock()
+        if nreps:
+            self.deadlines = self.start_time + np.arange(nreps) * self.interval
+        else:
+            self.deadlines = np.empty((0,))
+        #: number of reps waited for
+        self.rep = 0
+        self._delay = 0.
+        self._late = 0
+        self._total_lateness = 0.
+        self._max_lateness = 0.
+
+    def deadline(self, rep):
+        """Time rep number *rep* is due, from the clock
+
+        :returns: float -- time (seconds)
+        """
+        if rep < len(self.deadlines):
+            due = self.deadlines[rep]
+        else:
+            due = self.start_time + rep * self.interval
+        return due + self._delay
+
+    def wait(self):
+        """Waits until the next rep is due
+
+        :returns: float -- seconds the rep is late
+        """
+        due = self.deadline(self.rep)
+        remaining = due - self.clock()
+        if remaining > self.spin:
+            self.sleep(remaining - self.spin)
+        now = self.clock()
+        while now < due:
+            now = self.clock()
+        lateness = now - due
+        if lateness > self.tolerance:
+            self._late += 1
+            self._delay += lateness
+        self._total_lateness += lateness
+        self._max_lateness = max(self._max_lateness, lateness)
+        self.rep += 1
+        return lateness
+
+    def stats(self):
+        """Timing statistics of the reps so far
+
+        :returns: dict -- number of reps, number late, mean and max lateness (seconds), and the tolerance for being late
+        """
+        return {'reps': self.rep, 'late': self._late,
+                'mean_lateness': self._total_lateness / self.rep if self.rep else 0.,
+                'max_lateness': self._max_lateness, 'tolerance': self.tolerance}
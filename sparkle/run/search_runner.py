@@ -109,10 +109,6 @@ class SearchRunner(AbstractAcquisitionRunner):
             self.datafile.init_data(self.current_dataset_name, self.aitimes.shape, mode='open')
             self.set_name = increment_title(self.set_name)
 
-        # save the start time and set last tick to expired, so first
-        # acquisition loop iteration executes immediately
-        self.start_time = time.time()
-        self.last_tick = self.start_time - (interval/1000)
         self.interval = interval
         self.acq_thread = threading.Thread(target=self._worker)
 
@@ -129,6 +125,8 @@ class SearchRunner(AbstractAcquisitionRunner):
         return self.acq_thread
 
     def _worker(self):
+        # the first rep is due straight away
+        self.start_schedule()
         try:
             spike_counts = []
             spike_latencies = []
@@ -143,7 +141,7 @@ class SearchRunner(AbstractAcquisitionRunner):
             # self.player.start_timer(self.reprate)
             stim = self.player.start()
             while not self._halt:
-                self.interval_wait()
+                lateness = self.interval_wait()
 
                 response = self.player.run()
                 stamp = time.time()
@@ -163,7 +161,7 @@ class SearchRunner(AbstractAcquisitionRunner):
 
                 if self.save_data:
                     # save response data
-                    self.save_to_file(response, stamp)
+                    self.save_to_file(response, stamp, lateness)
 
                 self.irep +=1
                 if self.irep == self.nreps:
@@ -177,19 +175,24 @@ class SearchRunner(AbstractAcquisitionRunner):
         except:
             logger = logging.getLogger('main')
             logger.exception("Uncaught Exception from Explore Thread:")
+        finally:
+            self.stop_schedule()
 
-    def save_to_file(self, data, stamp):
+    def save_to_file(self, data, stamp, lateness=None):
         """Saves data to current dataset.
 
         :param data: data to save to file
         :type data: numpy.ndarray
         :param stamp: time stamp of when the data was acquired
         :type stamp: str
+        :param lateness: seconds the acquisition started after it was due
+        :type lateness: float
         """
         self.datafile.append(self.current_dataset_name, data)
         # save stimulu info
         info = dict(self._stimulus.componentDoc().items() + self._stimulus.testDoc().items())
         print 'saving doc', info
         info['time_stamps'] = [stamp]
+        info['lateness'] = [lateness]
         info['samplerate_ad'] = self.player.aifs
         self.datafile.append_trace_info(self.current_dataset_name, info)
@@ -0,0 +1,207 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import weakref
+
+import numpy as np
+
+from sparkle.tools.audiotools import OverlapSaveFilter, impulse_response
+from sparkle.tools.cache import LRUCache
+
+
+class KernelCache(object):
+    """Calibration filters, by everything that goes into making them:
+    samplerate, frequency response, frequencies, frequency range and kernel
+    length. So a filter can never be used with the wrong calibration, and
+    switching back to a calibration used before does not mean working
+    out its filters again. The least recently used filters are discarded
+    to stay under *maxbytes*.
+
+    Kernels can be worked out ahead of time on a background thread, with
+    :meth:`prefetch`; asking for one that is still being worked out waits
+    for it to finish.
+
+    If given a *directory*, kernels are also saved there, and loaded from
+    there when they are not in memory, so they last between sessions.
+
+    :param maxbytes: The most memory to use for filters
+    :type maxbytes: int
+    :param directory: Folder to save kernels in, or None to keep them in memory only
+    :type directory: str
+    """
+    def __init__(self, maxbytes=2**27, directory=None):
+        self.directory = directory
+        self._filters = LRUCache(maxbytes)
+        # events for kernels being worked out in the background, by key
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def kernel(self, fs, fresponse, frequencies, frange, filter_len=2**14):
+        """Gets the calibration filter kernel, see :func:`impulse_response<sparkle.tools.audiotools.impulse_response>`
+        for the arguments
+
+        :returns: numpy.ndarray -- the filter kernel, do not change it
+        """
+        return self.filter(fs, fresponse, frequencies, frange, filter_len).kernel
+
+    def filter(self, fs, fresponse, frequencies, frange, filter_len=2**14):
+        """Gets the calibration filter, for applying the kernel to signals,
+        see :func:`impulse_response<sparkle.tools.audiotools.impulse_response>`
+        for the arguments
+
+        :returns: :class:`OverlapSaveFilter<sparkle.tools.audiotools.OverlapSaveFilter>`
+        """
+        key = kernel_key(fs, fresponse, frequencies, frange, filter_len)
+        calibration_filter = self._filters.get(key)
+        if calibration_filter is not None:
+            return calibration_filter
+        with self._lock:
+            pending = self._pending.get(key)
+        if pending is not None:
+            pending.wait()
+            calibration_filter = self._filters.get(key)
+            if calibration_filter is not None:
+                return calibration_filter
+        return self._make(key, fs, fresponse, frequencies, frange, filter_len)
+
+    def prefetch(self, fs, fresponse, frequencies, frange, filter_len=2**14):
+        """Starts working out a calibration filter on a background thread,
+        if it is not already cached, so that it is ready when it is needed
+        """
+        key = kernel_key(fs, fresponse, frequencies, frange, filter_len)
+        with self._lock:
+            if key in self._filters or key in self._pending:
+                return
+            self._pending[key] = threading.Event()
+        thread = threading.Thread(target=self._make_pending,
+                                  args=(key, fs, fresponse, frequencies, frange, filter_len))
+        thread.daemon = True
+        thread.start()
+
+    def add(self, fs, fresponse, frequencies, frange, kernel, filter_len=2**14):
+        """Puts a kernel that was worked out before, e.g. one from a
+        :class:`CalibrationFile<sparkle.data.calibration_file.CalibrationFile>`,
+        in the cache, so that it does not have to be worked out again. See
+        :func:`impulse_response<sparkle.tools.audiotools.impulse_response>`
+        for the arguments
+
+        :param kernel: the filter kernel for the arguments
+        :type kernel: numpy.ndarray
+        """
+        key = kernel_key(fs, fresponse, frequencies, frange, filter_len)
+        if key not in self._filters:
+            self._put(key, kernel)
+
+    def clear(self):
+        """Discards all filters held in memory; saved kernels are kept"""
+        self._filters.clear()
+
+    def stats(self):
+        """See :meth:`LRUCache.stats<sparkle.tools.cache.LRUCache.stats>`"""
+        return self._filters.stats()
+
+    def _make_pending(self, key, *args):
+        try:
+            self._make(key, *args)
+        except:
+            logger = logging.getLogger('main')
+            logger.exception('Error calculating calibration filter')
+        finally:
+            with self._lock:
+                self._pending.pop(key).set()
+
+    def _make(self, key, fs, fresponse, frequencies, frange, filter_len):
+        kernel = self._load(key)
+        if kernel is None:
+            logger = logging.getLogger('main')
+            logger.debug('calculating new filter for fs {}'.format(fs))
+            kernel = impulse_response(fs, fresponse, frequencies, frange, filter_len)
+            self._save(key, kernel)
+        return self._put(key, kernel)
+
+    def _put(self, key, kernel):
+        calibration_filter = OverlapSaveFilter(kernel)
+        # the kernel, and its FFT for filtering
+        nbytes = kernel.nbytes + (calibration_filter.nfft // 2 + 1) * 16
+        self._filters.put(key, calibration_filter, nbytes)
+        return calibration_filter
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def _load(self, key):
+        if self.directory is None or not os.path.isfile(self._path(key)):
+            return None
+        try:
+            return np.load(self._path(key))
+        except (IOError, ValueError):
+            logger = logging.getLogger('main')
+            logger.warning('Could not load saved calibration filter {}'.format(self._path(key)))
+            return None
+
+    def _save(self, key, kernel):
+        if self.directory is None:
+            return
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # written under a temporary name, so a partly written file is never loaded
+            tmppath = self._path(key) + '.{}.tmp'.format(threading.current_thread().ident)
+            with open(tmppath, 'wb') as kernelfile:
+                np.save(kernelfile, kernel)
+            if not os.path.isfile(self._path(key)):
+                os.rename(tmppath, self._path(key))
+            else:
+                os.remove(tmppath)
+        except (IOError, OSError):
+            logger = logging.getLogger('main')
+            logger.exception('Could not save calibration filter to {}'.format(self.directory))
+
+def kernel_key(fs, fresponse, frequencies, frange, filter_len=2**14):
+    """Makes a key from everything that goes into a calibration filter
+    kernel, see :func:`impulse_response<sparkle.tools.audiotools.impulse_response>`
+
+    :returns: str -- hex digest of the arguments
+    """
+    digest = _calibration_digest(fresponse, frequencies)
+    digest.update(json.dumps([len(fresponse), float(fs), [float(f) for f in frange], int(filter_len)]))
+    return digest.hexdigest()
+
+# digests of calibrations held in memory that cannot be written to, e.g.
+# that of a CalibrationFile, so they are not hashed again for every key,
+# and every stimulus the calibration is set on; by the ids of the arrays,
+# for as long as the arrays exist
+_digests = {}
+_digests_lock = threading.RLock()
+
+def _calibration_digest(fresponse, frequencies):
+    arrays = (fresponse, frequencies)
+    ids = (id(fresponse), id(frequencies))
+    fixed = all(_read_only(values) for values in arrays)
+    if fixed:
+        with _digests_lock:
+            if ids in _digests:
+                return _digests[ids][0].copy()
+    digest = hashlib.sha1()
+    for values in arrays:
+        digest.update(np.ascontiguousarray(values, dtype=float).data)
+    if fixed:
+        def forget(ref):
+            with _digests_lock:
+                _digests.pop(ids, None)
+        with _digests_lock:
+            _digests[ids] = (digest.copy(), [weakref.ref(values, forget) for values in arrays])
+    return digest
+
+def _read_only(values):
+    # whether an array is a view of memory that can not be written to, as
+    # opposed to an array that could be made writeable again
+    if not isinstance(values, np.ndarray):
+        return False
+    while isinstance(values, np.ndarray):
+        if values.flags.writeable:
+            return False
+        values = values.base
+    return values is not None
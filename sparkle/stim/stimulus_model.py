@@ -1,6 +1,10 @@
 import copy
+import itertools
 import logging
 import os
+import Queue
+import sys
+import threading
 import uuid
 
 import numpy as np
@@ -9,7 +13,8 @@ import yaml
 from sparkle.stim.auto_parameter_model import AutoParameterModel
 from sparkle.stim.reorder import order_function
 from sparkle.stim.types import get_stimuli_models
-from sparkle.tools.audiotools import convolve_filter, impulse_response
+from sparkle.stim.kernel_cache import KernelCache, kernel_key
+from sparkle.tools.cache import LRUCache, content_key
 from sparkle.tools.systools import get_src_directory
 
 src_dir = get_src_directory()
@@ -17,13 +22,18 @@ src_dir = get_src_directory()
 with open(os.path.join(src_dir,'settings.conf'), 'r') as yf:
     config = yaml.load(yf)
 DEFAULT_SAMPLERATE = config['default_genrate']
+KERNEL_CACHE_DIR = config.get('kernel_cache_dir')
 
 class StimulusModel():
     """
     Model to represent any stimulus the system will present. 
     Holds all relevant parameters
     """
-    kernelCache = {} # persistent across all existing StimulusModels
+    # calibration filters, by calibration and samplerate, persistent across
+    # all existing StimulusModels
+    kernelCache = KernelCache(2**27, KERNEL_CACHE_DIR)
+    # generated signals, by the content of everything that goes into them
+    signalCache = LRUCache(2**28)
     # these should always be the same application wide, so
     # use class variables
     voltage_limits = [None, None, 0.0] # speaker max, device max, device min
@@ -39,11 +49,12 @@ class StimulusModel():
         # reference for what voltage == what intensity
         self.calv = None
         self.caldb = None
-        self.impulseResponse = None
 
         self._attenuationVector = None
         self._calFrequencies = None
         self._calFrange = None
+        # identifies the calibration filter contents, for the signal cache
+        self._calibrationId = None
 
         self.stimid = uuid.uuid1()
 
@@ -105,25 +116,18 @@ class StimulusModel():
 
             logger.debug('setting calibration with samplerate {}'.format(self.samplerate()))
             fs = self.samplerate()
-            if fs in StimulusModel.kernelCache:
-                logger.debug('---->using cached filter')
-                # makes the assumption that the cache will be cleared if the frequency reponse
-                # changes
-                self.impulseResponse = StimulusModel.kernelCache[fs]
-            else:
-                logger.debug('---->calculating new filter for fs {}'.format(fs))
-                self.impulseResponse = impulse_response(fs, dbBoostArray, frequencies, frange)
-                # mutable type so will affect data structure persistently
-                StimulusModel.kernelCache[fs] = self.impulseResponse
+            # the filter is worked out in the background, and only waited
+            # for when a signal is generated with it
+            StimulusModel.kernelCache.prefetch(fs, dbBoostArray, frequencies, frange)
+            # also for the default samplerate, since we are very likely to
+            # need it, and it's better to have this done up front, than
+            # cause lag in the UI later
+            if fs != DEFAULT_SAMPLERATE:
+                StimulusModel.kernelCache.prefetch(DEFAULT_SAMPLERATE, dbBoostArray, frequencies, frange)
 
             # store this so we can quickly check if a calibration needs to be re-done    
             self._calibration_fs = fs
-            
-            # calculate for the default samplerate, if not already, since
-            # we are very likely to need it, and it's better to have this done
-            # up front, than cause lag in the UI later
-            if DEFAULT_SAMPLERATE not in StimulusModel.kernelCache:
-                StimulusModel.kernelCache[DEFAULT_SAMPLERATE] = impulse_response(DEFAULT_SAMPLERATE, dbBoostArray, frequencies, frange)
+            self._calibrationId = kernel_key(fs, dbBoostArray, frequencies, frange)
 
             # hang on to these for re-calculating impulse response on samplerate change
             self._attenuationVector = dbBoostArray
@@ -131,7 +135,16 @@ class StimulusModel():
             self._calFrange = frange
 
         else:
-            self.impulseResponse = None
+            self._calibrationId = None
+
+    @property
+    def impulseResponse(self):
+        """The calibration filter kernel applied to the output signal, or
+        None if there is no calibration"""
+        if self._calibrationId is None:
+            return None
+        return StimulusModel.kernelCache.kernel(self._calibration_fs, self._attenuationVector,
+                                                self._calFrequencies, self._calFrange)
 
     def updateCalibration(self):
         """Updates the current calibration according to intenal values. For example, if the stimulus samplerate changes
@@ -141,8 +154,18 @@ class StimulusModel():
 
     @staticmethod
     def clearCache():
-        """clears the calibration filters stored in the cache"""
-        StimulusModel.kernelCache = {}
+        """clears the calibration filters, and the signals made with them, 
+        stored in the cache"""
+        StimulusModel.kernelCache.clear()
+        StimulusModel.signalCache.clear()
+
+    @staticmethod
+    def signalCacheStats():
+        """Usage of the cache of generated signals, shared by all stimuli
+
+        :returns: dict -- see :meth:`LRUCache.stats<sparkle.tools.cache.LRUCache.stats>`
+        """
+        return StimulusModel.signalCache.stats()
 
     def samplerate(self):
         """Returns the generation rate for this stimulus
@@ -398,6 +421,21 @@ class StimulusModel():
         :type args: list
         :returns: list<results of *func*>, one for each trace
         """
+        params, varylist = self._expansionSteps()
+        # now create the stimuli according to steps
+        # go through list of modifing parameters, update this stimulus,
+        # and then save current state to list
+        stim_list = []
+        for values in varylist:
+            self._applyExpansion(params, values)
+            stim_list.append(func(*args))
+
+        # now reset the components to start value
+        self._resetExpansion(params, varylist[0])
+
+        return stim_list
+
+    def _expansionSteps(self):
         # initilize array to hold all varied parameters
         params = self._autoParams.allData()
 
@@ -412,33 +450,34 @@ class StimulusModel():
                 idx = (itrace / x) % len(step_set)
                 varylist[itrace][iset] = step_set[idx]
             x = x*len(step_set)
-        # now create the stimuli according to steps
-        # go through list of modifing parameters, update this stimulus,
-        # and then save current state to list
-        stim_list = []
-        for itrace in range(ntraces):
-            for ip, param in enumerate(params):
-                for component in param['selection']:
-                    # print 'setting component {} parameter {} to {}'.format(component.name, param['parameter'], varylist[itrace][ip])
-                    
-                    # so I encountered a bug when the parameters were dragged the
-                    # pickling/unpickling seems to either make a copy or somehow
-                    # otherwise loose connection to the original components
-                    # make sure to be setting the components that are in this model.
-                    index = self.indexByComponent(component)
-                    component = self.component(*index)
-
-                    component.set(param['parameter'], varylist[itrace][ip])
-            # copy of current stim state, or go ahead and turn it into a signal?
-            # so then would I want to formulate some doc here as well?
-            stim_list.append(func(*args))
+        return params, varylist
 
-        # now reset the components to start value
+    def _applyExpansion(self, params, values):
         for ip, param in enumerate(params):
             for component in param['selection']:
-                component.set(param['parameter'], varylist[0][ip])
+                # so I encountered a bug when the parameters were dragged the
+                # pickling/unpickling seems to either make a copy or somehow
+                # otherwise loose connection to the original components
+                # make sure to be setting the components that are in this model.
+                index = self.indexByComponent(component)
+                component = self.component(*index)
 
-        return stim_list
+                component.set(param['parameter'], values[ip])
+
+    def _resetExpansion(self, params, values):
+        for ip, param in enumerate(params):
+            for component in param['selection']:
+                component.set(param['parameter'], values[ip])
+
+    def _expandedTrace(self):
+        # the signal and doc for the current state of the components.
+        # Generated directly, not through the signal cache: each trace of
+        # an expansion is used once, so caching would only hold on to them
+        assert None not in self.voltage_limits, 'Max voltage level not set'
+        signal, atten, overload = self._generateSignal(self.samplerate())
+        doc = self.componentDoc()
+        doc['overloaded_attenuation'] = overload
+        return (signal, atten), doc, overload
 
     def setReorderFunc(self, func, name=None):
         """Sets the function that reorders the expanded signals of this stimulus
@@ -462,16 +501,10 @@ class StimulusModel():
         logger = logging.getLogger('main')
         logger.debug("Generating Expanded Stimulus")
 
-        # 3 loops now -- could be done in one...
-        signals = self.expandFunction(self.signal)
-        docs = self.expandFunction(self.componentDoc)
-        overloads = []
-        for s, d in zip(signals, docs):
-            d['overloaded_attenuation'] = s[2]
-            overloads.append(s[2])
-
-        # remove the undesired attenuation argument
-        signals = [sig[0:2] for sig in signals]
+        traces = self.expandFunction(self._expandedTrace)
+        signals = [trace[0] for trace in traces]
+        docs = [trace[1] for trace in traces]
+        overloads = [trace[2] for trace in traces]
 
         if self.reorder:
             order = self.reorder(docs)
@@ -480,6 +513,37 @@ class StimulusModel():
 
         return signals, docs, overloads
 
+    def expandedStimStream(self, prefetch=2):
+        """
+        Same as :meth:`expandedStim`, but instead of generating every 
+        stimulus up front, they are generated in the background as they 
+        are used, at most *prefetch* ahead.
+
+        The components of this stimulus are changed while generating, so 
+        it should not be used for anything else until the stream is done, 
+        or closed.
+
+        :param prefetch: How many stimuli to generate ahead of their use
+        :type prefetch: int
+        :returns: :class:`ExpandedStimStream` -- iterable of (signal, doc, undesired attenuation) for each trace
+        """
+        logger = logging.getLogger('main')
+        logger.debug("Streaming Expanded Stimulus")
+
+        params, varylist = self._expansionSteps()
+        start_values = varylist[0]
+        if self.reorder:
+            # docs are quick to make, only signals are generated in the background
+            docs = []
+            for values in varylist:
+                self._applyExpansion(params, values)
+                docs.append(self.componentDoc())
+            self._resetExpansion(params, start_values)
+            order = self.reorder(docs)
+            varylist = [varylist[i] for i in order]
+
+        return ExpandedStimStream(self, params, varylist, start_values, prefetch)
+
     def templateDoc(self):
         """JSON serializable template to will all necessary details to recreate this 
         stimulus in another session.
@@ -578,6 +642,18 @@ class StimulusModel():
             samplerate = force_fs
         else:
             samplerate = self.samplerate()
+
+        key = content_key(self.componentDoc(), samplerate, self.caldb, self.calv,
+                          self.voltage_limits, self._calibrationId)
+        cached = StimulusModel.signalCache.get(key)
+        if cached is None:
+            cached = self._generateSignal(samplerate)
+            StimulusModel.signalCache.put(key, cached)
+        total_signal, atten, undesired_attenuation = cached
+        # copy, so callers can't change what is cached
+        return total_signal.copy(), atten, undesired_attenuation
+
+    def _generateSignal(self, samplerate):
         track_signals = []
         max_db = max([comp.intensity() for t in self._segments for comp in t])
         # atten = self.caldb - max_db
@@ -607,7 +683,10 @@ class StimulusModel():
         if 'silence' in component_names:
             component_names.remove('silence')
         if len(component_names) > 1 or (len(component_names) == 1 and component_names[0] != "Square Wave"):
-            total_signal = convolve_filter(total_signal, self.impulseResponse)
+            if self._calibrationId is not None:
+                calibration_filter = StimulusModel.kernelCache.filter(self._calibration_fs, self._attenuationVector,
+                                                                      self._calFrequencies, self._calFrange)
+                total_signal = calibration_filter.filter(total_signal, out=total_signal)
             maxv = self.voltage_limits[0]
             to_speaker = True
         else:
@@ -726,17 +805,59 @@ class StimulusModel():
         return 0
 
     def verifyExpanded(self, samplerate):
-        """Checks the expanded parameters for invalidating conditions
+        """Checks the expanded parameters for invalidating conditions. 
+        Rather than expanding the stimulus, each component is checked with 
+        the extreme values of its auto-parameters, on a copy, so the 
+        components of this stimulus are left untouched.
 
         :param samplerate: generation samplerate (Hz), passed on to component verification
         :type samplerate: int
         :returns: str -- error message, if any, 0 otherwise"""
-        results = self.expandFunction(self.verifyComponents, args=(samplerate,))
-        msg = [x for x in results if x]
-        if len(msg) > 0:
-            return msg[0]
-        else:
-            return 0
+        varied = self._variedValues()
+        for row, track in enumerate(self._segments):
+            for col, component in enumerate(track):
+                comp_params = varied.get((row, col), {})
+                names = comp_params.keys()
+                choices = [_extremes(comp_params[name]) for name in names]
+                for values in itertools.product(*choices):
+                    candidate = copy.copy(component)
+                    for name, value in zip(names, values):
+                        candidate.set(name, value)
+                    msg = candidate.verify(samplerate=samplerate)
+                    if msg:
+                        return msg
+        return 0
+
+    def _variedValues(self):
+        # the values each component's auto-parameters will take, by component
+        # index then parameter type. Where more than one auto-parameter sets the
+        # same thing, the last one is what gets used.
+        varied = {}
+        for param, values in zip(self._autoParams.allData(), self.autoParamRanges()):
+            for component in param['selection']:
+                index = self.indexByComponent(component)
+                if index is not None:
+                    varied.setdefault(index, {})[param['parameter']] = values
+        return varied
+
+    def maxExpandedDuration(self):
+        """The duration of the longest stimulus the auto-parameters will 
+        produce, worked out from the parameter ranges, without expanding
+
+        :returns: float -- duration in seconds
+        """
+        varied = self._variedValues()
+        durs = []
+        for row, track in enumerate(self._segments):
+            total = 0
+            for col, component in enumerate(track):
+                values = varied.get((row, col), {}).get('duration')
+                if values is None:
+                    total += component.duration()
+                else:
+                    total += max(values)
+            durs.append(total)
+        return max(durs)
 
     def verifyComponents(self, samplerate):
         """Checks the current components for invalidating conditions
@@ -767,10 +888,7 @@ class StimulusModel():
         if self.traceCount() == 0:
             return "Test is empty"
         if windowSize is not None:
-            durations = self.expandFunction(self.duration)
-            # print 'windowSize', windowSize, 'self', durations[0],  durations[-1]
-            # ranges are linear, so we only need to test first and last
-            if durations[0] > windowSize or durations[-1] > windowSize:
+            if self.maxExpandedDuration() > windowSize:
                 return "Stimulus duration exceeds window duration"
         msg = self.verifyExpanded(self.samplerate())
         if msg:
@@ -799,6 +917,66 @@ class StimulusModel():
             return False
 
 
+class ExpandedStimStream(object):
+    """Generates the expanded stimuli of a :class:`StimulusModel` on a 
+    separate thread, keeping up to *prefetch* ready ahead of use. Iterate 
+    over it to get the (signal, doc, undesired attenuation) of each trace. 
+    See :meth:`StimulusModel.expandedStimStream`"""
+    def __init__(self, stim, params, varylist, start_values, prefetch):
+        self._ntraces = len(varylist)
+        self._queue = Queue.Queue(prefetch)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._generate, 
+                                        args=(stim, params, varylist, start_values))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        return self._ntraces
+
+    def __iter__(self):
+        for itrace in range(self._ntraces):
+            item = self._queue.get()
+            if isinstance(item, tuple) and len(item) == 1:
+                # error info from the generating thread
+                error = item[0]
+                raise error[0], error[1], error[2]
+            yield item
+
+    def _generate(self, stim, params, varylist, start_values):
+        try:
+            for values in varylist:
+                stim._applyExpansion(params, values)
+                if not self._put(stim._expandedTrace()):
+                    break
+        except:
+            self._put((sys.exc_info(),))
+        finally:
+            stim._resetExpansion(params, start_values)
+
+    def _put(self, item):
+        # wait for room in the queue, unless stopped
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def close(self):
+        """Stops generating stimuli, and waits for the components to be 
+        reset to their start values"""
+        self._stop.set()
+        self._thread.join()
+
+def _extremes(values):
+    # the values that bound a parameter's effect: the smallest and largest 
+    # of numbers, every one of anything else (e.g. file names)
+    if any(isinstance(value, basestring) for value in values):
+        return list(values)
+    return [min(values), max(values)]
+
 def get_component(comp_name, class_list):
     """Returns an implementation of the class refered to by *comp_name* 
     if it is in *class_list*
@@ -1,14 +1,19 @@
 from __future__ import division
 
 import os
+import threading
 import wave
 
 import numpy as np
 import scipy.io.wavfile as wv
 import yaml
-from matplotlib import mlab
 from scipy.interpolate import interp1d
-from scipy.signal import fftconvolve, hann
+from scipy.signal import hann
+
+from sparkle.tools.cache import LRUCache, nbytes_of
+from sparkle.tools.fftbackend import fftconvolve, get_window, irfft, rfft, \
+    rfft_freqs
+from sparkle.tools.stft import STFT
 
 VERBOSE = False
 
@@ -16,6 +21,12 @@ with open(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'settings.con
     config = yaml.load(yf)
 USE_RMS = config['use_rms']
 
+# spectrogram engines, and their buffers, reused for the same parameters,
+# the least recently used are dropped to keep their buffers under this size
+STFT_CACHE_BYTES = 2**26
+_stft_engines = LRUCache(STFT_CACHE_BYTES)
+_stft_lock = threading.Lock()
+
 
 def calc_db(peak, refval, mphonecaldb=0):
     u""" 
@@ -51,19 +62,38 @@ def sum_db(x):
 
 
 def calc_spectrum(signal, rate):
-    """Return the spectrum and frequency indexes for real-valued input signal"""
-    npts = len(signal)
+    """Return the spectrum and frequency indexes for real-valued input signal,
+    or the spectrum of each signal along the last dimension of an array of them"""
+    npts = np.shape(signal)[-1]
     padto = 1 << (npts - 1).bit_length()
     # print 'length of signal {}, pad to {}'.format(npts, padto)
     npts = padto
 
-    sp = np.fft.rfft(signal, n=padto) / npts
+    sp = rfft(signal, n=padto, axis=-1) / npts
     # print('sp len ', len(sp))
-    freq = np.arange((npts / 2) + 1) / (npts / rate)
+    freq = rfft_freqs(npts, rate)
     # print('freq len ', len(freq))
     return freq, abs(sp)
 
 
+def spectrum_peaks(spectrum, freq, frequencies):
+    """Values of spectra at the frequencies nearest to the given ones, e.g.
+    the level of a tone in its recordings
+
+    :param spectrum: a spectrum, or an array of spectra along the last dimension e.g. (traces, reps, frequencies)
+    :type spectrum: numpy.ndarray
+    :param freq: frequencies of the spectrum values, see :func:`calc_spectrum`
+    :type freq: numpy.ndarray
+    :param frequencies: frequency to get the value of, for each spectrum; must broadcast against the spectra e.g. (traces, 1)
+    :type frequencies: float or numpy.ndarray
+    :returns: float or numpy.ndarray -- the values, one for each spectrum
+    """
+    bins = np.abs(freq - np.asarray(frequencies, dtype=float)[..., np.newaxis]).argmin(axis=-1)
+    bins, _ = np.broadcast_arrays(bins, spectrum[..., 0])
+    spectra = spectrum.reshape((-1, spectrum.shape[-1]))
+    return spectra[np.arange(len(spectra)), bins.ravel()].reshape(bins.shape)[()]
+
+
 def make_tone(freq, db, dur, risefall, samplerate, caldb=100, calv=0.1):
     """
     Produce a pure tone signal 
@@ -107,7 +137,7 @@ def make_tone(freq, db, dur, risefall, samplerate, caldb=100, calv=0.1):
     if risefall > 0:
         rf_npts = int(risefall * samplerate) // 2
         # print('amp {}, freq {}, npts {}, rf_npts {}'.format(amp,freq,npts,rf_npts))
-        wnd = hann(rf_npts * 2)  # cosine taper
+        wnd = get_window('hann', rf_npts * 2)  # cosine taper
         tone[:rf_npts] = tone[:rf_npts] * wnd[:rf_npts]
         tone[-rf_npts:] = tone[-rf_npts:] * wnd[rf_npts:]
 
@@ -158,8 +188,9 @@ def make_carrier_tone(freq, db, dur, samplerate, caldb=100, calv=0.1):
 
 def spectrogram(source, nfft=512, overlap=90, window='hanning', caldb=93, calv=2.83):
     """
-    Produce a matrix of spectral intensity, uses matplotlib's specgram
-    function. Output is in dB scale.
+    Produce a matrix of spectral intensity, the same as matplotlib's
+    specgram function would, with :class:`STFT<sparkle.tools.stft.STFT>`.
+    Output is in dB scale.
 
     :param source: filename of audiofile, or samplerate and vector of audio signal
     :type source: str or (int, numpy.ndarray)
@@ -191,22 +222,26 @@ def spectrogram(source, nfft=512, overlap=90, window='hanning', caldb=93, calv=2
     if len(wavdata) > 0 and np.max(abs(wavdata)) != 0:
         wavdata = wavdata / np.max(abs(wavdata))
 
-    if window == 'hanning':
-        winfnc = mlab.window_hanning
-    elif window == 'hamming':
-        winfnc = np.hamming(nfft)
-    elif window == 'blackman':
-        winfnc = np.blackman(nfft)
-    elif window == 'bartlett':
-        winfnc = np.bartlett(nfft)
-    elif window == None or window == 'none':
-        winfnc = mlab.window_none
+    if window is None:
+        window = 'none'
 
     noverlap = int(nfft * (float(overlap) / 100))
 
-    Pxx, freqs, bins = mlab.specgram(wavdata, NFFT=nfft, Fs=fs, noverlap=noverlap,
-                                     pad_to=nfft * 2, window=winfnc, detrend=mlab.detrend_none,
-                                     sides='default', scale_by_freq=False)
+    params = (fs, nfft, noverlap, nfft * 2, window)
+    with _stft_lock:
+        entry = _stft_engines.get(params)
+        if entry is None:
+            entry = (STFT(*params), threading.Lock())
+    engine, engine_lock = entry
+    with engine_lock:
+        # a copy, the engine's buffer is reused
+        Pxx = np.array(engine.compute(wavdata))
+        freqs = engine.freqs()
+        bins = engine.times()
+        nbytes = nbytes_of(vars(engine))
+    with _stft_lock:
+        # stored again, as its buffers grow with the signals given to it
+        _stft_engines.put(params, entry, nbytes)
 
     # log of zero is -inf, which is not great for plotting
     Pxx[Pxx == 0] = np.nan
@@ -270,7 +305,7 @@ def smooth(x, window_len=99, window='hanning'):
     elif window == 'kaiser':
         w = np.kaiser(window_len, 4)
     else:
-        w = eval('np.' + window + '(window_len)')
+        w = get_window(window, window_len)
 
     y = np.convolve(w / w.sum(), s, mode='valid')
     return y[window_len / 2 - 1:len(y) - window_len / 2]
@@ -284,13 +319,164 @@ def convolve_filter(signal, impulse_response):
     if impulse_response is not None:
         # print 'interpolated calibration'#, self.calibration_frequencies
         adjusted_signal = fftconvolve(signal, impulse_response)
-        adjusted_signal = adjusted_signal[
-                          len(impulse_response) / 2:len(adjusted_signal) - len(impulse_response) / 2 + 1]
+        start = len(impulse_response) // 2
+        adjusted_signal = adjusted_signal[start:start + len(signal)]
         return adjusted_signal
     else:
         return signal
 
 
+class OverlapSaveFilter(object):
+    """Convolves signals with a filter kernel block by block, by the
+    overlap-save method, so that only a few block sized buffers are needed
+    however long the signal is. The FFT of the kernel is worked out once,
+    for each block size, and reused.
+
+    :meth:`filter` gives the same output as :func:`convolve_filter`, for a
+    whole signal; :meth:`process` filters a signal that arrives in chunks.
+
+    :param kernel: The filter kernel, e.g. from :func:`impulse_response`
+    :type kernel: numpy.ndarray
+    :param nfft: Size of the FFT for each block, at least the kernel length; the default is 8 times the kernel length, rounded up to a power of two
+    :type nfft: int
+    """
+    def __init__(self, kernel, nfft=None):
+        self.kernel = np.asarray(kernel, dtype=float)
+        if nfft is None:
+            nfft = 8 * (1 << (len(self.kernel) - 1).bit_length())
+        if nfft < len(self.kernel):
+            raise ValueError("FFT size {} is smaller than the filter kernel {}".format(nfft, len(self.kernel)))
+        self.nfft = nfft
+        # samples :meth:`process` output is behind the centred output of :meth:`filter`
+        self.delay = len(self.kernel) // 2
+        self._kernel_ffts = {}
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Starts :meth:`process` over, for a new signal"""
+        self._buffer = np.zeros((self.nfft,))
+
+    def filter(self, signal, out=None):
+        """Filters a whole signal, the same as :func:`convolve_filter`. Does
+        not affect :meth:`process`, and can be used from multiple threads.
+
+        :param signal: the signal to filter
+        :type signal: numpy.ndarray
+        :param out: array to put the result in, which may be *signal* itself, to filter in place
+        :type out: numpy.ndarray
+        :returns: numpy.ndarray -- the filtered signal, the same length as *signal*
+        """
+        npoints = len(signal)
+        if out is None:
+            out = np.empty((npoints,))
+        # no bigger than needed to do the whole signal in one block
+        nfft = min(self.nfft, 1 << (npoints + self.delay + len(self.kernel) - 2).bit_length())
+        self._convolve(np.zeros((nfft,)), signal, self.delay, out)
+        return out
+
+    def process(self, chunk, out=None):
+        """Filters the next chunk of a signal. The output is the causal
+        convolution with the kernel, which is *delay* samples behind the
+        output of :meth:`filter`; to get the same output, drop the first
+        *delay* samples, and follow the signal with *delay* zeros.
+
+        :param chunk: the next samples of the signal
+        :type chunk: numpy.ndarray
+        :param out: array to put the result in, which may be *chunk* itself, to filter in place
+        :type out: numpy.ndarray
+        :returns: numpy.ndarray -- the filtered chunk, the same length as *chunk*
+        """
+        if out is None:
+            out = np.empty((len(chunk),))
+        self._convolve(self._buffer, chunk, 0, out)
+        return out
+
+    def _kernel_fft(self, nfft):
+        with self._lock:
+            if nfft not in self._kernel_ffts:
+                self._kernel_ffts[nfft] = rfft(self.kernel, nfft)
+            return self._kernel_ffts[nfft]
+
+    def _convolve(self, buf, signal, delay, out):
+        # buf holds the last len(kernel) - 1 input samples at its start.
+        # Runs signal, followed by delay zeros, through the filter, and puts
+        # the convolution, from its delay'th sample on, in out
+        nfft = len(buf)
+        nhistory = len(self.kernel) - 1
+        step = nfft - nhistory
+        kernel_fft = self._kernel_fft(nfft)
+        npoints = len(signal)
+        total = npoints + delay
+        pos = 0
+        while pos < total:
+            nblock = min(step, total - pos)
+            nin = min(nblock, max(0, npoints - pos))
+            # copied before out is written, which may be signal
+            buf[nhistory:nhistory + nin] = signal[pos:pos + nin]
+            buf[nhistory + nin:] = 0
+            block = irfft(rfft(buf) * kernel_fft, nfft)
+            # the first delay samples of the convolution are dropped
+            start = max(pos, delay)
+            if start < pos + nblock:
+                out[start - delay:pos + nblock - delay] = block[nhistory + start - pos:nhistory + nblock]
+            buf[:nhistory] = buf[nblock:nblock + nhistory].copy()
+            pos += nblock
+
+
+class RunningStats(object):
+    """Mean and variance, sample by sample, of a series of signals, kept
+    up to date as each signal is added (Welford's method), so the signals
+    themselves do not have to be kept, or read back, to average them.
+
+    :param shape: shape of the signals e.g. (samples,)
+    :type shape: int or tuple
+    """
+    def __init__(self, shape):
+        self.shape = shape
+        self._mean = np.zeros(shape)
+        self._m2 = np.zeros(shape)
+        self._delta = np.zeros(shape)
+        self.reset()
+
+    def reset(self):
+        """Starts over, with no signals"""
+        #: number of signals added
+        self.count = 0
+        self._mean[...] = 0
+        self._m2[...] = 0
+
+    def add(self, signal):
+        """Adds the next signal
+
+        :param signal: signal the same shape as the others
+        :type signal: numpy.ndarray
+        """
+        self.count += 1
+        # worked out in place, in buffers reused for every signal
+        np.subtract(signal, self._mean, out=self._delta)
+        self._mean += self._delta / self.count
+        self._m2 += self._delta * (signal - self._mean)
+
+    def mean(self):
+        """Mean of the signals added
+
+        :returns: numpy.ndarray -- the mean, sample by sample
+        """
+        return self._mean.copy()
+
+    def variance(self, ddof=0):
+        """Variance of the signals added, as numpy.var
+
+        :param ddof: Delta degrees of freedom; the sum of squares is divided by the number of signals less this
+        :type ddof: int
+        :returns: numpy.ndarray -- the variance, sample by sample
+        """
+        if self.count - ddof <= 0:
+            return np.zeros(self.shape)
+        return self._m2 / (self.count - ddof)
+
+
 def impulse_response(genrate, fresponse, frequencies, frange, filter_len=2 ** 14, db=True):
     """
     Calculate filter kernel from attenuation vector.
@@ -331,7 +517,7 @@ def impulse_response(genrate, fresponse, frequencies, frange, filter_len=2 ** 14
 
     freq_response = freq_response[:fmax]
 
-    impulse_response = np.fft.irfft(freq_response)
+    impulse_response = irfft(freq_response)
 
     # rotate to create causal filter, and truncate
     impulse_response = np.roll(impulse_response, len(impulse_response) // 2)
@@ -368,11 +554,11 @@ def attenuation_curve(signal, resp, fs, calf, smooth_pts=99):
 
     # frequencies present in calibration spectrum
     npts = len(y)
-    fq = np.arange(npts / 2 + 1) / (float(npts) / fs)
+    fq = rfft_freqs(npts, fs)
 
     # convert time signals to frequency domain
-    Y = np.fft.rfft(y)
-    X = np.fft.rfft(x)
+    Y = rfft(y)
+    X = rfft(x)
 
     # take the magnitude of signals
     Ymag = np.sqrt(Y.real ** 2 + Y.imag ** 2)  # equivalent to abs(Y)
@@ -408,11 +594,11 @@ def calibrate_signal(signal, resp, fs, frange):
 
     y = resp
     # y = y/np.amax(y) # normalize
-    Y = np.fft.rfft(y)
+    Y = rfft(y)
 
     x = signal
     # x = x/np.amax(x) # normalize
-    X = np.fft.rfft(x)
+    X = rfft(x)
 
     H = Y / X
 
@@ -424,7 +610,7 @@ def calibrate_signal(signal, resp, fs, frange):
 
     A = X / H
 
-    return np.fft.irfft(A)
+    return irfft(A)
 
 
 def multiply_frequencies(signal, fs, frange, calibration_frequencies, attendB):
@@ -433,10 +619,10 @@ def multiply_frequencies(signal, fs, frange, calibration_frequencies, attendB):
     npts = len(signal)
     padto = 1 << (npts - 1).bit_length()
 
-    X = np.fft.rfft(signal, n=padto)
+    X = rfft(signal, n=padto)
 
     npts = padto
-    f = np.arange((npts / 2) + 1) / (npts / fs)
+    f = rfft_freqs(npts, fs)
 
     fidx_low = (np.abs(f - frange[0])).argmin()
     fidx_high = (np.abs(f - frange[1])).argmin()
@@ -461,7 +647,7 @@ def multiply_frequencies(signal, fs, frange, calibration_frequencies, attendB):
     # print 'X max', np.amax(abs(X))
     # print 'Xadjusted max', np.amax(abs(Xadjusted))
 
-    signal_calibrated = np.fft.irfft(Xadjusted)
+    signal_calibrated = irfft(Xadjusted)
     return signal_calibrated[:len(signal)]
 
 
@@ -527,34 +713,51 @@ def audiorate(filename):
 
 
 def rms(signal, fs):
-    """Returns the root mean square (RMS) of the given *signal*
+    """Returns the root mean square (RMS) of the given *signal*, or of
+    each signal along the last dimension of an array of them
 
-    :param signal: a vector of electric potential
+    :param signal: a vector of electric potential, or an array of vectors e.g. (reps, samples)
     :type signal: numpy.ndarray
     :param fs: samplerate of the signal (Hz)
     :type fs: int
-    :returns: float -- the RMS value of the signal
+    :returns: float -- the RMS value of the signal; or numpy.ndarray of the RMS of each signal
     """
+    signal = np.asarray(signal, dtype=float)
     # if a signal contains a some silence, taking the RMS of the whole
     # signal will be calculated as less loud as a signal without a silent
     # period. I don't like this, so I am going to chunk the signals, and
     # take the value of the most intense chunk
     chunk_time = 0.001  # 1 ms chunk
     chunk_samps = int(chunk_time * fs)
-    amps = []
     if chunk_samps > 10:
-        for i in range(0, len(signal) - chunk_samps, chunk_samps):
-            amps.append(np.sqrt(np.mean(pow(signal[i:i + chunk_samps], 2))))
-        amps.append(np.sqrt(np.mean(pow(signal[len(signal) - chunk_samps:], 2))))
-        return np.amax(amps)
+        npoints = signal.shape[-1]
+        # whole chunks from the start, that end before the last sample...
+        nchunks = max(0, -(-(npoints - chunk_samps) // chunk_samps))
+        chunks = signal[..., :nchunks*chunk_samps].reshape(signal.shape[:-1] + (nchunks, chunk_samps))
+        # ...and the last chunk_samps samples
+        last = signal[..., npoints - chunk_samps:]
+        power = np.empty(signal.shape[:-1] + (nchunks + 1,))
+        power[..., :-1] = np.einsum('...ij,...ij->...i', chunks, chunks) / chunk_samps
+        power[..., -1] = np.mean(last*last, axis=-1)
+        return np.sqrt(np.amax(power, axis=-1))
     else:
         # samplerate low, just rms the whole thing
-        return np.sqrt(np.mean(pow(signal, 2)))
+        return np.sqrt(np.mean(signal*signal, axis=-1))
 
 
 def signal_amplitude(signal, fs):
+    """Returns the amplitude of the given *signal*, as its RMS or peak
+    value, depending on the use_rms setting, or the amplitude of each
+    signal along the last dimension of an array of them
+
+    :param signal: a vector of electric potential, or an array of vectors e.g. (reps, samples)
+    :type signal: numpy.ndarray
+    :param fs: samplerate of the signal (Hz)
+    :type fs: int
+    :returns: float -- the signal amplitude; or numpy.ndarray of the amplitude of each signal
+    """
     if USE_RMS:
         amp = rms(signal, fs)
     else:
-        amp = np.amax(abs(signal))
+        amp = np.amax(abs(signal), axis=-1)
     return amp
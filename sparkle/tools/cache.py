@@ -0,0 +1,125 @@
+import collections
+import hashlib
+import json
+import threading
+
+import numpy as np
+
+from sparkle.tools.util import convert2native
+
+
+class LRUCache(object):
+    """Holds on to values up to a total size in bytes, discarding the least
+    recently used values to make room for new ones. Safe to use from
+    multiple threads.
+
+    :param maxbytes: The most memory the cached values may take up
+    :type maxbytes: int
+    """
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """Gets the value stored for *key*, and marks it as most recently used
+
+        :param key: the value's key
+        :param default: returned if there is nothing stored for *key*
+        :returns: the cached value, or *default*
+        """
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return default
+            value, nbytes = self._items.pop(key)
+            self._items[key] = (value, nbytes)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, nbytes=None):
+        """Stores *value* under *key*, discarding old values as needed to
+        stay under *maxbytes*. Values larger than *maxbytes* are not stored.
+
+        :param key: hashable key
+        :param value: value to store
+        :param nbytes: size of the value, if not given it is worked out from the numpy arrays in *value*
+        :type nbytes: int
+        """
+        if nbytes is None:
+            nbytes = nbytes_of(value)
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+            if nbytes > self.maxbytes:
+                return
+            while self.nbytes + nbytes > self.maxbytes:
+                old_key, (old_value, old_nbytes) = self._items.popitem(last=False)
+                self.nbytes -= old_nbytes
+                self.evictions += 1
+            self._items[key] = (value, nbytes)
+            self.nbytes += nbytes
+
+    def pop(self, key, default=None):
+        """Removes and returns the value for *key*
+
+        :param key: the value's key
+        :param default: returned if there is nothing stored for *key*
+        """
+        with self._lock:
+            if key not in self._items:
+                return default
+            value, nbytes = self._items.pop(key)
+            self.nbytes -= nbytes
+            return value
+
+    def clear(self):
+        """Discards all stored values, statistics are kept"""
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Usage statistics of this cache
+
+        :returns: dict -- number of hits, misses, evictions, items, and bytes used
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'items': len(self._items),
+                    'nbytes': self.nbytes, 'maxbytes': self.maxbytes}
+
+def nbytes_of(value):
+    """Memory taken up by the numpy arrays in *value*, which may be an array,
+    or a list, tuple or dict holding arrays. Anything else counts as
+    nothing.
+
+    :returns: int -- number of bytes
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    elif isinstance(value, dict):
+        return sum(nbytes_of(item) for item in value.values())
+    elif isinstance(value, (list, tuple)):
+        return sum(nbytes_of(item) for item in value)
+    else:
+        return 0
+
+def content_key(*args):
+    """Makes a key from the contents of JSON serializable arguments (numpy
+    arrays and types allowed), that is the same for equal contents
+
+    :returns: str -- hex digest of the contents
+    """
+    text = json.dumps(convert2native(list(args)), sort_keys=True)
+    return hashlib.sha1(text).hexdigest()
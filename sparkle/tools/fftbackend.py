@@ -0,0 +1,206 @@
+"""Fast Fourier transforms for the audio tools, carried out by the fastest
+library installed: pyFFTW, then scipy.fft, then numpy.
+
+pyFFTW and scipy.fft use multiple threads for large transforms, and reuse
+the plans they make for a transform size. Frequency axes and windows are
+kept in a cache, since the same ones are asked for over and over, e.g.
+for every response of a calibration run. Cached arrays are read-only.
+"""
+
+import multiprocessing
+
+import numpy as np
+from scipy.signal import hann
+
+from sparkle.tools.cache import LRUCache
+
+try:
+    import pyfftw
+    import pyfftw.interfaces.numpy_fft as pyfftw_fft
+    # keep plans between calls
+    pyfftw.interfaces.cache.enable()
+    pyfftw.interfaces.cache.set_keepalive_time(60)
+except ImportError:
+    pyfftw_fft = None
+
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+
+NTHREADS = multiprocessing.cpu_count()
+# transforms smaller than this are not worth spreading over threads
+THREAD_MIN_SIZE = 2**15
+
+WINDOWS = {'hann': hann,
+           'hanning': np.hanning,
+           'hamming': np.hamming,
+           'blackman': np.blackman,
+           'bartlett': np.bartlett,
+           'none': np.ones,
+           }
+
+class NumpyFFT(object):
+    """Transforms done by numpy.fft"""
+    name = 'numpy'
+
+    def rfft(self, x, n=None, axis=-1):
+        return np.fft.rfft(x, n, axis)
+
+    def irfft(self, x, n=None, axis=-1):
+        return np.fft.irfft(x, n, axis)
+
+    def fft(self, x, n=None, axis=-1):
+        return np.fft.fft(x, n, axis)
+
+    def ifft(self, x, n=None, axis=-1):
+        return np.fft.ifft(x, n, axis)
+
+class ScipyFFT(object):
+    """Transforms done by scipy.fft, multithreaded"""
+    name = 'scipy'
+
+    def rfft(self, x, n=None, axis=-1):
+        x = _real(x)
+        return scipy_fft.rfft(x, n, axis, workers=_nthreads(x))
+
+    def irfft(self, x, n=None, axis=-1):
+        x = np.asarray(x, dtype=complex)
+        return scipy_fft.irfft(x, n, axis, workers=_nthreads(x))
+
+    def fft(self, x, n=None, axis=-1):
+        x = np.asarray(x, dtype=complex)
+        return scipy_fft.fft(x, n, axis, workers=_nthreads(x))
+
+    def ifft(self, x, n=None, axis=-1):
+        x = np.asarray(x, dtype=complex)
+        return scipy_fft.ifft(x, n, axis, workers=_nthreads(x))
+
+class PyFFTW(object):
+    """Transforms done by FFTW, multithreaded, through the pyFFTW numpy
+    interface, which keeps plans for reuse"""
+    name = 'pyfftw'
+
+    def rfft(self, x, n=None, axis=-1):
+        x = _real(x)
+        return pyfftw_fft.rfft(x, n, axis, threads=_nthreads(x))
+
+    def irfft(self, x, n=None, axis=-1):
+        x = np.asarray(x, dtype=complex)
+        return pyfftw_fft.irfft(x, n, axis, threads=_nthreads(x))
+
+    def fft(self, x, n=None, axis=-1):
+        x = np.asarray(x, dtype=complex)
+        return pyfftw_fft.fft(x, n, axis, threads=_nthreads(x))
+
+    def ifft(self, x, n=None, axis=-1):
+        x = np.asarray(x, dtype=complex)
+        return pyfftw_fft.ifft(x, n, axis, threads=_nthreads(x))
+
+BACKENDS = [PyFFTW, ScipyFFT, NumpyFFT]
+
+def _nthreads(x):
+    return NTHREADS if x.size >= THREAD_MIN_SIZE else 1
+
+def _real(x):
+    # single precision is kept, to be transformed in single precision
+    x = np.asarray(x)
+    if x.dtype != np.float32:
+        x = np.asarray(x, dtype=float)
+    return x
+
+def available():
+    """Names of the backends that can be used, fastest first
+
+    :returns: list<str> -- backend names
+    """
+    names = []
+    if pyfftw_fft is not None:
+        names.append(PyFFTW.name)
+    if scipy_fft is not None:
+        names.append(ScipyFFT.name)
+    names.append(NumpyFFT.name)
+    return names
+
+def set_backend(name=None):
+    """Chooses the library to do transforms with
+
+    :param name: One of :func:`available`, or None for the fastest
+    :type name: str
+    """
+    global backend
+    names = available()
+    if name is None:
+        name = names[0]
+    if name not in names:
+        raise ValueError("FFT backend {} is not available, choices are {}".format(name, names))
+    backend = [cls for cls in BACKENDS if cls.name == name][0]()
+
+backend = None
+set_backend()
+
+def rfft(x, n=None, axis=-1):
+    """Same as numpy.fft.rfft, with the current backend"""
+    return backend.rfft(x, n, axis)
+
+def irfft(x, n=None, axis=-1):
+    """Same as numpy.fft.irfft, with the current backend"""
+    return backend.irfft(x, n, axis)
+
+def fft(x, n=None, axis=-1):
+    """Same as numpy.fft.fft, with the current backend"""
+    return backend.fft(x, n, axis)
+
+def ifft(x, n=None, axis=-1):
+    """Same as numpy.fft.ifft, with the current backend"""
+    return backend.ifft(x, n, axis)
+
+def fftconvolve(in1, in2):
+    """Full convolution of two vectors, the same as
+    scipy.signal.fftconvolve, with the current backend
+
+    :returns: numpy.ndarray -- the convolution, of length len(in1) + len(in2) - 1
+    """
+    in1 = np.asarray(in1)
+    in2 = np.asarray(in2)
+    nout = len(in1) + len(in2) - 1
+    nfft = 1 << (nout - 1).bit_length()
+    if np.iscomplexobj(in1) or np.iscomplexobj(in2):
+        return ifft(fft(in1, nfft) * fft(in2, nfft))[:nout]
+    return irfft(rfft(in1, nfft) * rfft(in2, nfft), nfft)[:nout]
+
+_cache = LRUCache(2**26)
+
+def rfft_freqs(npts, fs):
+    """Frequencies of the output of an rfft, cached
+
+    :param npts: length of the transform
+    :type npts: int
+    :param fs: samplerate of the signal
+    :type fs: int
+    :returns: numpy.ndarray -- read-only frequencies (Hz)
+    """
+    key = ('freqs', npts, fs)
+    freqs = _cache.get(key)
+    if freqs is None:
+        freqs = np.arange(npts // 2 + 1) / (float(npts) / fs)
+        freqs.flags.writeable = False
+        _cache.put(key, freqs)
+    return freqs
+
+def get_window(name, npts):
+    """A window function, cached
+
+    :param name: One of hann, hanning, hamming, blackman, bartlett, none (rectangular)
+    :type name: str
+    :param npts: length of the window
+    :type npts: int
+    :returns: numpy.ndarray -- read-only window
+    """
+    key = ('window', name, npts)
+    window = _cache.get(key)
+    if window is None:
+        window = np.asarray(WINDOWS[name](npts), dtype=float)
+        window.flags.writeable = False
+        _cache.put(key, window)
+    return window
@@ -2,22 +2,18 @@
 import numpy as np
 
 def refractory(times, refract=0.002):
-	"""Removes spikes in times list that do not satisfy refractor period
-
-	:param times: list(float) of spike times in seconds
-	:type times: list(float)
-	:param refract: Refractory period in seconds
-	:type refract: float
-	:returns: list(float) of spike times in seconds
-
-	For every interspike interval < refract, 
-	removes the second spike time in list and returns the result"""
-	times_refract = []
-	times_refract.append(times[0])
-	for i in range(1,len(times)):
-		if times_refract[-1]+refract <= times[i]:
-			times_refract.append(times[i])        
-	return times_refract
+    """Removes spikes in times list that do not satisfy refractor period
+
+    :param times: spike times in seconds, in order
+    :type times: list(float) or numpy array
+    :param refract: Refractory period in seconds
+    :type refract: float
+    :returns: numpy array of spike times in seconds
+
+    For every interspike interval < refract, 
+    removes the second spike time in list and returns the result"""
+    times = np.asarray(times, dtype=float)
+    return times[_refractory_mask(times, refract)]
 
 def spike_times(signal, threshold, fs, absval=True):
     """Detect spikes from a given signal
@@ -28,7 +24,7 @@ def spike_times(signal, threshold, fs, absval=True):
     :type threshold: float
     :param absval: Whether to apply absolute value to signal before thresholding
     :type absval: bool
-    :returns: list(float) of spike times in seconds
+    :returns: numpy array of spike times in seconds
 
     For every continuous set of points over given threshold, 
     returns the time of the maximum"""
@@ -68,25 +64,165 @@ def spike_times(signal, threshold, fs, absval=True):
     elif len(over) == 1:
         times.append(float(over[0])/fs)
         
-    if len(times)>0:
-    	return refractory(times)
+    return refractory(times)
+
+def batch_spike_indices(data, threshold, fs, absval=True, refract=0.002):
+    """Detect spikes in a whole block of recordings at once, e.g. a data set
+    of dimensions (trace, rep, channel, samples). Each recording (vector
+    along the last dimension) gives the same spikes as :func:`spike_times`,
+    but the work is done over the entire block with array operations,
+    rather than a recording at a time.
+
+    :param data: Spike trace recordings, samples along the last dimension
+    :type data: numpy array
+    :param threshold: Threshold value to determine spikes, either a single value, or one per recording, broadcastable to data.shape[:-1] (e.g. one per channel)
+    :type threshold: float or numpy array
+    :param fs: Samplerate of the recordings
+    :type fs: int
+    :param absval: Whether to apply absolute value to signal before thresholding, either for all, or one per recording, like threshold
+    :type absval: bool or numpy array
+    :param refract: Refractory period in seconds
+    :type refract: float
+    :returns: (numpy.ndarray, numpy.ndarray) -- offsets and spike sample indices.
+    Recordings are numbered in C order of the leading dimensions; the spikes of
+    recording i are indices[offsets[i]:offsets[i+1]]
+    """
+    data = np.asarray(data)
+    nsamples = data.shape[-1]
+    nrecordings = data.size/nsamples if nsamples > 0 else 0
+    signal = data.reshape((nrecordings, nsamples))
+    thresholds = np.empty(data.shape[:-1])
+    thresholds[...] = threshold
+    threshold = thresholds.reshape((nrecordings, 1))
+    absvals = np.empty(data.shape[:-1], dtype=bool)
+    absvals[...] = absval
+    absvals = absvals.ravel()
+
+    # only the points over threshold are looked at after this; find them a
+    # few recordings at a time, which is faster than the whole block at once
+    blockrows = max(1, 2**16/nsamples) if nsamples > 0 else 1
+    absbuf = np.empty((blockrows, nsamples), dtype=signal.dtype)
+    overbuf = np.empty((blockrows, nsamples), dtype=bool)
+    over = [np.zeros(0, dtype=int)]
+    for irow in range(0, nrecordings, blockrows):
+        block = signal[irow:irow+blockrows]
+        nrows = block.shape[0]
+        absrows = absvals[irow:irow+nrows]
+        if absrows.all():
+            block = np.abs(block, out=absbuf[:nrows])
+        elif absrows.any():
+            block = np.where(absrows[:,np.newaxis], np.abs(block), block)
+        np.greater(block, threshold[irow:irow+nrows], out=overbuf[:nrows])
+        over.append(np.flatnonzero(overbuf[:nrows]) + irow*nsamples)
+    over = np.concatenate(over)
+    values = np.asarray(signal.ravel()[over], dtype=float)
+    if absvals.all():
+        values = np.abs(values)
+    elif absvals.any():
+        values = np.where(absvals[over / nsamples], np.abs(values), values)
+
+    # split into continuous sets of points over threshold, in each recording
+    split = np.ones(len(over)+1, dtype=bool)
+    split[1:-1] = np.diff(over) != 1
+    split[np.searchsorted(over, np.arange(nrecordings)*nsamples)] = True
+    bounds, = np.where(split)
+    setstarts = bounds[:-1]
+    lengths = np.diff(bounds)
+    rows = over[setstarts] / nsamples
+
+    # the time of the maximum of each set, not including the last point
+    # (unless it is the only one); ties go to the first point
+    values[bounds[1:][lengths > 1] - 1] = -np.inf
+    if len(setstarts) > 0:
+        maxvals = np.maximum.reduceat(values, setstarts)
+        atmax, = np.where(values == np.repeat(maxvals, lengths))
+        peaks = over[atmax[np.searchsorted(atmax, setstarts)]] - rows*nsamples
     else:
-    	return times
+        peaks = np.zeros(0, dtype=int)
+
+    # matches spike_times, which gives the second point of a two point set,
+    # if it is the first set in a recording that is not a single point
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = rows[1:] != rows[:-1]
+    second = np.zeros(len(rows), dtype=bool)
+    second[1:] = first[:-1] & ~first[1:] & (lengths[:-1] == 1)
+    peaks[(lengths == 2) & (first | second)] += 1
+
+    keep = _refractory_mask(peaks/float(fs), refract, rows)
+    rows = rows[keep]
+    indices = peaks[keep]
+    offsets = np.zeros(nrecordings+1, dtype=int)
+    offsets[1:] = np.cumsum(np.bincount(rows, minlength=nrecordings))
+    return offsets, indices
+
+def _refractory_mask(times, refract, rows=None):
+    """Works out which spikes :func:`refractory` keeps, without going
+    through them one at a time
+
+    :param times: spike times in seconds, in order within each recording
+    :type times: numpy array
+    :param refract: Refractory period in seconds
+    :type refract: float
+    :param rows: Which recording each spike is from, in order, if times holds more than one recording
+    :type rows: numpy array of int
+    :returns: numpy array of bool -- True for the spikes to keep
+    """
+    nspikes = len(times)
+    if nspikes == 0 or (rows is None and not np.any(times[:-1] + refract > times[1:])):
+        # no spikes too close together
+        return np.ones(nspikes, dtype=bool)
+    keep = np.zeros(nspikes, dtype=bool)
+    if rows is None and (times[-1] - times[0])/refract < nspikes/20:
+        # dense enough that few spikes can be kept, step through just those
+        kept = [0]
+        while True:
+            ispike = times.searchsorted(times[kept[-1]] + refract)
+            if ispike == nspikes:
+                break
+            kept.append(ispike)
+        keep[kept] = True
+        return keep
+
+    # the spike kept after each spike is the first one at least refract
+    # later (or the first spike of the next recording)
+    if rows is None:
+        following = np.searchsorted(times, times + refract)
+    else:
+        # complex numbers are ordered by real, then imaginary part, so this
+        # orders by recording, then time
+        keys = np.empty(nspikes, dtype=complex)
+        keys.real = rows
+        keys.imag = times
+        targets = keys.copy()
+        targets.imag = times + refract
+        following = np.searchsorted(keys, targets)
+    following = np.maximum(following, np.arange(1, nspikes+1))
+
+    # follow the chain of kept spikes from the first, doubling the number
+    # of steps taken at once each time around
+    jump = np.append(following, nspikes)
+    kept = np.zeros(1, dtype=int)
+    while True:
+        more = jump[kept]
+        more = more[more < nspikes]
+        if len(more) == 0:
+            break
+        kept = np.concatenate((kept, more))
+        jump = jump[jump]
+    keep[kept] = True
+    return keep
 
 def bin_spikes(spike_times, binsz):
     """Sort spike times into bins
 
     :param spike_times: times of spike instances
-    :type spike_times: list
+    :type spike_times: list or numpy array
     :param binsz: length of time bin to use
     :type binsz: float
-    :returns: list of bin indicies, one for each element in spike_times
+    :returns: numpy array of bin indicies, one for each element in spike_times
     """
-    bins = np.empty((len(spike_times),), dtype=int)
-    for i, stime in enumerate(spike_times):
-        # around to fix rounding errors
-        bins[i] = np.floor(np.around(stime/binsz, 5))
-    return bins
+    # around to fix rounding errors
+    return np.floor(np.around(np.asarray(spike_times)/binsz, 5)).astype(int)
 
 def spike_latency(signal, threshold, fs):
     """Find the latency of the first spike over threshold
@@ -148,16 +284,16 @@ def dataset_spike_counts(dset, threshold, fs):
     """Dataset should be of dimensions (trace, rep, samples)"""
     if len(dset.shape) == 3:
         results = np.zeros(dset.shape[0])
+        # one trace at a time, so that a whole file data set is not read at once
         for itrace in range(dset.shape[0]):
             results[itrace] = count_spikes(dset[itrace], threshold, fs)
         return results
-    elif len(dset.shape == 2):
+    elif len(dset.shape) == 2:
         return count_spikes(dset, threshold, fs)
     else:
         raise Exception("Improper data dimensions")
 
 def count_spikes(dset, threshold, fs):
-    trace_count = 0
-    for irep in range(dset.shape[0]):
-        trace_count += len(spike_times(dset[irep,:], threshold, fs))
-    return trace_count
+    """Total number of spikes in all reps of dataset of dimensions (rep, samples)"""
+    offsets, indices = batch_spike_indices(dset, threshold, fs)
+    return len(indices)
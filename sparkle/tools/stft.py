@@ -0,0 +1,138 @@
+"""Short-time Fourier transform, for spectrograms, that does not need
+matplotlib. Computed in single precision, with buffers that are reused
+from one signal to the next, and able to add to a spectrogram as more of
+a signal comes in.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from sparkle.tools.fftbackend import get_window, rfft, rfft_freqs
+
+
+class STFT(object):
+    """Power spectra of overlapping, windowed, segments of a signal; the
+    same as matplotlib's specgram (psd mode, one-sided, not scaled by
+    frequency), in single precision.
+
+    Samples are added to the end of the signal with :meth:`append`, and
+    only the segments they complete are transformed, so a spectrogram can
+    be kept up to date as a signal comes in.
+
+    :param fs: samplerate of the signal
+    :type fs: int
+    :param nfft: number of samples in each segment
+    :type nfft: int
+    :param noverlap: number of samples each segment overlaps the one before it
+    :type noverlap: int
+    :param pad_to: length each segment is zero padded to for the transform, default *nfft*
+    :type pad_to: int
+    :param window: window applied to each segment, the name of one in :func:`get_window<sparkle.tools.fftbackend.get_window>`, or an array of length *nfft*
+    :type window: str or numpy.ndarray
+    :param block: number of segments to transform at a time
+    :type block: int
+    """
+    def __init__(self, fs, nfft=512, noverlap=0, pad_to=None, window='hanning', block=256):
+        if not 0 <= noverlap < nfft:
+            raise ValueError("Overlap must be at least 0, and less than the segment length {}".format(nfft))
+        self.fs = fs
+        self.nfft = nfft
+        self.step = nfft - noverlap
+        self.pad_to = nfft if pad_to is None else pad_to
+        if isinstance(window, basestring):
+            window = get_window(window, nfft)
+        self.window = np.asarray(window, dtype=np.float32)
+        nfreqs = self.pad_to // 2 + 1
+
+        # power is preserved in each segment, and the one-sided spectrum
+        # has double the power, except for DC (and nfft/2, if nfft is even)
+        self._scale = np.empty((nfreqs,), dtype=np.float32)
+        self._scale[:] = 2. / np.abs(self.window.astype(float)).sum()**2
+        self._scale[0] /= 2
+        if nfft % 2 == 0:
+            self._scale[-1] /= 2
+
+        # windowed segments, zero padded, reused for every block
+        self._segments = np.zeros((block, self.pad_to), dtype=np.float32)
+        self._power = np.empty((block, nfreqs), dtype=np.float32)
+        self.reset()
+
+    def reset(self):
+        """Starts over, for a new signal; buffers are kept"""
+        # samples not yet part of a whole segment
+        self._pending = np.zeros((0,), dtype=np.float32)
+        self.nsegments = 0
+
+    def append(self, samples):
+        """Adds samples to the end of the signal, and transforms the
+        segments they complete
+
+        :param samples: the next samples of the signal
+        :type samples: numpy.ndarray
+        :returns: int -- number of new segments
+        """
+        pending = np.concatenate((self._pending, np.asarray(samples, dtype=np.float32)))
+        if len(pending) < self.nfft:
+            self._pending = pending
+            return 0
+        nnew = 1 + (len(pending) - self.nfft) // self.step
+        self._reserve(self.nsegments + nnew)
+        stride = pending.strides[0]
+        segments = as_strided(pending, shape=(nnew, self.nfft), strides=(self.step*stride, stride))
+        block = len(self._segments)
+        for start in range(0, nnew, block):
+            nblock = min(block, nnew - start)
+            windowed = self._segments[:nblock]
+            np.multiply(segments[start:start + nblock], self.window, out=windowed[:, :self.nfft])
+            spectra = rfft(windowed, axis=-1)
+            power = self._power[self.nsegments + start:self.nsegments + start + nblock]
+            np.multiply(spectra.real, spectra.real, out=power, casting='unsafe')
+            power += spectra.imag**2
+            power *= self._scale
+        self.nsegments += nnew
+        # keep the samples the next segment starts with
+        self._pending = pending[nnew*self.step:].copy()
+        return nnew
+
+    def compute(self, signal):
+        """Spectrogram of a whole signal, same as matplotlib's specgram;
+        a signal shorter than *nfft* is zero padded to make one segment
+
+        :param signal: the signal
+        :type signal: numpy.ndarray
+        :returns: numpy.ndarray -- see :meth:`power`
+        """
+        self.reset()
+        if len(signal) < self.nfft:
+            signal = np.concatenate((signal, np.zeros((self.nfft - len(signal),))))
+        self.append(signal)
+        return self.power()
+
+    def power(self):
+        """Power of each frequency in each segment so far, in a buffer that
+        is reused; copy it to keep it past the next :meth:`append`
+
+        :returns: numpy.ndarray -- float32 array of dimensions (frequencies, segments)
+        """
+        return self._power[:self.nsegments].T
+
+    def freqs(self):
+        """Frequencies of the rows of :meth:`power`
+
+        :returns: numpy.ndarray -- frequencies (Hz)
+        """
+        return rfft_freqs(self.pad_to, self.fs)
+
+    def times(self):
+        """Times of the middle of the segments so far
+
+        :returns: numpy.ndarray -- times (s)
+        """
+        return (np.arange(self.nsegments)*self.step + self.nfft/2.)/self.fs
+
+    def _reserve(self, nsegments):
+        # grows the output buffer by doubling, so appends are cheap
+        if nsegments > len(self._power):
+            power = np.empty((max(nsegments, 2*len(self._power)), self._power.shape[1]), dtype=np.float32)
+            power[:self.nsegments] = self._power[:self.nsegments]
+            self._power = power
@@ -0,0 +1,164 @@
+"""Timing of the stages of acquisition, e.g. generating a stimulus, arming
+the DAQ, reading, processing and saving a response, kept for the most
+recent reps so their distribution can be looked at while, or after,
+running.
+"""
+
+import contextlib
+import ctypes
+import ctypes.util
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+# percentiles given by TimingRecorder.summary
+PERCENTILES = [50, 90, 99]
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _monotonic_clock():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    if sys.platform.startswith('win'):
+        # the performance counter, which does not go backwards
+        return time.clock
+    clock_id = 6 if sys.platform == 'darwin' else 1  # CLOCK_MONOTONIC
+    for libname in [None, ctypes.util.find_library('rt')]:
+        try:
+            clock_gettime = ctypes.CDLL(libname, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        def monotonic():
+            ts = _timespec()
+            if clock_gettime(clock_id, ctypes.byref(ts)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        return monotonic
+    return time.time
+
+#: Current time of a monotonic clock (seconds); only differences between times are meaningful
+monotonic = _monotonic_clock()
+
+class TimingRecorder(object):
+    """Keeps the durations of named stages, in a ring buffer for each, so
+    only the most recent *size* of each are kept. Stages may be recorded
+    from any thread.
+
+    :param size: Number of durations kept for each stage
+    :type size: int
+    """
+    def __init__(self, size=4096):
+        self.size = size
+        self._buffers = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        """Adds a duration of *stage*
+
+        :param stage: Name of the stage e.g. 'read'
+        :type stage: str
+        :param seconds: how long it took
+        :type seconds: float
+        """
+        with self._lock:
+            if stage not in self._buffers:
+                self._buffers[stage] = np.empty((self.size,))
+                self._counts[stage] = 0
+            self._buffers[stage][self._counts[stage] % self.size] = seconds
+            self._counts[stage] += 1
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Records how long the body of a with statement takes, as a
+        duration of *stage*, e.g.::
+
+            with recorder.timer('save'):
+                datafile.append(key, data)
+        """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.record(stage, monotonic() - start)
+
+    def stages(self):
+        """Names of the stages recorded
+
+        :returns: list<str>
+        """
+        with self._lock:
+            return sorted(self._buffers.keys())
+
+    def count(self, stage):
+        """Number of times *stage* has been recorded, including those no
+        longer kept
+
+        :returns: int
+        """
+        with self._lock:
+            return self._counts.get(stage, 0)
+
+    def values(self, stage):
+        """Durations of *stage* kept, oldest first
+
+        :returns: numpy.ndarray -- durations (seconds)
+        """
+        with self._lock:
+            if stage not in self._buffers:
+                return np.empty((0,))
+            count = self._counts[stage]
+            buf = self._buffers[stage]
+            if count <= self.size:
+                return buf[:count].copy()
+            start = count % self.size
+            return np.concatenate((buf[start:], buf[:start]))
+
+    def percentiles(self, stage, q=PERCENTILES):
+        """Percentiles of the durations of *stage* kept
+
+        :param q: Percentiles to work out, 0-100
+        :type q: list<float>
+        :returns: numpy.ndarray -- durations (seconds), NaN if *stage* has not been recorded
+        """
+        values = self.values(stage)
+        if len(values) == 0:
+            return np.zeros((len(q),)) * np.nan
+        return np.percentile(values, q)
+
+    def histogram(self, stage, bins=20):
+        """Histogram of the durations of *stage* kept, see numpy.histogram
+
+        :param bins: Number of bins, or their edges (seconds)
+        :type bins: int or list<float>
+        :returns: numpy.ndarray, numpy.ndarray -- number of durations in each bin, edges of the bins (seconds)
+        """
+        return np.histogram(self.values(stage), bins)
+
+    def summary(self):
+        """Statistics of the durations kept, of every stage
+
+        :returns: dict -- for each stage, a dict of count, mean, max and percentiles p50, p90, p99 (seconds)
+        """
+        summary = {}
+        for stage in self.stages():
+            values = self.values(stage)
+            stats = {'count': len(values), 'mean': float(np.mean(values)),
+                     'max': float(np.amax(values))}
+            for q, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+                stats['p{}'.format(q)] = float(value)
+            summary[stage] = stats
+        return summary
+
+    def reset(self):
+        """Discards all durations recorded"""
+        with self._lock:
+            self._buffers.clear()
+            self._counts.clear()
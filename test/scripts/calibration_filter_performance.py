@@ -0,0 +1,37 @@
+"""Compares filtering stimuli with a calibration kernel, with
+convolve_filter, and the overlap-save filter StimulusModel uses
+"""
+
+import timeit
+
+import numpy as np
+
+from sparkle.tools.audiotools import OverlapSaveFilter, convolve_filter, \
+    impulse_response
+
+############################################################
+# Edit these values as desired
+
+fs = 5e5 # generation samplerate
+filter_len = 2**14 # calibration kernel length
+frange = [2000, 105000] # range to apply calibration to
+DURS = [0.05, 0.2, 1., 5.] # stimulus durations (seconds)
+
+def best_time(func, *args):
+    return min(timeit.repeat(lambda: func(*args), number=1, repeat=5))
+
+if __name__ == "__main__":
+    frequencies = np.linspace(0, fs/2, 2**15)
+    fresponse = np.random.normal(0, 3, frequencies.shape)
+    kernel = impulse_response(fs, fresponse, frequencies, frange, filter_len)
+    osfilter = OverlapSaveFilter(kernel)
+    print 'kernel length {}, block fft size {}'.format(len(kernel), osfilter.nfft)
+
+    print '{:<8}{:>16}{:>16}{:>10}'.format('dur', 'convolve_filter', 'overlap-save', 'speedup')
+    for dur in DURS:
+        signal = np.random.normal(0, 1, (int(dur*fs),))
+        assert np.allclose(osfilter.filter(signal), convolve_filter(signal, kernel))
+
+        conv_time = best_time(convolve_filter, signal, kernel)
+        os_time = best_time(osfilter.filter, signal, signal.copy())
+        print '{:<8}{:>14.3f}ms{:>14.3f}ms{:>9.1f}x'.format(dur, conv_time*1e3, os_time*1e3, conv_time/os_time)
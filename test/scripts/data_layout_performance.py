@@ -0,0 +1,82 @@
+"""Compares the storage layouts for finite data sets, for write throughput,
+random single rep read time, and file size
+"""
+
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from sparkle.data.hdf5data import HDF5Data
+
+############################################################
+# Edit these values as desired
+
+ntraces = 20 # no. of traces in the test
+nreps = 10 # no. of reps for each trace
+nchans = 1 # no. of recording channels
+dur = 0.2 # duration of each recording (seconds)
+fs = 5e5 # input samplerate
+nreads = 200 # no. of random reps to read back
+
+# name : keyword arguments for HDF5Data.set_layout
+LAYOUTS = [('contiguous float32', {}),
+           ('chunked float32', {'chunked': True}),
+           ('chunked float64', {'chunked': True, 'dtype': 'float64'}),
+           ('int16', {'chunked': True, 'dtype': 'int16'}),
+           ('lzf', {'compression': 'lzf'}),
+           ('lzf shuffle', {'compression': 'lzf', 'shuffle': True}),
+           ('gzip 4 shuffle', {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True}),
+           ('int16 gzip 4 shuffle', {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True, 'dtype': 'int16'}),
+           ('gzip 1 shuffle', {'compression': 'gzip', 'compression_opts': 1, 'shuffle': True}),
+           ('gzip 1 trace chunks', {'chunks': (100, 100, 2**20), 'compression': 'gzip',
+                                    'compression_opts': 1, 'shuffle': True}),
+           ]
+
+def fake_response(npts):
+    # noise with a few spikes, roughly like a recording
+    response = np.random.normal(0, 0.005, (nchans, npts))
+    spike_idxs = np.random.randint(0, npts-20, 10)
+    for idx in spike_idxs:
+        response[:, idx:idx+20] += 0.1*np.hanning(20)
+    return response
+
+def run_layout(fname, layout, responses):
+    npts = responses[0].shape[-1]
+    acq_data = HDF5Data(fname)
+    acq_data.set_layout(**layout)
+    acq_data.init_data('segment_1', dims=(ntraces, nreps, nchans, npts))
+    start = time.time()
+    for itrace in range(ntraces):
+        for irep in range(nreps):
+            acq_data.append('segment_1', responses[(itrace*nreps + irep) % len(responses)])
+    acq_data.hdf5.flush()
+    write_time = time.time() - start
+    acq_data.close()
+
+    acq_data = HDF5Data(fname, filemode='r')
+    indexes = [(random.randrange(ntraces), random.randrange(nreps)) for i in range(nreads)]
+    start = time.time()
+    for index in indexes:
+        acq_data.get_data('segment_1/test_1', index)
+    read_time = (time.time() - start)/nreads
+    acq_data.close()
+
+    return write_time, read_time, os.path.getsize(fname)
+
+if __name__ == "__main__":
+    npts = int(dur*fs)
+    responses = [fake_response(npts) for i in range(10)]
+    nbytes = ntraces*nreps*nchans*npts*np.dtype('float64').itemsize
+
+    tempdir = tempfile.mkdtemp()
+    print '{} traces x {} reps x {} channels x {} samples, {:.1f} MB of float64\n'.format(ntraces, nreps, nchans, npts, nbytes/1e6)
+    print '{:<24}{:>14}{:>16}{:>14}'.format('layout', 'write (MB/s)', 'rep read (ms)', 'size (MB)')
+    for ilayout, (name, layout) in enumerate(LAYOUTS):
+        fname = os.path.join(tempdir, 'layout{}.hdf5'.format(ilayout))
+        write_time, read_time, size = run_layout(fname, layout, responses)
+        os.remove(fname)
+        print '{:<24}{:>14.1f}{:>16.3f}{:>14.1f}'.format(name, nbytes/1e6/write_time, read_time*1e3, size/1e6)
+    os.rmdir(tempdir)
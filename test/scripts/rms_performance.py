@@ -0,0 +1,46 @@
+"""Compares the chunked RMS of audiotools, with the chunk by chunk loop
+it replaced (copied here for reference), for single signals and blocks
+of repetitions
+"""
+
+import timeit
+
+import numpy as np
+
+from sparkle.tools.audiotools import rms
+
+############################################################
+# Edit these values as desired
+
+fs = 5e5 # samplerate
+nreps = 20 # repetitions, for blocks
+DURS = [0.01, 0.2, 1., 5.] # signal durations (seconds)
+
+def loop_rms(signal, fs):
+    chunk_time = 0.001  # 1 ms chunk
+    chunk_samps = int(chunk_time * fs)
+    amps = []
+    if chunk_samps > 10:
+        for i in range(0, len(signal) - chunk_samps, chunk_samps):
+            amps.append(np.sqrt(np.mean(pow(signal[i:i + chunk_samps], 2))))
+        amps.append(np.sqrt(np.mean(pow(signal[len(signal) - chunk_samps:], 2))))
+        return np.amax(amps)
+    else:
+        return np.sqrt(np.mean(pow(signal, 2)))
+
+def best_time(func, *args):
+    return min(timeit.repeat(lambda: func(*args), number=1, repeat=5))
+
+if __name__ == "__main__":
+    print '{:<8}{:>12}{:>12}{:>10}{:>14}{:>12}{:>10}'.format('dur', 'loop', 'rms', 'speedup', 'loop block', 'rms block', 'speedup')
+    for dur in DURS:
+        signals = np.random.normal(0, 1, (nreps, int(dur*fs)))
+        assert np.allclose(rms(signals, fs), [loop_rms(signal, fs) for signal in signals])
+
+        loop_time = best_time(loop_rms, signals[0], fs)
+        rms_time = best_time(rms, signals[0], fs)
+        loop_block_time = best_time(lambda: [loop_rms(signal, fs) for signal in signals])
+        block_time = best_time(rms, signals, fs)
+        print '{:<8}{:>10.3f}ms{:>10.3f}ms{:>9.1f}x{:>12.3f}ms{:>10.3f}ms{:>9.1f}x'.format(dur,
+              loop_time*1e3, rms_time*1e3, loop_time/rms_time,
+              loop_block_time*1e3, block_time*1e3, loop_block_time/block_time)
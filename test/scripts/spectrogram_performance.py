@@ -0,0 +1,59 @@
+"""Compares the STFT engine with matplotlib's specgram, which spectrogram
+used before, for whole signals, and for a signal that comes in a chunk
+at a time (specgram has to start over for every chunk)
+"""
+
+import timeit
+
+import numpy as np
+from matplotlib import mlab
+
+from sparkle.tools.stft import STFT
+
+############################################################
+# Edit these values as desired
+
+fs = 500000 # samplerate
+nfft = 512
+overlap = 90 # percent
+chunk_dur = 0.05 # seconds, for appending
+DURS = [0.01, 0.2, 1.] # signal durations (seconds)
+
+noverlap = int(nfft * (float(overlap) / 100))
+
+def specgram(signal):
+    return mlab.specgram(signal, NFFT=nfft, Fs=fs, noverlap=noverlap,
+                         pad_to=nfft*2, window=mlab.window_hanning, detrend=mlab.detrend_none,
+                         sides='default', scale_by_freq=False)[0]
+
+def specgram_chunks(signal):
+    chunk_samps = int(chunk_dur*fs)
+    for end in range(chunk_samps, len(signal) + chunk_samps, chunk_samps):
+        Pxx = specgram(signal[:end])
+    return Pxx
+
+def stft_chunks(engine, signal):
+    engine.reset()
+    for chunk in np.array_split(signal, range(int(chunk_dur*fs), len(signal), int(chunk_dur*fs))):
+        engine.append(chunk)
+    return engine.power()
+
+def best_time(func, *args):
+    return min(timeit.repeat(lambda: func(*args), number=1, repeat=3))
+
+if __name__ == "__main__":
+    engine = STFT(fs, nfft, noverlap, nfft*2, 'hanning')
+    print '{:<8}{:>12}{:>12}{:>10}{:>16}{:>14}{:>10}'.format('dur', 'specgram', 'stft', 'speedup', 'specgram chunks', 'stft chunks', 'speedup')
+    for dur in DURS:
+        signal = np.random.normal(0, 1, (int(dur*fs),))
+        Pxx = specgram(signal)
+        assert np.allclose(engine.compute(signal), Pxx, rtol=1e-4, atol=1e-9*Pxx.max())
+        assert np.allclose(stft_chunks(engine, signal), Pxx, rtol=1e-4, atol=1e-9*Pxx.max())
+
+        specgram_time = best_time(specgram, signal)
+        stft_time = best_time(engine.compute, signal)
+        specgram_chunks_time = best_time(specgram_chunks, signal)
+        stft_chunks_time = best_time(stft_chunks, engine, signal)
+        print '{:<8}{:>10.3f}ms{:>10.3f}ms{:>9.1f}x{:>14.3f}ms{:>12.3f}ms{:>9.1f}x'.format(dur,
+              specgram_time*1e3, stft_time*1e3, specgram_time/stft_time,
+              specgram_chunks_time*1e3, stft_chunks_time*1e3, specgram_chunks_time/stft_chunks_time)
@@ -0,0 +1,54 @@
+"""Compares spike detection of a recorded data set, a rep at a time with
+spike_times, and all at once with batch_spike_indices
+"""
+
+import time
+
+import numpy as np
+
+from sparkle.tools.spikestats import batch_spike_indices, spike_times
+
+############################################################
+# Edit these values as desired
+
+ntraces = 20 # no. of traces in the test
+nreps = 10 # no. of reps for each trace
+nchans = 2 # no. of recording channels
+dur = 0.2 # duration of each recording (seconds)
+fs = 5e5 # input samplerate
+rate = 100 # average spikes per second
+threshold = 0.05
+
+def fake_data(npts):
+    # noise with spikes, roughly like a recording
+    data = np.random.normal(0, 0.01, (ntraces, nreps, nchans, npts))
+    nspikes = int(rate*dur)
+    spike = 0.1*np.hanning(int(0.001*fs))
+    for recording in data.reshape((-1, npts)):
+        for idx in np.random.randint(0, npts-len(spike), nspikes):
+            recording[idx:idx+len(spike)] += spike
+    return data
+
+if __name__ == "__main__":
+    npts = int(dur*fs)
+    data = fake_data(npts)
+    print '{} traces x {} reps x {} channels x {} samples\n'.format(ntraces, nreps, nchans, npts)
+
+    start = time.time()
+    loop_times = []
+    for itrace in range(ntraces):
+        for irep in range(nreps):
+            for ichan in range(nchans):
+                loop_times.append(spike_times(data[itrace, irep, ichan], threshold, fs))
+    loop_time = time.time() - start
+
+    start = time.time()
+    offsets, indices = batch_spike_indices(data, threshold, fs)
+    batch_time = time.time() - start
+
+    same = all(np.array_equal(indices[offsets[i]:offsets[i+1]]/fs, loop_times[i]) for i in range(len(loop_times)))
+    print 'same spikes found:', same, '({} spikes)'.format(len(indices))
+    print '{:<24}{:>12}'.format('method', 'time (s)')
+    print '{:<24}{:>12.3f}'.format('spike_times loop', loop_time)
+    print '{:<24}{:>12.3f}'.format('batch_spike_indices', batch_time)
+    print 'speedup: {:.1f}x'.format(loop_time/batch_time)
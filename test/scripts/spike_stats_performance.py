@@ -0,0 +1,57 @@
+"""Compares refractory pruning and binning of spike times, with the
+array implementations in spikestats, and the list based implementations
+they replaced (copied here for reference)
+"""
+
+import timeit
+
+import numpy as np
+
+from sparkle.tools.spikestats import bin_spikes, refractory
+
+############################################################
+# Edit these values as desired
+
+dur = 1. # duration of each recording (seconds)
+fs = 5e5 # input samplerate
+binsz = 0.001 # bin size (seconds)
+# no. of threshold crossings in a recording, from sparse to dense
+NSPIKES = [10, 100, 1000, 10000, 50000]
+
+def list_refractory(times, refract=0.002):
+    times_refract = []
+    times_refract.append(times[0])
+    for i in range(1,len(times)):
+        if times_refract[-1]+refract <= times[i]:
+            times_refract.append(times[i])
+    return times_refract
+
+def loop_bin_spikes(spike_times, binsz):
+    bins = np.empty((len(spike_times),), dtype=int)
+    for i, stime in enumerate(spike_times):
+        bins[i] = np.floor(np.around(stime/binsz, 5))
+    return bins
+
+def fake_times(nspikes):
+    # spike times, as from spike_times before refractory pruning
+    idxs = np.unique(np.random.randint(0, int(dur*fs), nspikes))
+    return [float(idx)/fs for idx in idxs]
+
+def best_time(func, *args):
+    return min(timeit.repeat(lambda: func(*args), number=1, repeat=5))
+
+if __name__ == "__main__":
+    print '{:<10}{:>14}{:>14}{:>10}{:>14}{:>14}{:>10}'.format('spikes', 'list refract', 'refractory', 'speedup', 'loop bins', 'bin_spikes', 'speedup')
+    for nspikes in NSPIKES:
+        times = fake_times(nspikes)
+        array_times = np.array(times)
+        assert np.array_equal(refractory(array_times), list_refractory(times))
+        assert np.array_equal(bin_spikes(array_times, binsz), loop_bin_spikes(times, binsz))
+
+        list_time = best_time(list_refractory, times)
+        array_time = best_time(refractory, array_times)
+        loop_bin_time = best_time(loop_bin_spikes, times, binsz)
+        bin_time = best_time(bin_spikes, array_times, binsz)
+        print '{:<10}{:>12.3f}ms{:>12.3f}ms{:>9.1f}x{:>12.3f}ms{:>12.3f}ms{:>9.1f}x'.format(len(times), 
+              list_time*1e3, array_time*1e3, list_time/array_time,
+              loop_bin_time*1e3, bin_time*1e3, loop_bin_time/bin_time)
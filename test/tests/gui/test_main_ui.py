@@ -1,6 +1,5 @@
 import gc
 import glob
-import json
 import logging
 import os
 import re
@@ -13,6 +12,7 @@ import qtbot
 import test.sample as sample
 from sparkle.acq.daq_tasks import get_devices
 from sparkle.QtWrapper import QtCore, QtGui, QtTest
+from sparkle.data.hdf5data import read_trace_stim
 from sparkle.data.open import open_acqdata
 from sparkle.gui.main_control import MainWindow
 from sparkle.gui.stim.abstract_component_editor import AbstractComponentWidget
@@ -162,7 +162,7 @@ class TestMainUI():
         # now check saved data
         hfile = h5py.File(fname, 'r')
         signals = hfile[calname]['signal']
-        stim = json.loads(signals.attrs['stim'])
+        stim = read_trace_stim(signals)
         cal_vector = hfile[calname]['calibration_intensities']
 
         # make sure displayed counts jive with saved file
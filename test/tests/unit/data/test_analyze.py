@@ -0,0 +1,131 @@
+import glob
+import json
+import os
+
+import h5py
+import numpy as np
+from nose.tools import assert_equal, raises
+
+import test.sample as sample
+from sparkle.data.analyze import analyze, save_spikes, Manifest
+from sparkle.data.hdf5data import HDF5Data
+from sparkle.tools.spikestats import batch_spike_indices
+
+tempfolder = os.path.join(os.path.abspath(os.path.dirname(__file__)), u"tmp")
+
+class TestAnalyze():
+    def setUp(self):
+        self.fnames = [os.path.join(tempfolder, 'analyzetemp{}.hdf5'.format(i)) for i in range(2)]
+        self.output = os.path.join(tempfolder, 'analyzeresults.hdf5')
+        self.data = {}
+        for fname in self.fnames:
+            acq_data = HDF5Data(fname)
+            acq_data.init_group('segment_1')
+            acq_data.set_metadata('segment_1', {'samplerate_ad': 1000})
+            for itest in range(2):
+                fakedata = np.random.normal(0, 0.2, (3, 4, 2, 500))
+                acq_data.init_data('segment_1', fakedata.shape)
+                for itrace in range(fakedata.shape[0]):
+                    acq_data.append_trace_info('segment_1', {'trace': itrace})
+                    for irep in range(fakedata.shape[1]):
+                        acq_data.append('segment_1', fakedata[itrace, irep])
+                key = 'segment_1/test_{}'.format(itest+1)
+                self.data[(fname, key)] = acq_data.get_data(key)
+            acq_data.close()
+
+    def tearDown(self):
+        files = glob.glob(os.path.join(tempfolder, 'analyze*'))
+        for f in files:
+            os.remove(f)
+
+    def read_results(self):
+        results = h5py.File(self.output, 'r')
+        columns = dict((name, results[name][:]) for name in results)
+        results.close()
+        return columns
+
+    def test_results(self):
+        ntests = analyze(self.fnames, self.output, 0.4, nprocs=1)
+        assert_equal(ntests, 4)
+
+        results = self.read_results()
+        # a row for each trace and channel
+        assert_equal(len(results['trace']), 4*3*2)
+        for irow in range(len(results['trace'])):
+            data = self.data[(results['file'][irow], results['test'][irow])]
+            recordings = data[results['trace'][irow], :, results['channel'][irow]]
+            offsets, indices = batch_spike_indices(recordings, 0.4, 1000)
+            assert_equal(results['spike_count'][irow], len(indices))
+            assert_equal(results['psth'][irow].sum(), len(indices))
+            assert_equal(len(results['psth'][irow]), 500)
+            assert_equal(results['rate'][irow], len(indices)/4./0.5)
+            if len(indices) > 0:
+                np.testing.assert_almost_equal(results['latency_mean'][irow],
+                    np.mean([indices[offsets[i]] for i in range(4) if offsets[i+1] > offsets[i]])/1000.)
+            assert_equal(json.loads(results['stim'][irow])['trace'], results['trace'][irow])
+
+    def test_processes(self):
+        analyze(self.fnames, self.output, 0.4, nprocs=1)
+        serial = self.read_results()
+        os.remove(self.output)
+        os.remove(self.output + '.manifest')
+        analyze(self.fnames, self.output, 0.4, nprocs=2)
+        parallel = self.read_results()
+
+        # rows may be in a different order
+        key = lambda results, irow: (results['file'][irow], results['test'][irow],
+                                     results['trace'][irow], results['channel'][irow])
+        serial_rows = dict((key(serial, irow), irow) for irow in range(len(serial['trace'])))
+        assert_equal(len(serial_rows), len(parallel['trace']))
+        for irow in range(len(parallel['trace'])):
+            jrow = serial_rows[key(parallel, irow)]
+            assert_equal(parallel['spike_count'][irow], serial['spike_count'][jrow])
+            np.testing.assert_array_equal(parallel['psth'][irow], serial['psth'][jrow])
+
+    def test_resume(self):
+        analyze(self.fnames[:1], self.output, 0.4, nprocs=1)
+        # results saved without making it into the manifest
+        manifest = Manifest(self.output + '.manifest')
+        nrows = manifest.nrows
+        manifest.close()
+        results = h5py.File(self.output, 'a')
+        for name in results:
+            results[name].resize((nrows + 3,))
+        results.close()
+
+        ntests = analyze(self.fnames, self.output, 0.4, nprocs=1)
+        assert_equal(ntests, 2)
+        results = self.read_results()
+        assert_equal(len(results['trace']), 4*3*2)
+        assert_equal(sorted(set(zip(results['file'], results['test']))),
+                     sorted(self.data.keys()))
+
+        # all done
+        assert_equal(analyze(self.fnames, self.output, 0.4, nprocs=1), 0)
+
+    def test_window(self):
+        analyze(self.fnames[:1], self.output, 0.4, window=(0.1, 0.3), nprocs=1)
+        results = self.read_results()
+        assert_equal(results['psth'][0][:100].sum(), 0)
+        assert_equal(results['psth'][0][300:].sum(), 0)
+        assert all(results['latency_mean'][np.isfinite(results['latency_mean'])] >= 0.1)
+
+    @raises(ValueError)
+    def test_different_params_error(self):
+        analyze(self.fnames[:1], self.output, 0.4, nprocs=1)
+        analyze(self.fnames, self.output, 0.3, nprocs=1)
+
+    def test_save_spikes(self):
+        ntests = save_spikes(self.fnames, 0.4, nprocs=2)
+        assert_equal(ntests, 4)
+        for (fname, key), data in self.data.items():
+            acq_data = HDF5Data(fname, filemode='r')
+            counts = acq_data.get_spike_counts(key, 0.4)
+            acq_data.close()
+            for itrace in range(data.shape[0]):
+                offsets, indices = batch_spike_indices(data[itrace], 0.4, 1000)
+                np.testing.assert_array_equal(counts[itrace].flatten(), np.diff(offsets))
+
+    def test_save_spikes_skips_batlab(self):
+        ntests = save_spikes(self.fnames[:1] + [sample.batlabfile() + '.pst'], 0.4, nprocs=2)
+        assert_equal(ntests, 2)
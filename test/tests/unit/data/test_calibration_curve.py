@@ -0,0 +1,79 @@
+import glob
+import os
+
+import numpy as np
+from nose.tools import assert_equal
+
+from sparkle.data.calibration_curve import process_tones, reprocess
+from sparkle.data.hdf5data import HDF5Data
+from sparkle.tools.audiotools import calc_db, calc_spectrum, signal_amplitude
+
+tempfolder = os.path.join(os.path.abspath(os.path.dirname(__file__)), u"tmp")
+
+FS = 100000
+
+def tones(frequencies, nreps, npts=2000):
+    t = np.arange(npts)/float(FS)
+    amps = np.random.uniform(0.1, 1, (len(frequencies), nreps, 1))
+    return amps*np.sin(2*np.pi*np.array(frequencies)[:, np.newaxis, np.newaxis]*t)
+
+def test_process_tones():
+    frequencies = [5000, 15000, 45000]
+    responses = tones(frequencies, 4)
+    freq, spectra, peaks, amps = process_tones(responses, FS, np.array(frequencies)[:, np.newaxis])
+    assert_equal(peaks.shape, (3, 4))
+    assert_equal(amps.shape, (3, 4))
+    # the same as each rep on its own
+    for itrace, f in enumerate(frequencies):
+        for irep in range(4):
+            rep_freq, spectrum = calc_spectrum(responses[itrace, irep], FS)
+            np.testing.assert_array_almost_equal(spectra[itrace, irep], spectrum)
+            assert_equal(peaks[itrace, irep], spectrum[(np.abs(rep_freq-f)).argmin()])
+            assert_equal(amps[itrace, irep], signal_amplitude(responses[itrace, irep], FS))
+
+class TestReprocess():
+    def setUp(self):
+        self.fname = os.path.join(tempfolder, 'calcurvetemp.hdf5')
+        self.frequencies = [5000, 25000, 45000, 5000, 25000, 45000]
+        self.intensities = [90, 90, 90, 100, 100, 100]
+        self.responses = tones(self.frequencies, 3)
+        self.reference = tones([20000], 2)[0]
+
+        acq_data = HDF5Data(self.fname)
+        key = 'calibration_test_1'
+        acq_data.init_group(key, mode='calibration')
+        acq_data.init_data(key, mode='calibration', dims=self.responses.shape)
+        acq_data.init_data(key, mode='calibration', dims=self.reference.shape,
+                           nested_name='reference_tone')
+        acq_data.set_metadata(key, {'samplerate_ad': FS, 'microphone_sensitivity': 0.004,
+                                    'microphone_dB': 94})
+        acq_data.append(key, self.reference, nested_name='reference_tone')
+        acq_data.append_trace_info(key, self.stim(20000, 100), nested_name='reference_tone')
+        for response, f, db in zip(self.responses, self.frequencies, self.intensities):
+            acq_data.append(key, response)
+            acq_data.append_trace_info(key, self.stim(f, db), nested_name='signal')
+        acq_data.close()
+
+    def tearDown(self):
+        for f in glob.glob(os.path.join(tempfolder, 'calcurvetemp*')):
+            os.remove(f)
+
+    def stim(self, f, db):
+        return {'components': [{'stim_type': 'Pure Tone', 'frequency': f, 'intensity': db}]}
+
+    def test_reprocess(self):
+        acq_data = HDF5Data(self.fname, filemode='r')
+        frequencies, intensities, resultdb, attenuations = reprocess(acq_data, 'calibration_test_1')
+        np.testing.assert_array_equal(frequencies, self.frequencies)
+        np.testing.assert_array_equal(intensities, self.intensities)
+
+        levels = np.array([np.mean([signal_amplitude(rep, FS) for rep in trace]) for trace in self.responses])
+        calpeak = np.mean([signal_amplitude(rep, FS) for rep in self.reference])
+        np.testing.assert_array_almost_equal(resultdb, calc_db(levels, 0.004, 94), 4)
+        np.testing.assert_array_almost_equal(attenuations, -calc_db(levels, calpeak), 4)
+
+        # one trace at a time
+        np.testing.assert_array_almost_equal(reprocess(acq_data, 'calibration_test_1', block_size=1)[3], attenuations)
+        # different microphone
+        np.testing.assert_array_almost_equal(reprocess(acq_data, 'calibration_test_1', 0.002, 94)[2], resultdb + 20*np.log10(2), 4)
+        acq_data.close()
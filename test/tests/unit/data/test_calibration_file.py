@@ -0,0 +1,87 @@
+import glob
+import os
+
+import numpy as np
+from nose.tools import assert_equal
+
+import test.sample as sample
+from sparkle.data.calibration_file import CalibrationFile, save_calibration
+from sparkle.data.open import open_acqdata
+from sparkle.stim.kernel_cache import KernelCache, kernel_key
+from sparkle.tools.audiotools import impulse_response
+
+tempfolder = os.path.join(os.path.abspath(os.path.dirname(__file__)), u"tmp")
+
+FRANGE = (5000, 100000)
+
+class TestCalibrationFile():
+    def setUp(self):
+        self.fname = os.path.join(tempfolder, 'calfiletemp.cal')
+        cal_data_file = open_acqdata(sample.calibration_filename(), filemode='r')
+        self.calname = cal_data_file.calibration_list()[0]
+        self.fresponse, self.frequencies = cal_data_file.get_calibration(self.calname, reffreq=15000)
+        cal_data_file.close()
+
+    def tearDown(self):
+        for f in glob.glob(os.path.join(tempfolder, 'calfiletemp*')):
+            os.remove(f)
+
+    def test_save_load(self):
+        save_calibration(self.fname, self.fresponse, self.frequencies, FRANGE, 15000,
+                         samplerates=[100000, 500000], source=self.calname)
+        calibration = CalibrationFile(self.fname)
+        np.testing.assert_array_equal(calibration.fresponse, self.fresponse)
+        np.testing.assert_array_equal(calibration.frequencies, self.frequencies)
+        assert_equal(calibration.frange, FRANGE)
+        assert_equal(calibration.calf, 15000)
+        assert_equal(calibration.source, self.calname)
+        assert_equal(sorted(calibration.kernels.keys()), [100000, 500000])
+        np.testing.assert_array_equal(calibration.kernels[500000],
+                                      impulse_response(500000, self.fresponse, self.frequencies, FRANGE))
+
+        # memory-mapped, not read in
+        assert isinstance(calibration.fresponse.base, np.memmap)
+        assert isinstance(calibration.kernels[100000].base, np.memmap)
+        assert not calibration.kernels[100000].flags.writeable
+
+    def test_save_over_loaded(self):
+        save_calibration(self.fname, self.fresponse, self.frequencies, FRANGE, samplerates=[100000])
+        calibration = CalibrationFile(self.fname)
+        kernel = calibration.kernels[100000].copy()
+        save_calibration(self.fname, np.ones_like(self.fresponse), self.frequencies, FRANGE,
+                         samplerates=[100000])
+        # the calibration already loaded is left as it was
+        np.testing.assert_array_equal(calibration.fresponse, self.fresponse)
+        np.testing.assert_array_equal(calibration.kernels[100000], kernel)
+        np.testing.assert_array_equal(CalibrationFile(self.fname).fresponse, np.ones_like(self.fresponse))
+        # no temporary files left behind
+        assert_equal(glob.glob(os.path.join(tempfolder, '*.tmp')), [])
+
+    def test_default_frange(self):
+        save_calibration(self.fname, self.fresponse, self.frequencies, samplerates=[100000])
+        calibration = CalibrationFile(self.fname)
+        assert_equal(calibration.frange, (self.frequencies[0], self.frequencies[-1]))
+        assert_equal(calibration.calf, None)
+
+    def test_add_kernels(self):
+        save_calibration(self.fname, self.fresponse, self.frequencies, FRANGE,
+                         samplerates=[100000, 500000])
+        calibration = CalibrationFile(self.fname)
+        cache = KernelCache()
+        # kernels for another range are not used
+        calibration.add_kernels(cache, (1000, 50000))
+        assert_equal(cache.stats()['nbytes'], 0)
+
+        calibration.add_kernels(cache)
+        assert cache.kernel(500000, self.fresponse, self.frequencies, FRANGE) is calibration.kernels[500000]
+        assert cache.kernel(100000, self.fresponse, self.frequencies, list(FRANGE)) is calibration.kernels[100000]
+        assert_equal(cache.stats()['misses'], 0)
+
+    def test_same_key(self):
+        save_calibration(self.fname, self.fresponse, self.frequencies, FRANGE, samplerates=[])
+        calibration = CalibrationFile(self.fname)
+        key = kernel_key(100000, self.fresponse, self.frequencies, FRANGE)
+        # the digest of the memory-mapped arrays is kept
+        for i in range(2):
+            assert_equal(kernel_key(100000, calibration.fresponse, calibration.frequencies, FRANGE), key)
+        assert kernel_key(200000, calibration.fresponse, calibration.frequencies, FRANGE) != key
@@ -9,9 +9,11 @@ import h5py
 import numpy as np
 from nose.tools import assert_equal, assert_in, raises
 
-from sparkle.data.hdf5data import HDF5Data, recover_data_from_backup, autosave_filenames
+from sparkle.data.hdf5data import HDF5Data, recover_data_from_backup, \
+    autosave_filenames, read_trace_stim, repack
 from sparkle.tools.exceptions import DataIndexError, DisallowedFilemodeError, \
     OverwriteFileError, ReadOnlyError
+from sparkle.tools.spikestats import batch_spike_indices
 
 tempfolder = os.path.join(os.path.abspath(os.path.dirname(__file__)), u"tmp")
 
@@ -176,6 +178,200 @@ class TestHDF5Data():
         assert hfile.keys() == ['fake', 'fake1']
         hfile.close()
 
+    def test_finite_chunked_compressed(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+        acq_data.set_layout(compression='gzip', compression_opts=4, shuffle=True)
+
+        fakedata = np.random.uniform(-1, 1, (2, 3, 100))
+        acq_data.init_data('fake', (4, 2, 3, 100))
+        acq_data.append('fake', fakedata)
+        acq_data.append('fake', fakedata*2)
+
+        dataset = acq_data.hdf5['fake/test_1']
+        assert_equal(dataset.chunks, (1, 1, 1, 100))
+        assert_equal(dataset.compression, 'gzip')
+        assert dataset.shuffle
+        np.testing.assert_array_almost_equal(acq_data.get_data('fake/test_1', (1, 1)), fakedata[1]*2)
+        acq_data.close()
+
+    def test_finite_chunk_shape(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+        # a chunk per trace, larger than the reps in a trace
+        acq_data.set_layout(chunks=(10, 2, 100))
+
+        fakedata = np.random.uniform(-1, 1, (2, 100))
+        acq_data.init_data('fake', (4, 3, 2, 100))
+        for irep in range(5):
+            acq_data.append('fake', fakedata*irep)
+
+        dataset = acq_data.hdf5['fake/test_1']
+        assert_equal(dataset.chunks, (1, 3, 2, 100))
+        np.testing.assert_array_almost_equal(acq_data.get_data('fake/test_1', (1, 1)), fakedata*4)
+        acq_data.close()
+
+    @raises(ValueError)
+    def test_bad_chunk_shape(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+        try:
+            acq_data.set_layout(chunks=(0, 100))
+        finally:
+            acq_data.close()
+
+    def test_finite_scaled_int16(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+        acq_data.set_layout(compression='lzf', dtype='int16', full_scale=2.0)
+
+        fakedata = np.array([-3.0, -1.0, 0.0, 0.5, 1.99, 2.5])
+        acq_data.init_data('fake', (2, fakedata.shape[0]))
+        acq_data.append('fake', fakedata)
+        acq_data.insert('fake', (1,), fakedata)
+        acq_data.close()
+
+        acq_data = HDF5Data(fname, filemode='r')
+        assert_equal(acq_data.hdf5['fake/test_1'].dtype, np.int16)
+        expected = np.clip(fakedata, -2.0, 2.0)
+        # within half a step of the scale
+        np.testing.assert_allclose(acq_data.get_data('fake/test_1', (0,)), expected, atol=1./32767)
+        np.testing.assert_allclose(acq_data.get_data('fake/test_1')[1], expected, atol=1./32767)
+        acq_data.close()
+
+    def test_calibration_layout(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+        acq_data.set_layout(chunked=True, dtype='float64')
+
+        acq_data.init_group('calibration_1', mode='calibration')
+        acq_data.init_data('calibration_1', (3, 50), mode='calibration')
+        acq_data.init_data('calibration_1', (50,), mode='calibration',
+                           nested_name='calibration_intensities')
+
+        assert_equal(acq_data.hdf5['calibration_1/signal'].chunks, (1, 50))
+        assert_equal(acq_data.hdf5['calibration_1/signal'].dtype, np.float64)
+        # only recorded signals get the layout
+        assert_equal(acq_data.hdf5['calibration_1/calibration_intensities'].chunks, None)
+        acq_data.close()
+
+    def test_finite_trace_buffered(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+
+        nreps = 3
+        fakedata = np.random.uniform(-1, 1, (2, 50))
+        acq_data.init_data('fake', (2, nreps, 2, 50))
+        for irep in range(nreps-1):
+            acq_data.append('fake', fakedata*irep)
+        # nothing written until the trace is filled
+        np.testing.assert_array_equal(acq_data.hdf5['fake/test_1'][0], np.zeros((nreps, 2, 50)))
+        acq_data.append('fake', fakedata*2)
+        np.testing.assert_array_almost_equal(acq_data.hdf5['fake/test_1'][0,2], fakedata*2)
+
+        # unfinished trace is written on flush
+        acq_data.append('fake', fakedata*3)
+        acq_data.flush()
+        np.testing.assert_array_almost_equal(acq_data.hdf5['fake/test_1'][1,0], fakedata*3)
+        acq_data.append('fake', fakedata*4)
+        acq_data.close()
+
+        acq_data = HDF5Data(fname, filemode='r')
+        data = acq_data.get_data('fake/test_1')
+        for irep in range(nreps):
+            np.testing.assert_array_almost_equal(data[0, irep], fakedata*irep)
+        np.testing.assert_array_almost_equal(data[1, 0], fakedata*3)
+        np.testing.assert_array_almost_equal(data[1, 1], fakedata*4)
+        np.testing.assert_array_equal(data[1, 2], np.zeros((2, 50)))
+        acq_data.close()
+
+    def test_finite_buffered_read(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+
+        fakedata = np.ones((10,))
+        acq_data.init_data('fake', (2, 3, 10))
+        acq_data.append('fake', fakedata)
+        np.testing.assert_array_equal(acq_data.get_data('fake/test_1', (0, 0)), fakedata)
+        # a new test writes out the previous
+        acq_data.append('fake', fakedata*2)
+        acq_data.init_data('fake', (2, 3, 10))
+        np.testing.assert_array_equal(acq_data.hdf5['fake/test_1'][0, 1], fakedata*2)
+        acq_data.close()
+
+    @raises(ValueError)
+    def test_bad_layout(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+        try:
+            acq_data.set_layout(compression='szip')
+        finally:
+            acq_data.close()
+
+    def test_spike_index(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data, fakedata = self.setup_spikes(fname)
+        thresholds = [0.5, 0.7]
+
+        assert acq_data.get_spikes('segment_1/test_1', thresholds) is None
+        assert_equal(acq_data.build_spike_index('', thresholds), ['segment_1/test_1'])
+        acq_data.close()
+
+        acq_data = HDF5Data(fname, filemode='r')
+        # saved spikes are not data
+        assert_equal(acq_data.keys(), ['segment_1'])
+        assert_equal(acq_data.dataset_names(), ['segment_1/test_1'])
+
+        offsets, indices = batch_spike_indices(fakedata, thresholds, 1000)
+        saved_offsets, saved_indices = acq_data.get_spikes('segment_1/test_1', thresholds)
+        np.testing.assert_array_equal(saved_offsets, offsets)
+        np.testing.assert_array_equal(saved_indices, indices)
+        counts = acq_data.get_spike_counts('segment_1/test_1', thresholds)
+        np.testing.assert_array_equal(counts, np.diff(offsets).reshape((3, 4, 2)))
+
+        # spikes of a single rep
+        offsets, indices = batch_spike_indices(fakedata[2,1], thresholds, 1000)
+        saved_offsets, saved_indices = acq_data.get_spikes('segment_1/test_1', thresholds, index=(2,1))
+        np.testing.assert_array_equal(saved_offsets, offsets)
+        np.testing.assert_array_equal(saved_indices, indices)
+
+        # not saved for other parameters
+        assert acq_data.get_spikes('segment_1/test_1', thresholds, absval=False) is None
+        assert acq_data.get_spike_counts('segment_1/test_1', 0.5) is None
+        acq_data.close()
+
+    def test_spike_index_polarity(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data, fakedata = self.setup_spikes(fname)
+
+        acq_data.build_spike_index('segment_1', 0.5, absval=False, polarity=[1, -1])
+        offsets, indices = batch_spike_indices(fakedata*np.array([1, -1])[:,np.newaxis], 0.5, 1000, absval=False)
+        saved_offsets, saved_indices = acq_data.get_spikes('segment_1/test_1', 0.5, False, [1, -1])
+        np.testing.assert_array_equal(saved_offsets, offsets)
+        np.testing.assert_array_equal(saved_indices, indices)
+        acq_data.close()
+
+    def test_spike_index_deleted_with_data(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data, fakedata = self.setup_spikes(fname)
+
+        acq_data.build_spike_index('segment_1/test_1', 0.5)
+        acq_data.delete_group('segment_1')
+        assert '.spikes/segment_1' not in acq_data.hdf5
+        acq_data.close()
+
+    @raises(ReadOnlyError)
+    def test_spike_index_read_only_error(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data, fakedata = self.setup_spikes(fname)
+        acq_data.close()
+
+        acq_data = HDF5Data(fname, filemode='r')
+        try:
+            acq_data.build_spike_index('', 0.5)
+        finally:
+            acq_data.close()
+
     def test_open_dataset_append_even_sets(self):
         """
         Test appending to, and consolidating dataset, ending in a 
@@ -232,7 +428,7 @@ class TestHDF5Data():
         acq_data.close()
 
         hfile = h5py.File(fname)
-        stim = json.loads(hfile['fake'].attrs['stim'])
+        stim = read_trace_stim(hfile['fake'])
         assert_equal(stim[0]['duration'], 0.1)
         hfile.close()
 
@@ -251,7 +447,7 @@ class TestHDF5Data():
 
         hfile = h5py.File(fname)
         test = hfile['fake']['test_1']
-        stim = json.loads(test.attrs['stim'])
+        stim = read_trace_stim(test)
         assert_equal(stim[0]['duration'], 0.1)
         hfile.close()
 
@@ -274,7 +470,7 @@ class TestHDF5Data():
 
         hfile = h5py.File(fname)
         test = hfile['fake']
-        stim = json.loads(test.attrs['stim'])
+        stim = read_trace_stim(test)
         assert hfile['fake'].size == nsets*npoints
         assert hfile['fake'][0] == 0
         assert hfile['fake'][-1] == 31
@@ -304,13 +500,67 @@ class TestHDF5Data():
 
         hfile = h5py.File(fname)
         test = hfile['fake']
-        stim = json.loads(test.attrs['stim'])
+        stim = read_trace_stim(test)
         assert hfile['fake'].size == nsets*npoints
         assert hfile['fake'][0] == 0
         assert hfile['fake'][-1] == 31
         assert len(stim) == nsets
         hfile.close()
 
+    def test_trace_info_by_index(self):
+        nsets = 5
+        npoints = 10
+        fakedata = np.ones((npoints,))
+
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+        acq_data.init_data('fake', (nsets, npoints))
+        for iset in range(nsets):
+            acq_data.append('fake', fakedata*iset)
+            acq_data.append_trace_info('fake', {'duration': 0.1, 'trace': iset})
+
+        stims = acq_data.get_trace_stim('fake/test_1')
+        assert_equal([stim['trace'] for stim in stims], range(nsets))
+        assert_equal(acq_data.get_trace_stim('fake/test_1', 3)['trace'], 3)
+        # trace info is bookkeeping, and not listed with the data
+        assert_equal(acq_data.dataset_names(), ['fake/test_1'])
+        assert_equal(acq_data.keys('fake'), ['test_1'])
+        acq_data.close()
+
+    def test_trace_info_from_attribute(self):
+        # files recorded before the trace info journal store a JSON attribute
+        nsets = 3
+        npoints = 10
+
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        hfile = h5py.File(fname, 'w')
+        test = hfile.create_group('fake').create_dataset('test_1', (nsets, npoints))
+        test.attrs['stim'] = json.dumps([{'trace': i} for i in range(nsets)])
+        hfile.close()
+
+        acq_data = HDF5Data(fname, filemode='r')
+        assert_equal(len(acq_data.get_trace_stim('fake/test_1')), nsets)
+        assert_equal(acq_data.get_trace_stim('fake/test_1', 2)['trace'], 2)
+        acq_data.close()
+
+    def test_calibration_trace_info(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+        acq_data.init_group('calibration_1', mode='calibration')
+        acq_data.init_data('calibration_1', (3, 50), mode='calibration')
+        acq_data.init_data('calibration_1', (3, 50), mode='calibration',
+                           nested_name='reference_tone')
+
+        tone = {'components': [{'stim_type': 'Pure Tone'}]}
+        acq_data.append_trace_info('calibration_1', tone)
+        acq_data.append_trace_info('calibration_1', {'components': [{'stim_type': 'FM Sweep'}]})
+        acq_data.append_trace_info('calibration_1', tone, nested_name='signal')
+
+        assert_equal(len(acq_data.get_trace_stim('calibration_1/reference_tone')), 1)
+        stims = acq_data.get_trace_stim('calibration_1/signal')
+        assert_equal([stim['components'][0]['stim_type'] for stim in stims], ['FM Sweep', 'Pure Tone'])
+        acq_data.close()
+
     def test_calibration_data(self):
         npoints = 250000
         caldata = np.ones((npoints,))
@@ -549,6 +799,138 @@ class TestHDF5Data():
         recovered_acqdata.close()
         original_acqdata.close()
 
+    def test_recover_from_unreadable_file(self):
+        nsets = 3
+        npoints = 10
+        fakedata = np.ones((npoints,))
+        acq_data = self.setup_finite(fakedata, nsets)
+        acq_data.set_metadata('fake', {'raindrops': 'roses'})
+        acq_data.append_trace_info('fake', {'duration': 0.1})
+        acq_data.backup()
+
+        original_filename =  acq_data.hdf5.filename
+        acq_data.hdf5.close()
+        # wreck the data file, everything must come from the backups
+        with open(original_filename, 'wb') as wrecked:
+            wrecked.write('not an hdf5 file')
+
+        recovered_acqdata = HDF5Data(original_filename, filemode='a')
+        assert_equal(recovered_acqdata.dataset_names(), ['fake/test_1'])
+        np.testing.assert_array_equal(recovered_acqdata.get_data('fake/test_1', (2,)), fakedata*2)
+        assert_equal(recovered_acqdata.get_info('fake')['raindrops'], 'roses')
+        assert_equal(recovered_acqdata.get_trace_stim('fake/test_1'), [{'duration': 0.1}])
+        assert_in('date', recovered_acqdata.get_info(''))
+        recovered_acqdata.close()
+
+    def test_backup_only_new_data(self):
+        nsets = 3
+        npoints = 10
+        fakedata = np.ones((npoints,))
+        acq_data = self.setup_finite(fakedata, nsets, groupname='segment_1')
+        original_filename =  acq_data.hdf5.filename
+        acq_data.close()
+
+        acq_data = HDF5Data(original_filename, filemode='a')
+        acq_data.init_data('segment_2', (nsets, npoints))
+        acq_data.append('segment_2', fakedata)
+        acq_data.backup()
+
+        backup_dir, backup_filename, prev_backups = autosave_filenames(original_filename)
+        backed_up = []
+        for backup_fname in sorted(prev_backups):
+            backup_file = h5py.File(backup_fname, 'r')
+            backed_up.append([record.attrs['path'] for record in backup_file.values()])
+            backup_file.close()
+        # data already in the file when it was opened is only in the first
+        assert_equal(len(backed_up), 2)
+        assert '/segment_1/test_1' in backed_up[0]
+        assert '/segment_1/test_1' not in backed_up[1]
+        assert '/segment_2/test_2' in backed_up[1]
+        acq_data.close()
+
+    def test_recover_data_from_earlier_session(self):
+        nsets = 3
+        npoints = 10
+        fakedata = np.ones((npoints,))
+        acq_data = self.setup_finite(fakedata, nsets, groupname='segment_1')
+        acq_data.set_metadata('segment_1', {'raindrops': 'roses'})
+        original_filename =  acq_data.hdf5.filename
+        acq_data.close()
+
+        acq_data = HDF5Data(original_filename, filemode='a')
+        acq_data.init_data('segment_2', (nsets, npoints))
+        acq_data.append('segment_2', fakedata)
+        acq_data.backup()
+        acq_data.hdf5.close()
+        # wreck the data file, including what was in it before it was opened
+        with open(original_filename, 'wb') as wrecked:
+            wrecked.write('not an hdf5 file')
+
+        recovered_acqdata = HDF5Data(original_filename, filemode='a')
+        assert_equal(recovered_acqdata.dataset_names(), ['segment_1/test_1', 'segment_2/test_2'])
+        for iset in range(nsets):
+            np.testing.assert_array_equal(recovered_acqdata.get_data('segment_1/test_1', (iset,)), 
+                                          fakedata*iset)
+        np.testing.assert_array_equal(recovered_acqdata.get_data('segment_2/test_2', (0,)), fakedata)
+        assert_equal(recovered_acqdata.get_info('segment_1')['raindrops'], 'roses')
+        recovered_acqdata.close()
+
+    def test_backup_scalar_dataset(self):
+        acq_data = self.setup_finite(np.ones((10,)), 3)
+        acq_data.hdf5.create_dataset('fake/scalar', data=5.)
+        acq_data.hdf5['fake/scalar'].attrs['unit'] = 'V'
+        acq_data.changes.touch('fake/scalar')
+        acq_data.backup()
+        original_filename =  acq_data.hdf5.filename
+        acq_data.hdf5.close()
+        os.remove(original_filename)
+
+        recovered_acqdata = HDF5Data(original_filename, filemode='a')
+        assert_equal(recovered_acqdata.hdf5['fake/scalar'][()], 5.)
+        assert_equal(recovered_acqdata.hdf5['fake/scalar'].attrs['unit'], 'V')
+        recovered_acqdata.close()
+
+    def test_repack_on_close(self):
+        nsets = 10
+        npoints = 10000
+        fakedata = np.ones((npoints,))
+        acq_data = self.setup_deleted_group(fakedata, nsets)
+        assert_equal(acq_data.freed_space, nsets*npoints*4)
+
+        acq_data.repack_threshold = 0
+        fname = acq_data.filename
+        acq_data.close()
+
+        assert os.path.getsize(fname) < nsets*npoints*4*2
+        hfile = h5py.File(fname, 'r')
+        assert hfile.keys() == ['fake']
+        hfile.close()
+
+    def test_repack_skipped(self):
+        nsets = 10
+        npoints = 10000
+        fakedata = np.ones((npoints,))
+        acq_data = self.setup_deleted_group(fakedata, nsets)
+
+        # less than the threshold was deleted
+        fname = acq_data.filename
+        acq_data.close()
+        unpacked_size = os.path.getsize(fname)
+        assert unpacked_size > nsets*npoints*4*2
+
+        # so it can be done later
+        progress = []
+        repack(fname, lambda copied, total: progress.append((copied, total)), buffer_size=npoints*4*3)
+        assert os.path.getsize(fname) < unpacked_size
+        # data copied in blocks of 3 traces
+        assert_equal(len(progress), 4)
+        assert_equal(progress[-1][0], progress[-1][1])
+
+        acq_data = HDF5Data(fname, filemode='r')
+        for iset in range(nsets):
+            np.testing.assert_array_equal(acq_data.get_data('fake/test_2', (iset,)), fakedata*iset)
+        acq_data.close()
+
     def test_data_apocalyse(self):
         # multiple crashes on same file
         nsets = 3
@@ -599,6 +981,30 @@ class TestHDF5Data():
 
         return acq_data
 
+    def setup_deleted_group(self, fakedata, nsets):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+
+        # deleted data must be followed by other data, or the file just shrinks
+        for groupname in ['deleteme', 'fake']:
+            acq_data.init_data(groupname, (nsets, len(fakedata)))
+            for iset in range(nsets):
+                acq_data.append(groupname, fakedata*iset)
+        acq_data.delete_group('deleteme')
+        return acq_data
+
+    def setup_spikes(self, fname):
+        fakedata = np.random.normal(0, 0.2, (3, 4, 2, 500))
+        acq_data = HDF5Data(fname)
+        acq_data.init_group('segment_1')
+        acq_data.set_metadata('segment_1', {'samplerate_ad': 1000})
+        acq_data.init_data('segment_1', fakedata.shape)
+        for itrace in range(fakedata.shape[0]):
+            for irep in range(fakedata.shape[1]):
+                acq_data.append('segment_1', fakedata[itrace, irep])
+        # as saved
+        return acq_data, acq_data.get_data('segment_1/test_1')
+
     def setup_finite(self, fakedata, nsets, operation='append', groupname='fake'):
         # npoints = len(np.squeeze(fakedata))
         fakedata = np.array(fakedata)
@@ -0,0 +1,126 @@
+import os
+import threading
+
+import numpy as np
+from nose.tools import assert_equal, raises
+
+from sparkle.data.hdf5data import HDF5Data
+from sparkle.data.writer import DataWriter
+from sparkle.tools.timing import TimingRecorder
+
+tempfolder = os.path.join(os.path.abspath(os.path.dirname(__file__)), u"tmp")
+
+class TestDataWriter():
+    def setUp(self):
+        self.fname = os.path.join(tempfolder, 'writertemp.hdf5')
+        self.writer = DataWriter(HDF5Data(self.fname))
+
+    def tearDown(self):
+        self.writer.close()
+        if os.path.isfile(self.fname):
+            os.remove(self.fname)
+
+    def test_write_read(self):
+        fakedata = np.ones((2, 10))
+        self.writer.init_data('fake', (3, 2, 2, 10))
+        for irep in range(5):
+            fakedata[:] = irep
+            self.writer.append('fake', fakedata)
+            self.writer.append_trace_info('fake', {'rep': irep})
+
+        # reads see everything queued before them
+        data = self.writer.get_data('fake/test_1')
+        for irep in range(5):
+            np.testing.assert_array_equal(data[irep/2, irep%2], np.ones((2, 10))*irep)
+        assert_equal(self.writer.get_trace_stim('fake/test_1', 4)['rep'], 4)
+
+    def test_close_finishes_writes(self):
+        self.writer.init_data('fake', (5, 10))
+        for i in range(5):
+            self.writer.append('fake', np.ones((10,))*i)
+        self.writer.close()
+
+        acq_data = HDF5Data(self.fname, filemode='r')
+        np.testing.assert_array_equal(acq_data.get_data('fake/test_1', (4,)), np.ones((10,))*4)
+        acq_data.close()
+        self.writer = DataWriter(HDF5Data(self.fname, filemode='a'))
+
+    def test_backpressure(self):
+        release = threading.Event()
+        reports = []
+        self.writer.close()
+        self.writer = DataWriter(SlowData(HDF5Data(self.fname), release),
+                                 maxsize=1, on_backpressure=reports.append)
+
+        self.writer.init_data('fake', (5, 10))
+        # the first is held up by the writer, the second waits in the queue
+        self.writer.append('fake', np.ones((10,)))
+        self.writer.append('fake', np.ones((10,)))
+        t = threading.Timer(0.1, release.set)
+        t.start()
+        self.writer.append('fake', np.ones((10,)))
+        assert self.writer.stalls > 0
+        assert_equal(reports[0], 1)
+        assert self.writer.stall_time > 0
+
+    def test_timing(self):
+        recorder = TimingRecorder()
+        self.writer.set_timing(recorder)
+        self.writer.init_data('fake', (6, 10))
+        for i in range(5):
+            self.writer.append('fake', np.ones((10,))*i)
+        self.writer.join()
+        # every write waited in the queue, and appends were timed by the data file
+        assert_equal(recorder.count('queue'), 6)
+        assert_equal(recorder.count('save'), 5)
+
+        self.writer.set_timing(None)
+        self.writer.append('fake', np.ones((10,)))
+        self.writer.join()
+        assert_equal(recorder.count('save'), 5)
+
+    def test_reads_on_writer_thread(self):
+        release = threading.Event()
+        self.writer.close()
+        self.writer = DataWriter(SlowData(HDF5Data(self.fname), release))
+
+        self.writer.init_data('fake', (5, 10))
+        self.writer.append('fake', np.ones((10,)))
+        # does not wait for the held up write
+        assert_equal(self.writer.filename, self.fname)
+        threads = []
+        self.writer.datafile.on_read = lambda: threads.append(threading.current_thread())
+        t = threading.Timer(0.1, release.set)
+        t.start()
+        np.testing.assert_array_equal(self.writer.get_data('fake/test_1', (0,)), np.ones((10,)))
+        assert release.is_set()
+        assert_equal(threads, [self.writer._thread])
+
+    @raises(KeyError)
+    def test_read_error(self):
+        self.writer.get_data('notthere')
+
+    @raises(TypeError)
+    def test_write_error(self):
+        self.writer.init_data('fake', (3, 10))
+        # wrong shape
+        self.writer.append('fake', np.ones((2, 5)))
+        self.writer.flush()
+
+class SlowData(object):
+    """Holds up writes until released"""
+    def __init__(self, datafile, release):
+        self.datafile = datafile
+        self.release = release
+
+        self.on_read = None
+
+    def __getattr__(self, name):
+        if name == 'append':
+            self.release.wait()
+        if name == 'get_data' and self.on_read is not None:
+            def get_data(*args):
+                self.on_read()
+                return self.datafile.get_data(*args)
+            return get_data
+        return getattr(self.datafile, name)
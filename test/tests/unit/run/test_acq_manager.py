@@ -11,13 +11,14 @@ import unittest
 
 import h5py
 import numpy as np
-from nose.tools import assert_equal, assert_in, nottest
+from nose.tools import assert_equal, assert_in, nottest, raises
 
 import test.sample as sample
 from test.tests.unit.data.test_hdf5_data import assert_attrs_equal
+from sparkle.data.hdf5data import read_trace_stim
 from sparkle.data.open import open_acqdata
 from sparkle.gui.stim.factory import TCFactory
-from sparkle.run.acquisition_manager import AcquisitionManager
+from sparkle.run.acquisition_manager import DATA_LAYOUT, AcquisitionManager
 from sparkle.stim.auto_parameter_model import AutoParameterModel
 from sparkle.stim.reorder import random_order
 from sparkle.stim.stimulus_model import StimulusModel
@@ -123,6 +124,34 @@ class TestAcquisitionManager():
         original_hfile.close()
         backup_hfile.close()
 
+    def test_data_layout(self):
+        winsz = 0.2 #seconds
+        acq_rate = 50000
+        manager, fname = self.create_acqmodel(winsz, acq_rate)
+        self.fake_calibration(manager)
+
+        # the layout from settings.conf
+        self.tone_protocol(manager)
+        manager.set_data_layout(chunks=(3, 1, 1000), compression='lzf', dtype='int16')
+        manager.protocol_model().remove(0)
+        self.tone_protocol(manager)
+        manager.close_data()
+
+        hfile = h5py.File(os.path.join(self.tempfolder, fname), 'r')
+        default = hfile['segment_1/test_1']
+        assert_equal(default.compression, DATA_LAYOUT.get('compression'))
+        assert_equal(default.dtype, np.dtype(DATA_LAYOUT.get('dtype', 'float32')))
+        changed = hfile['segment_2/test_2']
+        assert_equal(changed.chunks, (1, 3, 1, 1000))
+        assert_equal(changed.compression, 'lzf')
+        assert_equal(changed.dtype, np.int16)
+        hfile.close()
+
+    @raises(ValueError)
+    def test_bad_data_layout(self):
+        manager = AcquisitionManager()
+        manager.set_data_layout(compression='szip')
+
     def test_tone_protocol_no_attenuator(self):
         """Test a protocol with a single tone stimulus and no
         attenution for small amplitude"""
@@ -206,7 +235,7 @@ class TestAcquisitionManager():
         hfile = h5py.File(os.path.join(self.tempfolder, fname))
         test = hfile['segment_1']['test_1']
 
-        stim = json.loads(test.attrs['stim'])
+        stim = read_trace_stim(test)
 
         check_result(test, stim0, winsz, acq_rate)
 
@@ -241,7 +270,7 @@ class TestAcquisitionManager():
         # now check saved data
         hfile = h5py.File(os.path.join(self.tempfolder, fname))
         test = hfile['segment_1']['test_1']
-        stim = json.loads(test.attrs['stim'])
+        stim = read_trace_stim(test)
 
         # stim 0 is control window
         assert_in('components', stim[1])
@@ -451,6 +480,7 @@ class TestAcquisitionManager():
         manager.protocol_model().insert(stim_model,0)
 
         interval = 250
+        manager.set(save_timing=True)
         manager.setup_protocol(interval)
         t = manager.run_protocol()
         t.join()
@@ -459,10 +489,16 @@ class TestAcquisitionManager():
         # now check saved data
         hfile = h5py.File(os.path.join(self.tempfolder, fname))
         test = hfile['segment_1']['test_1']
-        stims = json.loads(test.attrs['stim'])
+        stims = read_trace_stim(test)
+        timing = json.loads(hfile['segment_1'].attrs['timing'])
         
         hfile.close()
 
+        # how long each stage of the reps took
+        for stage in ['stim_generation', 'daq_arm', 'read', 'processing', 'save', 'queue']:
+            assert timing[stage]['count'] > 0
+            assert timing[stage]['p50'] <= timing[stage]['p99'] <= timing[stage]['max']
+
         # aggregate all time intervals
         intervals = []
         for stim in stims:
@@ -473,6 +509,10 @@ class TestAcquisitionManager():
 
         # ms tolerance, not as good as I would like
         assert all(map(lambda x: x < 20, intervals))
+        # how late each rep was is saved with it
+        for stim in stims:
+            assert_equal(len(stim['lateness']), len(stim['time_stamps']))
+        assert manager.protocoler.timing_stats()['reps'] > 0
 
 
     # @unittest.skip("Grrrrrr")
@@ -497,7 +537,7 @@ class TestAcquisitionManager():
         # now check saved data
         hfile = h5py.File(os.path.join(self.tempfolder, fname))
         test = hfile['segment_1']['test_1']
-        stims = json.loads(test.attrs['stim'])
+        stims = read_trace_stim(test)
         
         hfile.close()
 
@@ -580,7 +620,7 @@ class TestAcquisitionManager():
         test = hfile['explore_1']
 
         # check_result(test, manager.explorer.stimulus, winsz, acq_rate)
-        stim = json.loads(test.attrs['stim'])
+        stim = read_trace_stim(test)
 
         assert_in('components', stim[0])
         assert_equal(stim[-1]['samplerate_da'], manager.explore_genrate())
@@ -634,7 +674,7 @@ class TestAcquisitionManager():
         # now check saved data
         hfile = h5py.File(os.path.join(self.tempfolder, fname))
         test = hfile['chart_1']
-        stim = json.loads(test.attrs['stim'])
+        stim = read_trace_stim(test)
         assert stim == []
         assert test.size > 1
         assert len(test.shape) == 1
@@ -668,7 +708,7 @@ class TestAcquisitionManager():
         # now check saved data
         hfile = h5py.File(os.path.join(self.tempfolder, fname))
         test = hfile['chart_1']
-        stim = json.loads(test.attrs['stim'])
+        stim = read_trace_stim(test)
 
         # print 'stim', stim
         # assert_in('components', stim[0])
@@ -739,7 +779,7 @@ class TestAcquisitionManager():
         hfile = h5py.File(fname, 'r')
         signals = hfile[calname]['signal']
 
-        stim = json.loads(signals.attrs['stim'])
+        stim = read_trace_stim(signals)
         cal_vector = hfile[calname]['calibration_intensities']
 
         assert_in('components', stim[0])
@@ -755,10 +795,16 @@ class TestAcquisitionManager():
 
 
         assert cal_vector.shape == ((npts/2+1),)
+        assert_equal(cal_vector.attrs['reps'], nreps)
+        assert cal_vector.attrs['signal_variance'] >= 0
+        assert cal_vector.attrs['reference_tone_variance'] >= 0
+        variance = manager.bs_calibrator.calibration_variance()
+        assert_equal(variance['signal'].shape, (npts,))
+        np.testing.assert_array_almost_equal(variance['signal'], np.var(signals, axis=0))
 
         reftone = hfile[calname]['reference_tone']
         # print 'reftone', reftone.attrs.keys()
-        stim = json.loads(reftone.attrs['stim'])
+        stim = read_trace_stim(reftone)
         tone = stim[0]['components'][0]
         assert tone['stim_type'] == 'Pure Tone'
         assert tone['frequency'] == 1234
@@ -766,6 +812,30 @@ class TestAcquisitionManager():
 
         hfile.close()
 
+    def test_calibration_file(self):
+        winsz = 0.2 #seconds
+        manager, fname = self.create_acqmodel(winsz)
+        manager.close_data()
+        manager.load_data_file(sample.calibration_filename(), 'r')
+        calname = manager.datafile.calibration_list()[0]
+        calfile = os.path.join(self.tempfolder, 'testcal' + rand_id() + '.cal')
+        manager.save_calibration_file(calfile, calname, 15000, [5000, 100000])
+        manager.close_data()
+
+        StimulusModel.clearCache()
+        manager.load_calibration_file(calfile)
+        calibration_vector, calibration_freqs = manager.current_calibration()
+        cal_data_file = open_acqdata(sample.calibration_filename(), filemode='r')
+        np.testing.assert_array_equal(calibration_vector, cal_data_file.get_calibration(calname, 15000)[0])
+        cal_data_file.close()
+
+        # saved filters are used
+        stim = manager.explorer.stimulus()
+        np.testing.assert_array_equal(stim.impulseResponse,
+                                      manager.calibration_files[calfile].kernels[stim.samplerate()])
+        assert_equal(StimulusModel.kernelCache.stats()['misses'], 0)
+        os.remove(calfile)
+
     def test_correct_data_groups_created_protocol(self):
         winsz = 0.2 #seconds
         acq_rate = 50000
@@ -927,7 +997,7 @@ class TestAcquisitionManager():
 def check_result(test_data, test_stim, winsz, acq_rate, nchans=1, averaged=False):
     ntraces = test_stim.traceCount()+1
     nreps = test_stim.repCount()
-    stim_doc = json.loads(test_data.attrs['stim'])
+    stim_doc = read_trace_stim(test_data)
 
     # print 'test_data', test_data, test_data.shape
     # print 'stim doc', stim_doc[0]
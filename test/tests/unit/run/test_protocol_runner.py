@@ -0,0 +1,43 @@
+import numpy as np
+from nose.tools import assert_equal, raises
+
+from sparkle.run.protocol_runner import reject_artifacts
+
+
+def test_reject_samples():
+    responses = np.zeros((3, 2, 10))
+    responses[0, 1, 4] = 5
+    responses[2, 0, 0] = 2
+    responses[2, 0, 1] = 1.9
+
+    nrejected = reject_artifacts(responses, 2)
+
+    assert_equal(nrejected, 2)
+    assert_equal(np.count_nonzero(np.isnan(responses)), 2)
+    assert np.isnan(responses[0, 1, 4])
+    assert np.isnan(responses[2, 0, 0])
+    assert_equal(responses[2, 0, 1], 1.9)
+    # the averages leave out the rejected samples
+    avg = np.nanmean(responses, axis=0)
+    assert_equal(avg[0, 1], 1.9/3)
+
+def test_reject_reps():
+    responses = np.ones((4, 2, 10))
+    responses[1, 1, 9] = 3
+
+    nrejected = reject_artifacts(responses, 2, mode='rep')
+
+    assert_equal(nrejected, 1)
+    assert np.all(np.isnan(responses[1]))
+    assert not np.any(np.isnan(responses[[0, 2, 3]]))
+    np.testing.assert_array_equal(np.nanmean(responses, axis=0), np.ones((2, 10)))
+
+def test_reject_nothing():
+    responses = np.ones((4, 1, 10))
+    assert_equal(reject_artifacts(responses, 2, mode='rep'), 0)
+    assert_equal(reject_artifacts(responses, 2), 0)
+    assert not np.any(np.isnan(responses))
+
+@raises(ValueError)
+def test_reject_bad_mode():
+    reject_artifacts(np.ones((4, 1, 10)), 2, mode='trace')
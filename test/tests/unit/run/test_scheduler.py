@@ -0,0 +1,63 @@
+import numpy as np
+from nose.tools import assert_equal
+
+from sparkle.run.scheduler import Scheduler
+
+
+class FakeClock(object):
+    """Time that passes only when slept, or a little each time it is read"""
+    def __init__(self, tick=0.0001):
+        self.now = 0.
+        self.tick = tick
+
+    def __call__(self):
+        self.now += self.tick
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+def test_schedule():
+    clock = FakeClock()
+    interval = 20
+    scheduler = Scheduler(interval, clock=clock, sleep=clock.sleep)
+    scheduler.start(5)
+    times = []
+    for rep in range(8):
+        lateness = scheduler.wait()
+        times.append(clock.now)
+        assert 0 <= lateness < scheduler.tolerance
+    # on the schedule, past the reps worked out up front too
+    expected = scheduler.start_time + np.arange(8)*interval/1000.
+    np.testing.assert_array_almost_equal(times, expected, 3)
+    stats = scheduler.stats()
+    assert_equal(stats['reps'], 8)
+    assert_equal(stats['late'], 0)
+
+def test_late_rep():
+    clock = FakeClock()
+    interval = 20
+    scheduler = Scheduler(interval, clock=clock, sleep=clock.sleep)
+    scheduler.start(4)
+    scheduler.wait()
+    # the second rep will be late...
+    clock.sleep(0.05)
+    assert scheduler.wait() > 0.025
+    # ...and the next is still an interval after it
+    second = clock.now
+    scheduler.wait()
+    assert clock.now - second >= 0.02
+    assert_equal(scheduler.stats()['late'], 1)
+
+def test_real_clock():
+    scheduler = Scheduler(10)
+    for rep in range(3):
+        assert scheduler.wait() >= 0
+    assert_equal(scheduler.stats()['reps'], 3)
+
+def test_restart():
+    scheduler = Scheduler(10)
+    scheduler.wait()
+    scheduler.start()
+    assert_equal(scheduler.stats(), {'reps': 0, 'late': 0, 'mean_lateness': 0.,
+                                     'max_lateness': 0., 'tolerance': scheduler.tolerance})
@@ -0,0 +1,94 @@
+import glob
+import os
+
+import numpy as np
+from nose.tools import assert_equal
+
+from sparkle.stim.kernel_cache import KernelCache, kernel_key
+from sparkle.tools.audiotools import impulse_response
+
+tempfolder = os.path.join(os.path.abspath(os.path.dirname(__file__)), u"tmp")
+
+FS = 100000
+FREQS = np.linspace(0, 50000, 1000)
+FRANGE = (5000, 40000)
+
+class TestKernelCache():
+    def setUp(self):
+        self.fresponse = np.random.normal(0, 3, FREQS.shape)
+        self.cache = KernelCache()
+
+    def tearDown(self):
+        for f in glob.glob(os.path.join(tempfolder, 'kernels', '*')):
+            os.remove(f)
+
+    def test_kernel(self):
+        kernel = self.cache.kernel(FS, self.fresponse, FREQS, FRANGE, 2**10)
+        np.testing.assert_array_equal(kernel, impulse_response(FS, self.fresponse, FREQS, FRANGE, 2**10))
+        # cached
+        assert self.cache.kernel(FS, self.fresponse, FREQS, FRANGE, 2**10) is kernel
+        assert self.cache.filter(FS, self.fresponse, FREQS, FRANGE, 2**10).kernel is kernel
+        assert_equal(self.cache.stats()['misses'], 1)
+
+    def test_different_calibrations(self):
+        kernel0 = self.cache.kernel(FS, self.fresponse, FREQS, FRANGE)
+        other_response = self.fresponse.copy()
+        other_response[500] += 1
+        kernel1 = self.cache.kernel(FS, other_response, FREQS, FRANGE)
+        assert not np.array_equal(kernel0, kernel1)
+        assert self.cache.kernel(FS, self.fresponse, FREQS, (5000, 30000)) is not kernel0
+        assert self.cache.kernel(FS*2, self.fresponse, FREQS, FRANGE) is not kernel0
+        # both kept
+        assert self.cache.kernel(FS, self.fresponse, FREQS, FRANGE) is kernel0
+        assert self.cache.kernel(FS, other_response, FREQS, FRANGE) is kernel1
+
+    def test_key(self):
+        assert_equal(kernel_key(FS, self.fresponse, FREQS, FRANGE),
+                     kernel_key(float(FS), list(self.fresponse), FREQS, list(FRANGE)))
+        assert kernel_key(FS, self.fresponse, FREQS, FRANGE) != kernel_key(FS, self.fresponse, FREQS, FRANGE, 2**10)
+
+    def test_evict_least_recent(self):
+        self.cache = KernelCache(maxbytes=200000)
+        kernel0 = self.cache.kernel(FS, self.fresponse, FREQS, FRANGE, 2**10)
+        for i in range(3):
+            self.cache.kernel(FS, self.fresponse + i + 1, FREQS, FRANGE, 2**10)
+        assert self.cache.stats()['evictions'] > 0
+        assert self.cache.stats()['nbytes'] <= 200000
+        assert self.cache.kernel(FS, self.fresponse, FREQS, FRANGE, 2**10) is not kernel0
+
+    def test_prefetch(self):
+        self.cache.prefetch(FS, self.fresponse, FREQS, FRANGE)
+        kernel = self.cache.kernel(FS, self.fresponse, FREQS, FRANGE)
+        np.testing.assert_array_equal(kernel, impulse_response(FS, self.fresponse, FREQS, FRANGE))
+        # already there
+        self.cache.prefetch(FS, self.fresponse, FREQS, FRANGE)
+        assert self.cache.kernel(FS, self.fresponse, FREQS, FRANGE) is kernel
+
+    def test_saved_kernels(self):
+        directory = os.path.join(tempfolder, 'kernels')
+        self.cache = KernelCache(directory=directory)
+        kernel = self.cache.kernel(FS, self.fresponse, FREQS, FRANGE)
+        assert_equal(len(glob.glob(os.path.join(directory, '*.npy'))), 1)
+
+        # a new session
+        cache = KernelCache(directory=directory)
+        np.testing.assert_array_equal(cache.kernel(FS, self.fresponse, FREQS, FRANGE), kernel)
+
+        # saved kernels are used, instead of calculating again
+        path = glob.glob(os.path.join(directory, '*.npy'))[0]
+        np.save(path, np.ones((10,)))
+        cache = KernelCache(directory=directory)
+        np.testing.assert_array_equal(cache.kernel(FS, self.fresponse, FREQS, FRANGE), np.ones((10,)))
+
+    def test_add(self):
+        kernel = impulse_response(FS, self.fresponse, FREQS, FRANGE)
+        self.cache.add(FS, self.fresponse, FREQS, FRANGE, kernel)
+        assert self.cache.kernel(FS, self.fresponse, FREQS, FRANGE) is kernel
+        # only for the same calibration
+        assert self.cache.kernel(FS, self.fresponse, FREQS, FRANGE, 2**10) is not kernel
+        assert_equal(self.cache.stats()['misses'], 1)
+
+    def test_clear(self):
+        kernel = self.cache.kernel(FS, self.fresponse, FREQS, FRANGE)
+        self.cache.clear()
+        assert self.cache.kernel(FS, self.fresponse, FREQS, FRANGE) is not kernel
@@ -241,6 +241,51 @@ class TestStimModel():
         # do math to make this more accurate
         assert ovld > 0
 
+    def test_expanded_stream(self):
+        component = PureTone()
+        self.model.insertComponent(component, 0,0)
+        nsteps = self.add_auto_param(self.model)
+
+        signals, docs, ovlds = self.model.expandedStim()
+        stream = self.model.expandedStimStream(prefetch=1)
+        assert_equal(len(stream), nsteps)
+        traces = list(stream)
+        stream.close()
+
+        assert_equal(len(traces), nsteps)
+        for (signal, doc, ovld), expected in zip(traces, zip(signals, docs, ovlds)):
+            np.testing.assert_array_equal(signal[0], expected[0][0])
+            assert_equal(signal[1], expected[0][1])
+            assert_equal(doc, expected[1])
+            assert_equal(ovld, expected[2])
+        # components are back to where they started
+        assert_equal(component.intensity(), 0)
+
+    def test_expanded_stream_reordered(self):
+        component = PureTone()
+        self.model.insertComponent(component, 0,0)
+        nsteps = self.add_auto_param(self.model)
+        self.model.setReorderFunc(lambda docs: range(len(docs))[::-1], 'backwards')
+
+        stream = self.model.expandedStimStream()
+        intensities = [doc['components'][0]['intensity'] for sig, doc, ovld in stream]
+        stream.close()
+
+        assert_equal(intensities, range(nsteps)[::-1])
+        assert_equal(component.intensity(), 0)
+
+    def test_expanded_stream_closed_early(self):
+        component = PureTone()
+        self.model.insertComponent(component, 0,0)
+        self.add_auto_param(self.model)
+
+        stream = self.model.expandedStimStream(prefetch=1)
+        first = iter(stream).next()
+        stream.close()
+
+        assert_equal(first[1]['components'][0]['intensity'], 0)
+        assert_equal(component.intensity(), 0)
+
     def test_corrent_number_of_traces(self):
         self.model = self.stim_with_double_auto()
         n = self.model.traceCount()
@@ -490,6 +535,49 @@ class TestStimModel():
         print 'msg', invalid
         assert invalid
 
+    def test_verify_leaves_components(self):
+        component = PureTone()
+        component.setFrequency(5000)
+        self.model.insertComponent(component, 0,0)
+
+        ap_model = self.model.autoParams()
+        ap_model.insertRow(0)
+        ap_model.toggleSelection(0, component)
+        # goes over nyquist
+        ap_model.setParamValue(0, parameter='frequency', start=1000,
+                               stop=DEFAULT_SAMPLERATE, step=1000)
+
+        invalid = self.model.verify(windowSize=0.5)
+        assert invalid
+        assert_equal(component.frequency(), 5000)
+        assert self.model.component(0,0) is component
+
+    def test_max_expanded_duration(self):
+        tone0 = PureTone()
+        tone0.setDuration(0.01)
+        tone1 = PureTone()
+        tone1.setDuration(0.02)
+        self.model.insertComponent(tone0, 0,0)
+        self.model.insertComponent(tone1, 0,1)
+        tone2 = PureTone()
+        tone2.setDuration(0.1)
+        self.model.insertComponent(tone2, 1,0)
+
+        ap_model = self.model.autoParams()
+        ap_model.insertRow(0)
+        ap_model.toggleSelection(0, tone0)
+        ap_model.toggleSelection(0, tone1)
+        ap_model.setParamValue(0, parameter='duration', start=0.05,
+                               stop=0.01, step=0.01)
+
+        assert_equal(self.model.maxExpandedDuration(), 0.1)
+        assert self.model.verify(windowSize=0.09)
+        assert_equal(self.model.verify(windowSize=0.1), 0)
+        assert_equal(tone0.duration(), 0.01)
+
+        durations = self.model.expandFunction(self.model.duration)
+        assert_equal(self.model.maxExpandedDuration(), max(durations))
+
     def test_calibration_samplerates_change(self):
         # get some calibration data
         frange = [5000, 100000]
@@ -517,6 +605,62 @@ class TestStimModel():
 
         assert self.model._calibration_fs == DEFAULT_SAMPLERATE
 
+    def test_signal_cached(self):
+        StimulusModel.clearCache()
+        component = PureTone()
+        self.model.insertComponent(component, 0,0)
+
+        before = StimulusModel.signalCacheStats()
+        signal0 = self.model.signal()
+        signal1 = self.model.signal()
+        after = StimulusModel.signalCacheStats()
+
+        np.testing.assert_array_equal(signal0[0], signal1[0])
+        assert_equal(after['misses'] - before['misses'], 1)
+        assert_equal(after['hits'] - before['hits'], 1)
+        # changing the returned signal doesn't change the cache
+        signal0[0][:] = 0
+        assert np.any(self.model.signal()[0] != 0)
+
+        component.setFrequency(component.frequency()*2)
+        signal2 = self.model.signal()
+        assert not np.array_equal(signal2[0], signal1[0])
+
+    def test_expanded_not_cached(self):
+        StimulusModel.clearCache()
+        component = PureTone()
+        self.model.insertComponent(component, 0,0)
+        self.add_auto_param(self.model)
+
+        stream = self.model.expandedStimStream()
+        signals = [trace[0][0] for trace in stream]
+        stream.close()
+        assert len(signals) > 1
+        assert_equal(StimulusModel.signalCacheStats()['items'], 0)
+        # the same signals as on their own
+        np.testing.assert_array_equal(signals, [trace[0] for trace in self.model.expandedStim()[0]])
+
+    def test_signal_cache_calibration_change(self):
+        StimulusModel.clearCache()
+        component = PureTone()
+        self.model.insertComponent(component, 0,0)
+        uncalibrated = self.model.signal()[0]
+
+        frange = [5000, 100000]
+        cal_data_file = open_acqdata(sample.calibration_filename(), filemode='r')
+        calname = cal_data_file.calibration_list()[0]
+        calibration_vector, calibration_freqs = cal_data_file.get_calibration(calname, reffreq=15000)
+        cal_data_file.close()
+        self.model.setCalibration(calibration_vector, calibration_freqs, frange)
+        calibrated = self.model.signal()[0]
+        assert not np.array_equal(uncalibrated, calibrated)
+
+        self.model.setCalibration(None, None, None)
+        np.testing.assert_array_equal(self.model.signal()[0], uncalibrated)
+
+        StimulusModel.clearCache()
+        assert_equal(StimulusModel.signalCacheStats()['items'], 0)
+
     def add_auto_param(self, model):
         # adds an autoparameter to the given model
         ptype = 'intensity'
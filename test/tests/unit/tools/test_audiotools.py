@@ -85,9 +85,31 @@ def test_calc_spectrum_odd_len_signal():
     assert np.around(frequencies[-1]) == fs/2
     peak_idx = (abs(spectrum - max(spectrum))).argmin()
     freq_idx = (abs(frequencies - fq)).argmin()
-    print peak_idx, freq_idx, frequencies[peak_idx], frequencies[freq_idx] 
+    print peak_idx, freq_idx, frequencies[peak_idx], frequencies[freq_idx]
     assert (abs(spectrum - max(spectrum))).argmin() == (abs(frequencies - fq)).argmin()
 
+def test_calc_spectrum_batch():
+    signals = np.random.normal(0, 1, (3, 4, 1001))
+    frequencies, spectra = tools.calc_spectrum(signals, 100000)
+    assert spectra.shape == (3, 4, len(frequencies))
+    for trace, trace_spectra in zip(signals, spectra):
+        for rep, spectrum in zip(trace, trace_spectra):
+            assert_array_almost_equal(spectrum, tools.calc_spectrum(rep, 100000)[1])
+
+def test_spectrum_peaks():
+    fs = 100000
+    t = np.arange(5000)/float(fs)
+    tone_freqs = np.array([1000, 15000, 33333])
+    # reps of a tone for each trace
+    signals = np.sin(2*np.pi*tone_freqs[:, np.newaxis, np.newaxis]*t)*np.array([1, 2])[:, np.newaxis]
+    frequencies, spectra = tools.calc_spectrum(signals, fs)
+    peaks = tools.spectrum_peaks(spectra, frequencies, tone_freqs[:, np.newaxis])
+    assert peaks.shape == (3, 2)
+    assert_array_almost_equal(peaks, spectra.max(axis=-1))
+    assert peaks[0, 0] == spectra[0, 0, (abs(frequencies - 1000)).argmin()]
+    # a single spectrum
+    assert tools.spectrum_peaks(spectra[1, 1], frequencies, 15000) == peaks[1, 1]
+
 def test_make_tone_regular_at_caldb():
     fq = 15000
     db = 100
@@ -230,6 +252,22 @@ def test_spec_overlap():
     assert len(bins0) < len(bins50) < len(bins99)
     assert duration0 == duration50 == duration99
 
+def test_spectrogram_engines_bounded():
+    fs = 1000
+    signal = np.random.normal(0, 1, (fs,))
+    engines = tools._stft_engines
+    maxbytes = engines.maxbytes
+    engines.maxbytes = 2**20
+    try:
+        nffts = range(16, 2048, 16)
+        for nfft in nffts:
+            tools.spectrogram((fs, signal), nfft=nfft)
+            assert engines.nbytes <= engines.maxbytes
+        assert 0 < len(engines) < len(nffts)
+    finally:
+        engines.maxbytes = maxbytes
+        engines.clear()
+
 def test_attenuation_curve():
     fs = 5e5
     duration = 0.2
@@ -397,6 +435,63 @@ def test_convolve_no_impulse():
     x = np.array([1,2,3])
     assert_array_equal(tools.convolve_filter(x,None), x)
 
+def test_overlap_save_filter():
+    # whole signal in one block, over many blocks, shorter than the kernel
+    for nkernel in [1, 16, 17, 1000]:
+        kernel = np.random.normal(0, 1, (nkernel,))
+        for npoints in [1, 15, 1000, 50000]:
+            x = np.random.normal(0, 1, (npoints,))
+            for nfft in [None, nkernel + 1, 4*nkernel + 3]:
+                osfilter = tools.OverlapSaveFilter(kernel, nfft)
+                assert_array_almost_equal(osfilter.filter(x), tools.convolve_filter(x, kernel))
+
+def test_overlap_save_filter_in_place():
+    kernel = tools.impulse_response(100000, np.random.normal(0, 3, (2000,)), 
+                                    np.linspace(0, 50000, 2000), (5000, 40000), 
+                                    filter_len=2**10)
+    x = np.random.normal(0, 1, (20000,))
+    expected = tools.convolve_filter(x, kernel)
+    osfilter = tools.OverlapSaveFilter(kernel, 2**11)
+    out = osfilter.filter(x, out=x)
+    assert out is x
+    assert_array_almost_equal(x, expected)
+
+def test_overlap_save_filter_chunks():
+    kernel = np.random.normal(0, 1, (100,))
+    x = np.random.normal(0, 1, (5000,))
+    osfilter = tools.OverlapSaveFilter(kernel, 256)
+    chunks = []
+    for chunk in np.array_split(x, [10, 11, 500, 2000, 2157]):
+        chunks.append(osfilter.process(chunk))
+    # causal convolution
+    assert_array_almost_equal(np.concatenate(chunks), np.convolve(x, kernel)[:len(x)])
+
+    # delay and pad to get the filter output
+    osfilter.reset()
+    padded = np.concatenate((x, np.zeros((osfilter.delay,))))
+    filtered = np.concatenate([osfilter.process(chunk) for chunk in np.array_split(padded, 7)])
+    assert_array_almost_equal(filtered[osfilter.delay:], tools.convolve_filter(x, kernel))
+
+@raises(ValueError)
+def test_overlap_save_filter_small_fft():
+    tools.OverlapSaveFilter(np.ones((100,)), 64)
+
+def test_running_stats():
+    signals = np.random.normal(3, 2, (10, 500))
+    stats = tools.RunningStats(500)
+    for irep, signal in enumerate(signals):
+        stats.add(signal)
+        assert stats.count == irep + 1
+        np.testing.assert_array_almost_equal(stats.mean(), np.mean(signals[:irep+1], axis=0))
+        np.testing.assert_array_almost_equal(stats.variance(), np.var(signals[:irep+1], axis=0))
+    np.testing.assert_array_almost_equal(stats.variance(1), np.var(signals, axis=0, ddof=1))
+
+    stats.reset()
+    assert stats.count == 0
+    np.testing.assert_array_equal(stats.variance(1), np.zeros((500,)))
+    stats.add(signals[0])
+    np.testing.assert_array_equal(stats.mean(), signals[0])
+
 def test_tukey():
     npts = 100
     win = tools.tukey(npts, 0.1)
@@ -465,3 +560,45 @@ def test_audiorate_wav():
 def test_audiorate_call1():
     fs = tools.audiorate(sample.samplecall1())
     assert fs == 333333
+
+def loop_rms(signal, fs):
+    # the chunk by chunk loop rms replaced
+    chunk_samps = int(0.001 * fs)
+    amps = []
+    for i in range(0, len(signal) - chunk_samps, chunk_samps):
+        amps.append(np.sqrt(np.mean(pow(signal[i:i + chunk_samps], 2))))
+    amps.append(np.sqrt(np.mean(pow(signal[len(signal) - chunk_samps:], 2))))
+    return np.amax(amps)
+
+def test_rms_chunks():
+    fs = 50000
+    # evenly divided into chunks, a partial chunk at the end, and short
+    for npoints in [5000, 5001, 5049, 50, 30]:
+        signal = np.random.normal(0, 1, (npoints,))
+        assert_almost_equal(tools.rms(signal, fs), loop_rms(signal, fs))
+
+def test_rms_loudest_chunk():
+    fs = 50000
+    signal = np.zeros((5025,))
+    signal[-10:] = 1
+    # in the last chunk, which overlaps the chunk before it
+    assert_almost_equal(tools.rms(signal, fs), np.sqrt(10./50))
+
+def test_rms_low_samplerate():
+    signal = np.random.normal(0, 1, (100,))
+    assert_almost_equal(tools.rms(signal, 5000), np.sqrt(np.mean(signal**2)))
+
+def test_rms_batch():
+    fs = 50000
+    signals = np.random.normal(0, 1, (4, 3, 5049))
+    amps = tools.rms(signals, fs)
+    assert amps.shape == (4, 3)
+    for irep in range(4):
+        for ichan in range(3):
+            assert_almost_equal(amps[irep, ichan], loop_rms(signals[irep, ichan], fs))
+
+def test_signal_amplitude_batch():
+    fs = 50000
+    signals = np.random.normal(0, 1, (4, 5000))
+    amps = tools.signal_amplitude(signals, fs)
+    assert_array_almost_equal(amps, [tools.signal_amplitude(signal, fs) for signal in signals])
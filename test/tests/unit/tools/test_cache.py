@@ -0,0 +1,63 @@
+import numpy as np
+from nose.tools import assert_equal
+
+from sparkle.tools.cache import LRUCache, content_key, nbytes_of
+
+
+def test_get_put():
+    cache = LRUCache(1000)
+    cache.put('a', np.zeros((10,)))
+    np.testing.assert_array_equal(cache.get('a'), np.zeros((10,)))
+    assert cache.get('b') is None
+    stats = cache.stats()
+    assert_equal(stats['hits'], 1)
+    assert_equal(stats['misses'], 1)
+    assert_equal(stats['nbytes'], 80)
+
+def test_evict_least_recent():
+    cache = LRUCache(250)
+    cache.put('a', np.zeros((10,)))
+    cache.put('b', np.zeros((10,)))
+    cache.put('c', np.zeros((10,)))
+    # use a, so b is the oldest
+    cache.get('a')
+    cache.put('d', np.zeros((10,)))
+
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert 'c' in cache
+    assert 'd' in cache
+    assert_equal(cache.nbytes, 240)
+    assert_equal(cache.stats()['evictions'], 1)
+
+def test_too_big():
+    cache = LRUCache(100)
+    cache.put('a', np.zeros((5,)))
+    cache.put('b', np.zeros((20,)))
+    assert 'b' not in cache
+    assert 'a' in cache
+
+def test_replace():
+    cache = LRUCache(100)
+    cache.put('a', np.zeros((5,)))
+    cache.put('a', np.ones((10,)))
+    assert_equal(len(cache), 1)
+    assert_equal(cache.nbytes, 80)
+    np.testing.assert_array_equal(cache.pop('a'), np.ones((10,)))
+    assert_equal(cache.nbytes, 0)
+
+def test_clear():
+    cache = LRUCache(100)
+    cache.put('a', np.zeros((5,)))
+    cache.clear()
+    assert_equal(len(cache), 0)
+    assert_equal(cache.nbytes, 0)
+
+def test_nbytes_of():
+    assert_equal(nbytes_of((np.zeros((5,)), 3, [np.zeros((2,2))])), 72)
+    assert_equal(nbytes_of({'a': np.zeros((1,), dtype=np.float32)}), 4)
+
+def test_content_key():
+    assert_equal(content_key({'a': 1, 'b': [1, 2]}, 5), content_key({'b': [1, 2], 'a': 1}, 5))
+    assert content_key({'a': 1}, 5) != content_key({'a': 2}, 5)
+    assert_equal(content_key(np.float64(1.5)), content_key(1.5))
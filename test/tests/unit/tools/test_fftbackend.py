@@ -0,0 +1,53 @@
+import numpy as np
+from nose.tools import assert_equal, raises
+from scipy import signal
+
+from sparkle.tools import fftbackend
+
+
+class TestBackends():
+    def setUp(self):
+        self.default = fftbackend.backend.name
+
+    def tearDown(self):
+        fftbackend.set_backend(self.default)
+
+    def test_same_as_numpy(self):
+        x = np.random.normal(0, 1, (1001,))
+        for name in fftbackend.available():
+            fftbackend.set_backend(name)
+            np.testing.assert_array_almost_equal(fftbackend.rfft(x), np.fft.rfft(x))
+            np.testing.assert_array_almost_equal(fftbackend.rfft(x, 2048), np.fft.rfft(x, 2048))
+            X = np.fft.rfft(x)
+            np.testing.assert_array_almost_equal(fftbackend.irfft(X, 1001), np.fft.irfft(X, 1001))
+            np.testing.assert_array_almost_equal(fftbackend.fft(x), np.fft.fft(x))
+            np.testing.assert_array_almost_equal(fftbackend.ifft(X), np.fft.ifft(X))
+
+    def test_fftconvolve(self):
+        x = np.random.normal(0, 1, (1000,))
+        h = np.random.normal(0, 1, (99,))
+        for name in fftbackend.available():
+            fftbackend.set_backend(name)
+            np.testing.assert_array_almost_equal(fftbackend.fftconvolve(x, h), signal.fftconvolve(x, h))
+            np.testing.assert_array_almost_equal(fftbackend.fftconvolve(x*1j, h), signal.fftconvolve(x*1j, h))
+
+    @raises(ValueError)
+    def test_unavailable_backend(self):
+        fftbackend.set_backend('notalibrary')
+
+def test_rfft_freqs():
+    freqs = fftbackend.rfft_freqs(1024, 500000)
+    np.testing.assert_array_almost_equal(freqs, np.fft.rfftfreq(1024, 1./500000))
+    # odd length
+    assert_equal(len(fftbackend.rfft_freqs(1001, 500000)), len(np.fft.rfft(np.zeros(1001))))
+    # the same array next time
+    assert fftbackend.rfft_freqs(1024, 500000) is freqs
+    assert not freqs.flags.writeable
+
+def test_get_window():
+    np.testing.assert_array_equal(fftbackend.get_window('hamming', 512), np.hamming(512))
+    np.testing.assert_array_equal(fftbackend.get_window('hann', 512), signal.hann(512))
+    np.testing.assert_array_equal(fftbackend.get_window('none', 10), np.ones(10))
+    window = fftbackend.get_window('blackman', 100)
+    assert fftbackend.get_window('blackman', 100) is window
+    assert not window.flags.writeable
@@ -4,8 +4,8 @@ import numpy as np
 import scipy.io.wavfile as wv
 
 import test.sample as sample
-from sparkle.tools.spikestats import bin_spikes, firing_rate, spike_latency, \
-    spike_times
+from sparkle.tools.spikestats import batch_spike_indices, bin_spikes, \
+    count_spikes, firing_rate, refractory, spike_latency, spike_times
 
 
 def test_spike_times_sin():
@@ -193,6 +193,86 @@ def test_spike_times_empty():
 
 #--------------------------------
 
+def test_batch_spike_indices_matches_spike_times():
+    np.random.seed(7)
+    fs = 10000
+    data = np.random.normal(0, 1, (3, 4, 2, 500))
+    # flat tops, and two point sets over threshold
+    data[0,0,0,10:20] = 5
+    data[0,0,1,0:2] = 5
+    data[1,1,1,-2:] = 5
+    threshold = 1.5
+
+    for absval in [True, False]:
+        offsets, indices = batch_spike_indices(data, threshold, fs, absval)
+        assert len(offsets) == 3*4*2 + 1
+        recordings = data.reshape((-1, 500))
+        for irec in range(recordings.shape[0]):
+            times = spike_times(recordings[irec], threshold, fs, absval)
+            assert np.array_equal(indices[offsets[irec]:offsets[irec+1]]/float(fs), times)
+
+def test_batch_spike_indices_channel_thresholds():
+    y = np.zeros((2, 3, 2, 1024))
+    y[:,:,0,100] = 0.5
+    y[:,:,1,[100,500]] = 1
+    thresholds = np.array([0.8, 0.2])
+    fs = 10
+
+    offsets, indices = batch_spike_indices(y, thresholds, fs)
+    counts = np.diff(offsets).reshape((2, 3, 2))
+    assert np.array_equal(counts[:,:,0], np.zeros((2, 3)))
+    assert np.array_equal(counts[:,:,1], np.ones((2, 3))*2)
+    assert np.array_equal(indices, [100, 500]*6)
+
+def test_batch_spike_indices_channel_absval():
+    np.random.seed(11)
+    data = np.random.normal(0, 1, (4, 2, 300))
+    offsets, indices = batch_spike_indices(data, 1.5, 1000, absval=[True, False])
+    recordings = data.reshape((-1, 300))
+    for irec in range(recordings.shape[0]):
+        times = spike_times(recordings[irec], 1.5, 1000, absval=(irec % 2 == 0))
+        assert np.array_equal(indices[offsets[irec]:offsets[irec+1]]/1000., times)
+
+def test_batch_spike_indices_empty():
+    y = np.zeros((5, 1024))
+    offsets, indices = batch_spike_indices(y, 0.8, 10)
+    assert np.array_equal(offsets, np.zeros(6))
+    assert len(indices) == 0
+
+def test_count_spikes():
+    n = 1024
+    x = np.arange(n)
+    y = np.sin(2*np.pi*16*x/n)
+    reps = np.vstack([y, -y, np.zeros(n)])
+
+    assert count_spikes(reps, 0.7, 10) == 16*4
+
+#--------------------------------
+
+def test_refractory_chain():
+    # the middle spike is too close to the first, but once it is
+    # removed, the last spike is far enough from the first
+    times = refractory([0.1, 0.1015, 0.103, 0.2], 0.002)
+    assert isinstance(times, np.ndarray)
+    assert np.array_equal(times, [0.1, 0.103, 0.2])
+
+def test_refractory_burst():
+    times = np.arange(0, 1, 0.0625)
+    assert np.array_equal(refractory(times, 0.25), times[::4])
+
+def test_refractory_dense():
+    times = np.arange(0, 1, 2**-10)
+    assert np.array_equal(refractory(times, 2**-4), times[::64])
+
+def test_refractory_exact_interval():
+    times = [0.5, 0.75, 0.875]
+    assert np.array_equal(refractory(times, 0.25), [0.5, 0.75])
+
+def test_refractory_empty():
+    assert len(refractory([])) == 0
+
+#--------------------------------
+
 def test_bin_spikes_even_middle_times():
     times = np.arange(0.05, 0.95, 0.1)
     binsz = 0.1
@@ -219,6 +299,11 @@ def test_bin_spikes_uneven_times():
     bins = bin_spikes(times, binsz)
     assert np.array_equal([7, 6, 2, 4, 4, 3], bins)
 
+def test_bin_spikes_empty():
+    bins = bin_spikes([], 0.1)
+    assert isinstance(bins, np.ndarray)
+    assert len(bins) == 0
+
 #---------------------------------
 
 def test_spike_latency_smooth_stim():
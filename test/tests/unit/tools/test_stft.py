@@ -0,0 +1,54 @@
+import numpy as np
+from matplotlib import mlab
+from nose.tools import assert_equal, raises
+
+from sparkle.tools.stft import STFT
+
+FS = 100000
+
+def specgram(signal, nfft, noverlap, window):
+    return mlab.specgram(signal, NFFT=nfft, Fs=FS, noverlap=noverlap,
+                         pad_to=nfft*2, window=window, detrend=mlab.detrend_none,
+                         sides='default', scale_by_freq=False)
+
+def test_same_as_specgram():
+    signal = np.random.normal(0, 1, (10000,))
+    for nfft, noverlap in [(512, 0), (512, 460), (511, 100)]:
+        Pxx, freqs, bins = specgram(signal, nfft, noverlap, mlab.window_hanning)
+        engine = STFT(FS, nfft, noverlap, nfft*2, 'hanning', block=7)
+        power = engine.compute(signal)
+        assert_equal(power.shape, Pxx.shape)
+        np.testing.assert_allclose(power, Pxx, rtol=1e-4, atol=1e-9*Pxx.max())
+        np.testing.assert_array_almost_equal(engine.freqs(), freqs)
+        np.testing.assert_array_almost_equal(engine.times(), bins)
+
+def test_window_array():
+    signal = np.random.normal(0, 1, (5000,))
+    Pxx, freqs, bins = specgram(signal, 256, 128, np.blackman(256))
+    engine = STFT(FS, 256, 128, 512, np.blackman(256))
+    np.testing.assert_allclose(engine.compute(signal), Pxx, rtol=1e-4, atol=1e-9*Pxx.max())
+
+def test_append():
+    signal = np.random.normal(0, 1, (10000,))
+    engine = STFT(FS, 512, 256, 1024, block=5)
+    whole = np.array(engine.compute(signal))
+
+    engine.reset()
+    assert_equal(engine.power().shape, (513, 0))
+    nsegments = 0
+    for chunk in np.array_split(signal, [100, 1000, 1001, 4000, 9999]):
+        nsegments += engine.append(chunk)
+    assert_equal(nsegments, whole.shape[1])
+    np.testing.assert_array_equal(engine.power(), whole)
+
+def test_short_signal():
+    signal = np.random.normal(0, 1, (100,))
+    Pxx, freqs, bins = specgram(signal, 512, 0, mlab.window_hanning)
+    engine = STFT(FS, 512, 0, 1024)
+    power = engine.compute(signal)
+    assert_equal(power.shape, (513, 1))
+    np.testing.assert_allclose(power, Pxx, rtol=1e-4, atol=1e-9*Pxx.max())
+
+@raises(ValueError)
+def test_bad_overlap():
+    STFT(FS, 512, 512)
@@ -0,0 +1,58 @@
+import time
+
+import numpy as np
+from nose.tools import assert_equal
+
+from sparkle.tools.timing import TimingRecorder, monotonic
+
+
+def test_monotonic():
+    times = [monotonic() for i in range(1000)]
+    assert np.all(np.diff(times) >= 0)
+    start = monotonic()
+    time.sleep(0.05)
+    assert 0.045 < monotonic() - start < 0.1
+
+def test_record():
+    recorder = TimingRecorder(10)
+    for i in range(5):
+        recorder.record('read', i)
+    recorder.record('save', 0.5)
+    assert_equal(recorder.stages(), ['read', 'save'])
+    np.testing.assert_array_equal(recorder.values('read'), range(5))
+    assert_equal(len(recorder.values('arm')), 0)
+
+def test_ring_buffer():
+    recorder = TimingRecorder(10)
+    for i in range(25):
+        recorder.record('read', i)
+    # only the latest kept, oldest first
+    np.testing.assert_array_equal(recorder.values('read'), range(15, 25))
+    assert_equal(recorder.count('read'), 25)
+
+def test_timer():
+    recorder = TimingRecorder()
+    with recorder.timer('wait'):
+        time.sleep(0.02)
+    assert 0.015 < recorder.values('wait')[0] < 0.1
+
+def test_summary():
+    recorder = TimingRecorder()
+    values = np.random.uniform(0, 1, (100,))
+    for value in values:
+        recorder.record('read', value)
+    np.testing.assert_array_almost_equal(recorder.percentiles('read', [10, 50]),
+                                         np.percentile(values, [10, 50]))
+    assert np.all(np.isnan(recorder.percentiles('save')))
+    counts, edges = recorder.histogram('read', 5)
+    assert_equal(sum(counts), 100)
+    assert_equal(len(edges), 6)
+
+    summary = recorder.summary()
+    assert_equal(summary.keys(), ['read'])
+    assert_equal(summary['read']['count'], 100)
+    assert_equal(summary['read']['max'], np.amax(values))
+    assert_equal(summary['read']['p50'], np.median(values))
+
+    recorder.reset()
+    assert_equal(recorder.summary(), {})